@@ -1,32 +1,34 @@
-from .chroma import ChromaModel, ChromaRadianceModel
-from .hidream import HidreamModel, HidreamE1Model
-from .f_light import FLiteModel
-from .omnigen2 import OmniGen2Model
-from .flux_kontext import FluxKontextModel
-from .wan22 import Wan225bModel, Wan2214bModel, Wan2214bI2VModel
-from .qwen_image import QwenImageModel, QwenImageEditModel, QwenImageEditPlusModel
-from .flux2 import Flux2Model, Flux2Klein4BModel, Flux2Klein9BModel
-from .z_image import ZImageModel
-from .ltx2 import LTX2Model
+import importlib
 
-AI_TOOLKIT_MODELS = [
-    # put a list of models here
-    ChromaModel,
-    ChromaRadianceModel,
-    HidreamModel,
-    HidreamE1Model,
-    FLiteModel,
-    OmniGen2Model,
-    FluxKontextModel,
-    Wan225bModel,
-    Wan2214bI2VModel,
-    Wan2214bModel,
-    QwenImageModel,
-    QwenImageEditModel,
-    QwenImageEditPlusModel,
-    Flux2Model,
-    ZImageModel,
-    LTX2Model,
-    Flux2Klein4BModel,
-    Flux2Klein9BModel,
-]
+# model class -> submodule it comes from, in AI_TOOLKIT_MODELS order. they are imported on first access
+# so resolving one arch through the extension registry does not import every model and its dependencies
+_MODEL_MODULES = {
+    "ChromaModel": ".chroma",
+    "ChromaRadianceModel": ".chroma",
+    "HidreamModel": ".hidream",
+    "HidreamE1Model": ".hidream",
+    "FLiteModel": ".f_light",
+    "OmniGen2Model": ".omnigen2",
+    "FluxKontextModel": ".flux_kontext",
+    "Wan225bModel": ".wan22",
+    "Wan2214bI2VModel": ".wan22",
+    "Wan2214bModel": ".wan22",
+    "QwenImageModel": ".qwen_image",
+    "QwenImageEditModel": ".qwen_image",
+    "QwenImageEditPlusModel": ".qwen_image",
+    "Flux2Model": ".flux2",
+    "ZImageModel": ".z_image",
+    "LTX2Model": ".ltx2",
+    "Flux2Klein4BModel": ".flux2",
+    "Flux2Klein9BModel": ".flux2",
+}
+
+
+def __getattr__(name):
+    if name == "AI_TOOLKIT_MODELS":
+        # put a list of models here
+        return [__getattr__(model_name) for model_name in _MODEL_MODULES]
+    if name in _MODEL_MODULES:
+        module = importlib.import_module(_MODEL_MODULES[name], __name__)
+        return getattr(module, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,5 +1,5 @@
 import os
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, List
 
 import torch
 from toolkit.config_modules import GenerateImageConfig, ModelConfig
@@ -85,6 +85,7 @@ class ChromaModel(BaseModel):
         self.is_flow_matching = True
         self.is_transformer = True
         self.target_lora_modules = ['Chroma']
+        self.supports_batched_sampling = True
 
     # static method to get the noise scheduler
     @staticmethod
@@ -309,6 +310,31 @@ class ChromaModel(BaseModel):
         ).images[0]
         return img
 
+    def generate_batch_images(
+        self,
+        pipeline: ChromaPipeline,
+        gen_configs: List[GenerateImageConfig],
+        conditional_embeds: PromptEmbeds,
+        unconditional_embeds: PromptEmbeds,
+        generators: List[torch.Generator],
+        extra: dict,
+    ):
+        gen_config = gen_configs[0]
+        extra['negative_prompt_embeds'] = unconditional_embeds.text_embeds
+        extra['negative_prompt_attn_mask'] = unconditional_embeds.attention_mask
+
+        imgs = pipeline(
+            prompt_embeds=conditional_embeds.text_embeds,
+            prompt_attn_mask=conditional_embeds.attention_mask,
+            height=gen_config.height,
+            width=gen_config.width,
+            num_inference_steps=gen_config.num_inference_steps,
+            guidance_scale=gen_config.guidance_scale,
+            generator=generators,
+            **extra
+        ).images
+        return imgs
+
     def get_noise_prediction(
         self,
         latent_model_input: torch.Tensor,
@@ -16,7 +16,14 @@ from toolkit.samplers.custom_flowmatch_sampler import (
 from toolkit.dequantize import patch_dequantization_on_save
 from toolkit.accelerator import unwrap_model
 from optimum.quanto import freeze, QTensor
-from toolkit.util.quantize import quantize, get_qtype, quantize_model
+from toolkit.util.quantize import (
+    quantize,
+    get_qtype,
+    quantize_model,
+    load_quantized_model_from_cache,
+    can_quantize_streaming,
+    quantize_model_streaming,
+)
 
 from transformers import AutoProcessor, Mistral3ForConditionalGeneration
 from .src.model import Flux2, Flux2Params
@@ -132,39 +139,51 @@ class Flux2Model(BaseModel):
         transformer_path = model_path
 
         self.print_and_status_update("Loading transformer")
-        with torch.device("meta"):
-            transformer = Flux2(self.get_flux2_params())
-
-        # use local path if provided
-        if os.path.exists(os.path.join(transformer_path, self.flux2_te_filename)):
-            transformer_path = os.path.join(transformer_path, self.flux2_te_filename)
-
-        if not os.path.exists(transformer_path):
-            # assume it is from the hub
-            transformer_path = huggingface_hub.hf_hub_download(
-                repo_id=model_path,
-                filename=self.flux2_te_filename,
-                token=HF_TOKEN,
-            )
-
-        transformer_state_dict = load_file(transformer_path, device="cpu")
+        transformer = load_quantized_model_from_cache(
+            self, "transformer", lambda config: Flux2(self.get_flux2_params())
+        )
 
-        # cast to dtype
-        for key in transformer_state_dict:
-            transformer_state_dict[key] = transformer_state_dict[key].to(dtype)
+        if transformer is None:
+            with torch.device("meta"):
+                transformer = Flux2(self.get_flux2_params())
 
-        transformer.load_state_dict(transformer_state_dict, assign=True)
+            # use local path if provided
+            if os.path.exists(os.path.join(transformer_path, self.flux2_te_filename)):
+                transformer_path = os.path.join(transformer_path, self.flux2_te_filename)
 
-        transformer.to(self.quantize_device, dtype=dtype)
+            if not os.path.exists(transformer_path):
+                # assume it is from the hub
+                transformer_path = huggingface_hub.hf_hub_download(
+                    repo_id=model_path,
+                    filename=self.flux2_te_filename,
+                    token=HF_TOKEN,
+                )
 
-        if self.model_config.quantize:
-            # patch the state dict method
-            patch_dequantization_on_save(transformer)
-            self.print_and_status_update("Quantizing Transformer")
-            quantize_model(self, transformer)
-            flush()
-        else:
-            transformer.to(self.device_torch, dtype=dtype)
+            if can_quantize_streaming(self):
+                self.print_and_status_update("Loading and quantizing transformer block by block")
+                quantize_model_streaming(
+                    self, transformer, [transformer_path], cache_name="transformer"
+                )
+                flush()
+            else:
+                transformer_state_dict = load_file(transformer_path, device="cpu")
+
+                # cast to dtype
+                for key in transformer_state_dict:
+                    transformer_state_dict[key] = transformer_state_dict[key].to(dtype)
+
+                transformer.load_state_dict(transformer_state_dict, assign=True)
+
+                transformer.to(self.quantize_device, dtype=dtype)
+
+                if self.model_config.quantize:
+                    # patch the state dict method
+                    patch_dequantization_on_save(transformer)
+                    self.print_and_status_update("Quantizing Transformer")
+                    quantize_model(self, transformer, cache_name="transformer")
+                    flush()
+                else:
+                    transformer.to(self.device_torch, dtype=dtype)
         flush()
 
         if (
@@ -175,6 +194,7 @@ class Flux2Model(BaseModel):
                 transformer,
                 self.device_torch,
                 offload_percent=self.model_config.layer_offloading_transformer_percent,
+                **self.get_layer_offloading_kwargs(),
             )
 
         if self.model_config.low_vram:
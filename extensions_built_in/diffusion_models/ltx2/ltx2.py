@@ -299,6 +299,7 @@ class LTX2Model(BaseModel):
                 offload_percent=self.model_config.layer_offloading_transformer_percent,
                 ignore_modules=ignore_modules,
                 verbose=verbose,
+                **self.get_layer_offloading_kwargs(),
             )
             print_verbose(verbose, f"MemoryManager attached to transformer")
 
@@ -14,7 +14,16 @@ from toolkit.samplers.custom_flowmatch_sampler import (
 )
 from toolkit.accelerator import get_accelerator, unwrap_model
 from optimum.quanto import freeze, QTensor
-from toolkit.util.quantize import quantize, get_qtype, quantize_model
+from toolkit.util.quantize import (
+    quantize,
+    get_qtype,
+    quantize_model,
+    load_quantized_model_from_cache,
+    can_quantize_streaming,
+    quantize_model_streaming,
+    get_safetensors_files,
+)
+from accelerate import init_empty_weights
 import torch.nn.functional as F
 from toolkit.memory_management import MemoryManager
 from safetensors.torch import load_file
@@ -94,42 +103,67 @@ class QwenImageModel(BaseModel):
 
         self.print_and_status_update("Loading transformer")
 
-        if model_path.endswith(".safetensors"):
-            # load the safetensors file
-            transformer = QwenImageTransformer2DModel.from_single_file(
-                model_path,
-                config="Qwen/Qwen-Image",
-                subfolder="transformer",
-                torch_dtype=model_dtype,
-            )
-            transformer.to(model_dtype)
-
-        else:
-            transformer_path = model_path
-            transformer_subfolder = "transformer"
-            if os.path.exists(transformer_path):
-                transformer_subfolder = None
-                transformer_path = os.path.join(transformer_path, "transformer")
-                # check if the path is a full checkpoint.
-                te_folder_path = os.path.join(model_path, "text_encoder")
-                # if we have the te, this folder is a full checkpoint, use it as the base
-                if os.path.exists(te_folder_path):
-                    base_model_path = model_path
-
-            transformer = QwenImageTransformer2DModel.from_pretrained(
-                transformer_path, subfolder=transformer_subfolder, torch_dtype=dtype
-            )
+        if os.path.exists(model_path) and not model_path.endswith(".safetensors"):
+            # check if the path is a full checkpoint.
+            te_folder_path = os.path.join(model_path, "text_encoder")
+            # if we have the te, this folder is a full checkpoint, use it as the base
+            if os.path.exists(te_folder_path):
+                base_model_path = model_path
 
-        if self.model_config.quantize:
-            self.print_and_status_update("Quantizing Transformer")
-            quantize_model(self, transformer)
-            flush()
+        transformer = load_quantized_model_from_cache(
+            self, "transformer", QwenImageTransformer2DModel.from_config
+        )
+
+        if transformer is None:
+            is_quantized = False
+            if model_path.endswith(".safetensors"):
+                # load the safetensors file
+                transformer = QwenImageTransformer2DModel.from_single_file(
+                    model_path,
+                    config="Qwen/Qwen-Image",
+                    subfolder="transformer",
+                    torch_dtype=model_dtype,
+                )
+                transformer.to(model_dtype)
+
+            else:
+                transformer_path = model_path
+                transformer_subfolder = "transformer"
+                if os.path.exists(transformer_path):
+                    transformer_subfolder = None
+                    transformer_path = os.path.join(transformer_path, "transformer")
+
+                if can_quantize_streaming(self):
+                    self.print_and_status_update("Loading and quantizing transformer block by block")
+                    with init_empty_weights():
+                        transformer = QwenImageTransformer2DModel.from_config(
+                            QwenImageTransformer2DModel.load_config(
+                                transformer_path, subfolder=transformer_subfolder
+                            )
+                        )
+                    quantize_model_streaming(
+                        self,
+                        transformer,
+                        get_safetensors_files(transformer_path, transformer_subfolder),
+                        cache_name="transformer",
+                    )
+                    is_quantized = True
+                else:
+                    transformer = QwenImageTransformer2DModel.from_pretrained(
+                        transformer_path, subfolder=transformer_subfolder, torch_dtype=dtype
+                    )
+
+            if self.model_config.quantize and not is_quantized:
+                self.print_and_status_update("Quantizing Transformer")
+                quantize_model(self, transformer, cache_name="transformer")
+                flush()
 
         if self.model_config.layer_offloading and self.model_config.layer_offloading_transformer_percent > 0:
             MemoryManager.attach(
                 transformer,
                 self.device_torch,
-                offload_percent=self.model_config.layer_offloading_transformer_percent
+                offload_percent=self.model_config.layer_offloading_transformer_percent,
+                **self.get_layer_offloading_kwargs(),
             )
 
         if self.model_config.low_vram:
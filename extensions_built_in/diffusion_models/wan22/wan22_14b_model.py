@@ -363,13 +363,15 @@ class Wan2214bModel(Wan21):
                 transformer_1,
                 self.device_torch,
                 offload_percent=self.model_config.layer_offloading_transformer_percent,
-                ignore_modules=[transformer_1.scale_shift_table] + [block.scale_shift_table for block in transformer_1.blocks]
+                ignore_modules=[transformer_1.scale_shift_table] + [block.scale_shift_table for block in transformer_1.blocks],
+                **self.get_layer_offloading_kwargs(),
             )
             MemoryManager.attach(
                 transformer_2,
                 self.device_torch,
                 offload_percent=self.model_config.layer_offloading_transformer_percent,
-                ignore_modules=[transformer_2.scale_shift_table] + [block.scale_shift_table for block in transformer_2.blocks]
+                ignore_modules=[transformer_2.scale_shift_table] + [block.scale_shift_table for block in transformer_2.blocks],
+                **self.get_layer_offloading_kwargs(),
             )
 
         return transformer
@@ -193,7 +193,8 @@ class ZImageModel(BaseModel):
                 ignore_modules=[
                     transformer.x_pad_token,
                     transformer.cap_pad_token,
-                ]
+                ],
+                **self.get_layer_offloading_kwargs(),
             )
 
         if self.model_config.low_vram:
@@ -1,6 +1,9 @@
-from .flex2 import Flex2
-
-AI_TOOLKIT_MODELS = [
-    # put a list of models here
-    Flex2
-]
+def __getattr__(name):
+    # imported on first access, see extensions_built_in/diffusion_models/__init__.py
+    if name == "Flex2":
+        from .flex2 import Flex2
+        return Flex2
+    if name == "AI_TOOLKIT_MODELS":
+        # put a list of models here
+        return [__getattr__("Flex2")]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -23,6 +23,7 @@ from toolkit.custom_adapter import CustomAdapter
 from toolkit.print import print_acc
 from toolkit.print import print_verbose
 from toolkit.prompt_utils import PromptEmbeds, concat_prompt_embeds
+from toolkit.prompt_embeds_cache import PromptEmbedsCache, get_text_encoder_identity
 from toolkit.reference_adapter import ReferenceAdapter
 from toolkit.stable_diffusion_model import StableDiffusion, BlankNetwork
 from toolkit.train_tools import get_torch_dtype, apply_snr_weight, add_all_snr_to_noise_scheduler, \
@@ -85,6 +86,8 @@ class SDTrainer(BaseSDTrainProcess):
         self.cached_blank_embeds: Optional[PromptEmbeds] = None
         self.cached_trigger_embeds: Optional[PromptEmbeds] = None
         self.diff_output_preservation_embeds: Optional[PromptEmbeds] = None
+        self.prompt_embeds_cache: Optional[PromptEmbedsCache] = None
+        self._is_text_encoder_on_device = False
         
         self.dfe: Optional[DiffusionFeatureExtractor] = None
         self.unconditional_embeds = None
@@ -118,6 +121,27 @@ class SDTrainer(BaseSDTrainProcess):
     def before_model_load(self):
         pass
     
+    def encode_prompt_cached(
+            self,
+            prompt: str,
+            control_paths: Optional[List[str]] = None,
+            cache_extra: Optional[dict] = None,
+            get_encode_kwargs=None,
+    ) -> PromptEmbeds:
+        # checks the disk cache first and only moves the text encoder to the device if we have to encode
+        if self.prompt_embeds_cache is not None:
+            prompt_embeds = self.prompt_embeds_cache.load(prompt, control_paths, cache_extra)
+            if prompt_embeds is not None:
+                return prompt_embeds
+        if not self._is_text_encoder_on_device:
+            self.sd.text_encoder_to(self.device_torch)
+            self._is_text_encoder_on_device = True
+        encode_kwargs = get_encode_kwargs() if get_encode_kwargs is not None else {}
+        prompt_embeds = self.sd.encode_prompt(prompt, **encode_kwargs)
+        if self.prompt_embeds_cache is not None:
+            self.prompt_embeds_cache.save(prompt, prompt_embeds, control_paths, cache_extra)
+        return prompt_embeds
+
     def cache_sample_prompts(self):
         if self.train_config.disable_sampling:
             return
@@ -141,69 +165,51 @@ class SDTrainer(BaseSDTrainProcess):
                     ctrl_img_3=sample_item.ctrl_img_3,
                 )
                 
-                has_control_images = False
-                if gen_img_config.ctrl_img is not None or gen_img_config.ctrl_img_1 is not None or gen_img_config.ctrl_img_2 is not None or gen_img_config.ctrl_img_3 is not None:
-                    has_control_images = True
+                control_paths = [
+                    x for x in [
+                        gen_img_config.ctrl_img,
+                        gen_img_config.ctrl_img_1,
+                        gen_img_config.ctrl_img_2,
+                        gen_img_config.ctrl_img_3,
+                    ] if x is not None
+                ]
                 # see if we need to encode the control images
-                if self.sd.encode_control_in_text_embeddings and has_control_images:
-                    
-                    ctrl_img_list = []
-                    
-                    if gen_img_config.ctrl_img is not None:
-                        ctrl_img = Image.open(gen_img_config.ctrl_img).convert("RGB")
-                        # convert to 0 to 1 tensor
-                        ctrl_img = (
-                            TF.to_tensor(ctrl_img)
-                            .unsqueeze(0)
-                            .to(self.sd.device_torch, dtype=self.sd.torch_dtype)
-                        )
-                        ctrl_img_list.append(ctrl_img)
-                    
-                    if gen_img_config.ctrl_img_1 is not None:
-                        ctrl_img_1 = Image.open(gen_img_config.ctrl_img_1).convert("RGB")
-                        # convert to 0 to 1 tensor
-                        ctrl_img_1 = (
-                            TF.to_tensor(ctrl_img_1)
-                            .unsqueeze(0)
-                            .to(self.sd.device_torch, dtype=self.sd.torch_dtype)
-                        )
-                        ctrl_img_list.append(ctrl_img_1)
-                    if gen_img_config.ctrl_img_2 is not None:
-                        ctrl_img_2 = Image.open(gen_img_config.ctrl_img_2).convert("RGB")
-                        # convert to 0 to 1 tensor
-                        ctrl_img_2 = (
-                            TF.to_tensor(ctrl_img_2)
-                            .unsqueeze(0)
-                            .to(self.sd.device_torch, dtype=self.sd.torch_dtype)
-                        )
-                        ctrl_img_list.append(ctrl_img_2)
-                    if gen_img_config.ctrl_img_3 is not None:
-                        ctrl_img_3 = Image.open(gen_img_config.ctrl_img_3).convert("RGB")
-                        # convert to 0 to 1 tensor
-                        ctrl_img_3 = (
-                            TF.to_tensor(ctrl_img_3)
-                            .unsqueeze(0)
-                            .to(self.sd.device_torch, dtype=self.sd.torch_dtype)
-                        )
-                        ctrl_img_list.append(ctrl_img_3)
-                    
-                    if self.sd.has_multiple_control_images:
-                        ctrl_img = ctrl_img_list
-                    else:
-                        ctrl_img = ctrl_img_list[0] if len(ctrl_img_list) > 0 else None
-                    
-                    
-                    positive = self.sd.encode_prompt(
+                if self.sd.encode_control_in_text_embeddings and len(control_paths) > 0:
+                    loaded_ctrl_img = []
+
+                    def get_encode_kwargs():
+                        # only load the control images if we actually have to encode
+                        if len(loaded_ctrl_img) == 0:
+                            ctrl_img_list = []
+                            for control_path in control_paths:
+                                ctrl_img = Image.open(control_path).convert("RGB")
+                                # convert to 0 to 1 tensor
+                                ctrl_img = (
+                                    TF.to_tensor(ctrl_img)
+                                    .unsqueeze(0)
+                                    .to(self.sd.device_torch, dtype=self.sd.torch_dtype)
+                                )
+                                ctrl_img_list.append(ctrl_img)
+
+                            if self.sd.has_multiple_control_images:
+                                loaded_ctrl_img.append(ctrl_img_list)
+                            else:
+                                loaded_ctrl_img.append(ctrl_img_list[0])
+                        return {'control_images': loaded_ctrl_img[0]}
+
+                    positive = self.encode_prompt_cached(
                         gen_img_config.prompt,
-                        control_images=ctrl_img
+                        control_paths=control_paths,
+                        get_encode_kwargs=get_encode_kwargs,
                     ).to('cpu')
-                    negative = self.sd.encode_prompt(
+                    negative = self.encode_prompt_cached(
                         gen_img_config.negative_prompt,
-                        control_images=ctrl_img
+                        control_paths=control_paths,
+                        get_encode_kwargs=get_encode_kwargs,
                     ).to('cpu')
                 else:
-                    positive = self.sd.encode_prompt(gen_img_config.prompt).to('cpu')
-                    negative = self.sd.encode_prompt(gen_img_config.negative_prompt).to('cpu')
+                    positive = self.encode_prompt_cached(gen_img_config.prompt).to('cpu')
+                    negative = self.encode_prompt_cached(gen_img_config.negative_prompt).to('cpu')
                 
                 self.sd.sample_prompts_cache.append({
                     'conditional': positive,
@@ -314,20 +320,38 @@ class SDTrainer(BaseSDTrainProcess):
             with torch.no_grad():
                 if self.train_config.train_text_encoder:
                     raise ValueError("Cannot unload text encoder if training text encoder")
+                if self.train_config.prompt_embeds_cache:
+                    cache_dir = self.train_config.prompt_embeds_cache_dir
+                    if cache_dir is None:
+                        cache_dir = os.path.join(self.save_root, '_prompt_embeds_cache')
+                    self.prompt_embeds_cache = PromptEmbedsCache(
+                        cache_dir,
+                        get_text_encoder_identity(self.model_config),
+                    )
                 # cache embeddings
-                self.sd.text_encoder_to(self.device_torch)
-                encode_kwargs = {}
+                cache_extra = None
+                get_encode_kwargs = None
                 if self.sd.encode_control_in_text_embeddings:
-                    # just do a blank image for unconditionals
-                    control_image = torch.zeros((1, 3, 224, 224), device=self.sd.device_torch, dtype=self.sd.torch_dtype)
-                    if self.sd.has_multiple_control_images:
-                        control_image = [control_image]
-                    encode_kwargs['control_images'] = control_image
-                self.cached_blank_embeds = self.sd.encode_prompt("", **encode_kwargs)
+                    # the blank control image is part of the embedding
+                    cache_extra = {'blank_control_image': True}
+
+                    def get_encode_kwargs():
+                        # just do a blank image for unconditionals
+                        control_image = torch.zeros((1, 3, 224, 224), device=self.sd.device_torch, dtype=self.sd.torch_dtype)
+                        if self.sd.has_multiple_control_images:
+                            control_image = [control_image]
+                        return {'control_images': control_image}
+                self.cached_blank_embeds = self.encode_prompt_cached(
+                    "", cache_extra=cache_extra, get_encode_kwargs=get_encode_kwargs
+                ).to(self.device_torch)
                 if self.trigger_word is not None:
-                    self.cached_trigger_embeds = self.sd.encode_prompt(self.trigger_word, **encode_kwargs)
+                    self.cached_trigger_embeds = self.encode_prompt_cached(
+                        self.trigger_word, cache_extra=cache_extra, get_encode_kwargs=get_encode_kwargs
+                    ).to(self.device_torch)
                 if self.train_config.diff_output_preservation:
-                    self.diff_output_preservation_embeds = self.sd.encode_prompt(self.train_config.diff_output_preservation_class)
+                    self.diff_output_preservation_embeds = self.encode_prompt_cached(
+                        self.train_config.diff_output_preservation_class
+                    ).to(self.device_torch)
                 
                 self.cache_sample_prompts()
                 
@@ -1,7 +1,7 @@
 import os
 from collections import OrderedDict
 from jobs import BaseJob
-from toolkit.extension import get_all_extensions_process_dict
+from toolkit.extension import get_extensions_process_dict
 from toolkit.paths import CONFIG_ROOT
 
 class ExtensionJob(BaseJob):
@@ -9,7 +9,9 @@ class ExtensionJob(BaseJob):
     def __init__(self, config: OrderedDict):
         super().__init__(config)
         self.device = self.get_conf('device', 'cpu')
-        self.process_dict = get_all_extensions_process_dict()
+        # only import the extensions this job uses
+        process_types = [p['type'] for p in self.config.get('process', []) if 'type' in p]
+        self.process_dict = get_extensions_process_dict(process_types)
         self.load_processes(self.process_dict)
 
     def run(self):
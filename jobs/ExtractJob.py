@@ -30,12 +30,21 @@ class ExtractJob(BaseJob):
         self.output_folder = self.get_conf('output_folder', required=True)
         self.is_v2 = self.get_conf('is_v2', False)
         self.device = self.get_conf('device', 'cpu')
+        # read the weights straight from the safetensors files a few at a time instead of loading
+        # both models. lora processes only, with mode fixed
+        self.stream_safetensors = self.get_conf('stream_safetensors', False)
 
         # loads the processes from the config
         self.load_processes(process_dict)
 
     def run(self):
         super().run()
+        if self.stream_safetensors:
+            print(f"Streaming weights from {self.base_model_path} and {self.extract_model_path}")
+            for process in self.process:
+                process.run()
+            return
+
         # load models
         print(f"Loading models for extraction")
         print(f" - Loading base model: {self.base_model_path}")
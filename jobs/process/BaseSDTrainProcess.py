@@ -26,7 +26,9 @@ from toolkit.memory_management import MemoryManager
 from toolkit.basic import value_map
 from toolkit.clip_vision_adapter import ClipVisionAdapter
 from toolkit.custom_adapter import CustomAdapter
+from toolkit.delta_checkpoint import DELTA_CHECKPOINT_SUFFIX, is_delta_checkpoint, get_delta_parent_path
 from toolkit.data_loader import get_dataloader_from_datasets, trigger_dataloader_setup_epoch
+from toolkit.dataloader_monitor import DataloaderStallMonitor
 from toolkit.data_transfer_object.data_loader import FileItemDTO, DataLoaderBatchDTO
 from toolkit.ema import ExponentialMovingAverage
 from toolkit.embedding import Embedding
@@ -36,10 +38,16 @@ from toolkit.lora_special import LoRASpecialNetwork
 from toolkit.lorm import convert_diffusers_unet_to_lorm, count_parameters, print_lorm_extract_details, \
     lorm_ignore_if_contains, lorm_parameter_threshold, LORM_TARGET_REPLACE_MODULE
 from toolkit.lycoris_special import LycorisSpecialNetwork
+from toolkit.memory_management.offload_planner import save_offload_plans
 from toolkit.models.decorator import Decorator
 from toolkit.network_mixins import Network
 from toolkit.optimizer import get_optimizer
+from toolkit.optimizers.sharded_state import SHARDED_OPTIMIZER_DIRNAME, save_sharded_optimizer_state, \
+    get_sharded_optimizer_state_dir, load_sharded_optimizer_state
 from toolkit.paths import CONFIG_ROOT
+from toolkit.profiler import StepProfiler
+from toolkit.sample_writer import SampleWriter
+from toolkit.sample_worker import SampleWorker
 from toolkit.progress_bar import ToolkitProgressBar
 from toolkit.reference_adapter import ReferenceAdapter
 from toolkit.sampler import get_sampler
@@ -98,6 +106,10 @@ class BaseSDTrainProcess(BaseTrainProcess):
         self.start_step = 0
         self.epoch_num = 0
         self.last_save_step = 0
+        # state for delta checkpoints, the last network save and what loading it reconstructs to
+        self.delta_parent_file: Optional[str] = None
+        self.delta_parent_state_dict: Optional[OrderedDict] = None
+        self.saves_since_full = 0
         # start at 1 so we can do a sample at the start
         self.grad_accumulation_step = 1
         # if true, then we do not do an optimizer step. We are accumulating gradients
@@ -116,6 +128,9 @@ class BaseSDTrainProcess(BaseTrainProcess):
         # update modelconfig dtype to match train
         model_config['dtype'] = self.train_config.dtype
         self.model_config = ModelConfig(**model_config)
+        if self.model_config.layer_offloading_disk_dir is not None and self.network_config is None:
+            # disk offloaded weights are memory mapped read only and frozen, they cannot be trained
+            raise ValueError("layer_offloading_disk_dir is only supported when training a network (lora, lokr, etc)")
 
         self.save_config = SaveConfig(**self.get_conf('save', {}))
         self.sample_config = SampleConfig(**self.get_conf('sample', {}))
@@ -126,11 +141,25 @@ class BaseSDTrainProcess(BaseTrainProcess):
         else:
             self.has_first_sample_requested = False
             self.first_sample_config = self.sample_config
+        self.sample_worker: Optional[SampleWorker] = None
+        self.sample_writer: Optional[SampleWriter] = None
+        if self.sample_config.write_workers > 0:
+            self.sample_writer = SampleWriter(num_workers=self.sample_config.write_workers)
         self.logging_config = LoggingConfig(**self.get_conf('logging', {}))
         self.logger = create_logger(self.logging_config, config, self.save_root)
+        self.profiler: Optional[StepProfiler] = None
+        if self.logging_config.profile:
+            self.profiler = StepProfiler(
+                capacity=self.logging_config.profile_buffer_size,
+                device_timing=self.logging_config.profile_device_time,
+                count_syncs=self.logging_config.profile_count_syncs,
+            )
+            self.timer.profiler = self.profiler
+            self.profiler.activate()
         self.optimizer: torch.optim.Optimizer = None
         self.lr_scheduler = None
         self.data_loader: Union[DataLoader, None] = None
+        self.dataloader_monitor: Optional[DataloaderStallMonitor] = None
         self.data_loader_reg: Union[DataLoader, None] = None
         self.trigger_word = self.get_conf('trigger_word', None)
 
@@ -269,12 +298,37 @@ class BaseSDTrainProcess(BaseTrainProcess):
         # override in subclass
         return generate_image_config_list
 
+    def start_sample_worker(self):
+        if self.network is None or self.is_fine_tuning or self.adapter is not None \
+                or self.embedding is not None or self.decorator is not None \
+                or self.network_config.type.lower() == 'lorm':
+            print_acc("Sample worker only supports lora / lycoris training, sampling in the training process")
+            return
+        device = self.sample_config.worker_device
+        if device is None:
+            device = 'cuda:1' if torch.cuda.device_count() > 1 else 'cpu'
+        raw_model_config = copy.deepcopy(self.get_conf('model', {}))
+        raw_model_config['dtype'] = self.train_config.dtype
+        self.sample_worker = SampleWorker(
+            raw_model_config=raw_model_config,
+            raw_network_config=copy.deepcopy(self.get_conf('network', {})),
+            raw_train_config=copy.deepcopy(self.get_conf('train', {})),
+            device=device,
+            snapshot_dir=os.path.join(self.save_root, '_sample_worker'),
+            logger=self.logger,
+        )
+        self.sample_worker.start()
+
     def sample(self, step=None, is_first=False):
         if not self.accelerator.is_main_process:
             return
         flush()
         sample_folder = os.path.join(self.save_root, 'samples')
-        gen_img_config_list = []
+        gen_img_config_kwargs_list = []
+
+        # make sure the last round is written before starting the next one
+        if self.sample_writer is not None:
+            self.sample_writer.wait()
 
         sample_config = self.first_sample_config if is_first else self.sample_config
         start_seed = sample_config.seed
@@ -326,7 +380,7 @@ class BaseSDTrainProcess(BaseTrainProcess):
             if sample_item.seed is not None:
                 current_seed = sample_item.seed
 
-            gen_img_config_list.append(GenerateImageConfig(
+            gen_img_config_kwargs_list.append(dict(
                 prompt=prompt,  # it will autoparse the prompt
                 width=sample_item.width,
                 height=sample_item.height,
@@ -341,7 +395,6 @@ class BaseSDTrainProcess(BaseTrainProcess):
                 adapter_conditioning_scale=sample_config.adapter_conditioning_scale,
                 refiner_start_at=sample_config.refiner_start_at,
                 extra_values=sample_config.extra_values,
-                logger=self.logger,
                 num_frames=sample_item.num_frames,
                 fps=sample_item.fps,
                 ctrl_img=sample_item.ctrl_img,
@@ -353,6 +406,26 @@ class BaseSDTrainProcess(BaseTrainProcess):
                 **extra_args
             ))
 
+        if self.sample_worker is not None:
+            # hand it off to the worker process, with the ema weights if we have them
+            if self.ema is not None:
+                self.ema.eval()
+            self.sample_worker.submit(
+                step,
+                self.network,
+                gen_img_config_kwargs_list,
+                sampler=sample_config.sampler,
+                batch_size=sample_config.batch_size,
+            )
+            if self.ema is not None:
+                self.ema.train()
+            return
+
+        gen_img_config_list = [
+            GenerateImageConfig(**kwargs, logger=self.logger, sample_writer=self.sample_writer)
+            for kwargs in gen_img_config_kwargs_list
+        ]
+
         # post process
         gen_img_config_list = self.post_process_generate_image_config_list(gen_img_config_list)
 
@@ -365,7 +438,11 @@ class BaseSDTrainProcess(BaseTrainProcess):
             self.adapter.is_sampling = True
         
         # send to be generated
-        self.sd.generate_images(gen_img_config_list, sampler=sample_config.sampler)
+        self.sd.generate_images(
+            gen_img_config_list,
+            sampler=sample_config.sampler,
+            batch_size=sample_config.batch_size,
+        )
 
         
         if self.adapter is not None and isinstance(self.adapter, CustomAdapter):
@@ -415,7 +492,9 @@ class BaseSDTrainProcess(BaseTrainProcess):
             pattern = f"{self.job.name}_*"
             items = glob.glob(os.path.join(self.save_root, pattern))
             # Separate files and directories
-            safetensors_files = [f for f in items if f.endswith('.safetensors')]
+            safetensors_files = [f for f in items if f.endswith('.safetensors') and not is_delta_checkpoint(f)]
+            # delta checkpoints depend on the saves before them, they are removed with their base below
+            delta_files = [f for f in items if is_delta_checkpoint(f)]
             pt_files = [f for f in items if f.endswith('.pt')]
             directories = [d for d in items if os.path.isdir(d) and not d.endswith('.safetensors')]
             embed_files = []
@@ -443,7 +522,7 @@ class BaseSDTrainProcess(BaseTrainProcess):
                 critic_items.sort(key=os.path.getctime)
 
             # Combine and sort the lists
-            combined_items = safetensors_files + directories + pt_files
+            combined_items = safetensors_files + delta_files + directories + pt_files
             combined_items.sort(key=os.path.getctime)
             
             num_saves_to_keep = self.save_config.max_step_saves_to_keep
@@ -477,6 +556,22 @@ class BaseSDTrainProcess(BaseTrainProcess):
                 yaml_file = os.path.splitext(item)[0] + ".yaml"
                 if os.path.exists(yaml_file):
                     os.remove(yaml_file)
+
+            # remove delta checkpoints that can no longer be rebuilt. Oldest first so it cascades down the chain
+            delta_files.sort(key=os.path.getctime)
+            for delta_file in delta_files:
+                parent_file = get_delta_parent_path(delta_file)
+                if parent_file is None or not os.path.exists(parent_file):
+                    print_acc(f"Removing old delta save: {delta_file}")
+                    os.remove(delta_file)
+                    # and its yaml, named with or without the .delta part
+                    for yaml_file in [
+                        os.path.splitext(delta_file)[0] + ".yaml",
+                        delta_file[:-len(DELTA_CHECKPOINT_SUFFIX)] + ".yaml",
+                    ]:
+                        if os.path.exists(yaml_file):
+                            os.remove(yaml_file)
+                    combined_items.remove(delta_file)
             if combined_items:
                 latest_item = combined_items[-1]
         return latest_item
@@ -536,12 +631,43 @@ class BaseSDTrainProcess(BaseTrainProcess):
 
                 # if we are doing embedding training as well, add that
                 embedding_dict = self.embedding.state_dict() if self.embedding else None
-                self.network.save_weights(
-                    file_path,
-                    dtype=get_torch_dtype(self.save_config.dtype),
-                    metadata=save_meta,
-                    extra_state_dict=embedding_dict
+                use_delta = (
+                    self.save_config.delta_checkpoints
+                    and step is not None
+                    and self.delta_parent_state_dict is not None
+                    and self.saves_since_full < self.save_config.delta_full_every - 1
+                    and self.network.can_save_delta_weights()
                 )
+                saved_state_dict = None
+                if use_delta:
+                    delta_file_path = os.path.join(self.save_root, f'{lora_name}{step_num}{DELTA_CHECKPOINT_SUFFIX}')
+                    try:
+                        saved_state_dict = self.network.save_delta_weights(
+                            delta_file_path,
+                            parent_file=self.delta_parent_file,
+                            parent_state_dict=self.delta_parent_state_dict,
+                            dtype=get_torch_dtype(self.save_config.dtype),
+                            metadata=save_meta,
+                            extra_state_dict=embedding_dict,
+                            delta_format=self.save_config.delta_format,
+                        )
+                        file_path = delta_file_path
+                        self.saves_since_full += 1
+                    except ValueError as e:
+                        # network changed shape, fall back to a full save
+                        print_acc(f"Could not save delta checkpoint, saving full weights: {e}")
+                        saved_state_dict = None
+                if saved_state_dict is None:
+                    saved_state_dict = self.network.save_weights(
+                        file_path,
+                        dtype=get_torch_dtype(self.save_config.dtype),
+                        metadata=save_meta,
+                        extra_state_dict=embedding_dict
+                    )
+                    self.saves_since_full = 0
+                if self.save_config.delta_checkpoints:
+                    self.delta_parent_file = file_path
+                    self.delta_parent_state_dict = saved_state_dict
                 self.network.multiplier = prev_multiplier
                 # if we have an embedding as well, pair it with the network
 
@@ -668,14 +794,31 @@ class BaseSDTrainProcess(BaseTrainProcess):
         # save optimizer
         if self.optimizer is not None:
             try:
-                filename = f'optimizer.pt'
-                file_path = os.path.join(self.save_root, filename)
                 try:
                     state_dict = unwrap_model(self.optimizer).state_dict()
                 except Exception as e:
                     state_dict = self.optimizer.state_dict()
-                torch.save(state_dict, file_path)
+                sharded_dir = os.path.join(self.save_root, SHARDED_OPTIMIZER_DIRNAME)
+                pt_file_path = os.path.join(self.save_root, 'optimizer.pt')
+                if self.save_config.optimizer_format == 'sharded':
+                    file_path = sharded_dir
+                    save_sharded_optimizer_state(state_dict, file_path)
+                    # remove the other format so we do not resume from a stale one
+                    if os.path.exists(pt_file_path):
+                        os.remove(pt_file_path)
+                else:
+                    file_path = pt_file_path
+                    # write to a temp file first so a crash mid save does not corrupt the only copy
+                    tmp_file_path = file_path + '.tmp'
+                    torch.save(state_dict, tmp_file_path)
+                    os.replace(tmp_file_path, file_path)
+                    if os.path.exists(sharded_dir):
+                        shutil.rmtree(sharded_dir)
+                del state_dict
                 print_acc(f"Saved optimizer to {file_path}")
+            except TypeError:
+                # state the sharded format cannot store, resuming would silently reset the optimizer
+                raise
             except Exception as e:
                 print_acc(e)
                 print_acc("Could not save optimizer")
@@ -1528,6 +1671,16 @@ class BaseSDTrainProcess(BaseTrainProcess):
         # set trainable params
         self.sd.adapter = self.adapter
 
+    def save_layer_offloading_plans(self):
+        # keep what was offloaded with the run, and show how much goes over the bus each step
+        modules = OrderedDict([('transformer', unwrap_model(self.sd.unet))])
+        text_encoders = self.sd.text_encoder if isinstance(self.sd.text_encoder, list) else [self.sd.text_encoder]
+        for i, text_encoder in enumerate(text_encoders):
+            modules[f'text_encoder_{i}'] = text_encoder
+        plans = save_offload_plans(modules, os.path.join(self.save_root, 'layer_offloading_plan.json'))
+        for name, plan in plans.items():
+            print_acc(f"Layer offloading {name}: {plan.summary()}")
+
     def run(self):
         # Get verbose flag from model config
         verbose = self.model_config.verbose if hasattr(self.model_config, 'verbose') else False
@@ -1871,9 +2024,8 @@ class BaseSDTrainProcess(BaseTrainProcess):
                     self.train_config.train_unet
                 )
 
-                # we cannot merge in if quantized
-                if self.model_config.quantize or self.model_config.layer_offloading:
-                    # todo find a way around this
+                # we cannot merge in with layer offloading, and only merge into quantized weights if asked to
+                if self.model_config.layer_offloading or (self.model_config.quantize and not self.network_config.merge_quantized):
                     self.network.can_merge_in = False
 
                 if is_lorm:
@@ -2051,7 +2203,12 @@ class BaseSDTrainProcess(BaseTrainProcess):
         # check if it exists
         optimizer_state_filename = f'optimizer.pt'
         optimizer_state_file_path = os.path.join(self.save_root, optimizer_state_filename)
-        if os.path.exists(optimizer_state_file_path):
+        sharded_optimizer_state_dir = get_sharded_optimizer_state_dir(
+            os.path.join(self.save_root, SHARDED_OPTIMIZER_DIRNAME)
+        )
+        if sharded_optimizer_state_dir is not None:
+            optimizer_state_file_path = sharded_optimizer_state_dir
+        if sharded_optimizer_state_dir is not None or os.path.exists(optimizer_state_file_path):
             # try to load
             # previous param groups
             # previous_params = copy.deepcopy(optimizer.param_groups)
@@ -2069,7 +2226,10 @@ class BaseSDTrainProcess(BaseTrainProcess):
             if load_optimizer:
                 try:
                     print_acc(f"Loading optimizer state from {optimizer_state_file_path}")
-                    optimizer_state_dict = torch.load(optimizer_state_file_path, weights_only=True)
+                    if sharded_optimizer_state_dir is not None:
+                        optimizer_state_dict = load_sharded_optimizer_state(optimizer_state_file_path, optimizer)
+                    else:
+                        optimizer_state_dict = torch.load(optimizer_state_file_path, weights_only=True)
                     optimizer.load_state_dict(optimizer_state_dict)
                     del optimizer_state_dict
                     flush()
@@ -2114,6 +2274,12 @@ class BaseSDTrainProcess(BaseTrainProcess):
         ### HOOK ###
         self.hook_before_train_loop()
 
+        if self.model_config.layer_offloading and self.accelerator.is_main_process:
+            self.save_layer_offloading_plans()
+
+        if self.sample_config.worker and not self.train_config.disable_sampling and self.accelerator.is_main_process:
+            self.start_sample_worker()
+
         if self.has_first_sample_requested and self.step_num <= 1 and not self.train_config.disable_sampling:
             print_acc("Generating first sample from first sample config")
             self.sample(0, is_first=True)
@@ -2140,6 +2306,11 @@ class BaseSDTrainProcess(BaseTrainProcess):
         if self.data_loader is not None:
             dataloader = self.data_loader
             dataloader_iterator = iter(dataloader)
+            self.dataloader_monitor = DataloaderStallMonitor(
+                dataloader,
+                auto_tune=self.train_config.auto_tune_dataloader,
+                auto_tune_steps=self.train_config.auto_tune_dataloader_steps,
+            )
         else:
             dataloader = None
             dataloader_iterator = None
@@ -2183,6 +2354,8 @@ class BaseSDTrainProcess(BaseTrainProcess):
                 self.optimizer.optimizer.swap_paramiters()
                 print_verbose(verbose, f"Parameter swapping performed")
             self.timer.start('train_loop')
+            if self.dataloader_monitor is not None:
+                self.dataloader_monitor.start_step()
             if flush_next:
                 print_verbose(verbose, f"Flushing GPU memory (flush_next=True)")
                 flush()
@@ -2242,7 +2415,7 @@ class BaseSDTrainProcess(BaseTrainProcess):
                         print_verbose(verbose, f"    Loading training batch")
                         try:
                             with self.timer('get_batch'):
-                                batch = next(dataloader_iterator)
+                                batch = self.dataloader_monitor.get_batch(dataloader_iterator)
                             print_verbose(verbose, f"    Training batch loaded successfully")
                         except StopIteration:
                             print_verbose(verbose, f"    Training dataloader exhausted, resetting and triggering epoch setup")
@@ -2250,6 +2423,8 @@ class BaseSDTrainProcess(BaseTrainProcess):
                                 # hit the end of an epoch, reset
                                 if self.progress_bar is not None:
                                     self.progress_bar.pause()
+                                # apply any queued auto tune settings before the new iterator
+                                self.dataloader_monitor.on_new_epoch()
                                 dataloader_iterator = iter(dataloader)
                                 trigger_dataloader_setup_epoch(dataloader)
                                 self.epoch_num += 1
@@ -2260,7 +2435,7 @@ class BaseSDTrainProcess(BaseTrainProcess):
                                     self.grad_accumulation_step = 0
                                     print_verbose(verbose, f"    Gradient accumulation triggered by epoch end")
                             with self.timer('get_batch'):
-                                batch = next(dataloader_iterator)
+                                batch = self.dataloader_monitor.get_batch(dataloader_iterator)
                             if self.progress_bar is not None:
                                 self.progress_bar.unpause()
                             print_verbose(verbose, f"    Training batch loaded after reset")
@@ -2335,6 +2510,15 @@ class BaseSDTrainProcess(BaseTrainProcess):
                 print("\n==== Profile Results ====")
                 print(self.torch_profiler.key_averages().table(sort_by="cpu_time_total", row_limit=1000))
             self.timer.stop('train_loop')
+            if self.sample_worker is not None:
+                # log any samples the worker finished
+                self.sample_worker.poll()
+            if self.dataloader_monitor is not None:
+                # setting changes are queued and applied at the next epoch boundary
+                self.dataloader_monitor.end_step(self.step_num)
+                if len(self.dataloader_monitor.decisions) > 0:
+                    # keep the tuning decisions with the run so they end up in the saved metadata
+                    self.meta['dataloader_tuning'] = list(self.dataloader_monitor.decisions)
             if not did_first_flush:
                 print_verbose(verbose, f"  First flush after training start")
                 flush()
@@ -2468,6 +2652,8 @@ class BaseSDTrainProcess(BaseTrainProcess):
                         # print the timers and clear them
                         self.timer.print()
                         self.timer.reset()
+                        if self.profiler is not None and self.accelerator.is_main_process:
+                            self.logger.log(self.profiler.get_summary())
                         if self.progress_bar is not None:
                             self.progress_bar.unpause()
                 
@@ -2487,6 +2673,8 @@ class BaseSDTrainProcess(BaseTrainProcess):
                 # update various steps
                 self.step_num = step + 1
                 self.grad_accumulation_step += 1
+                if self.profiler is not None:
+                    self.profiler.step(self.step_num)
                 self.end_step_hook()
 
 
@@ -2502,9 +2690,20 @@ class BaseSDTrainProcess(BaseTrainProcess):
             self.sample(self.step_num)
             self.logger.commit(step=self.step_num)
         print_acc("")
+        if self.sample_worker is not None:
+            self.sample_worker.shutdown()
+            self.sample_worker = None
+        if self.sample_writer is not None:
+            self.sample_writer.shutdown()
         if self.accelerator.is_main_process:
             self.save()
+            if self.profiler is not None:
+                self.profiler.save(os.path.join(self.save_root, 'profile.npy'))
+                if self.logging_config.profile_chrome_trace:
+                    self.profiler.export_chrome_trace(os.path.join(self.save_root, 'profile_trace.json'))
             self.logger.finish()
+        if self.profiler is not None:
+            self.profiler.deactivate()
         self.accelerator.end_training()
 
         if self.accelerator.is_main_process:
@@ -2552,7 +2751,7 @@ class BaseSDTrainProcess(BaseTrainProcess):
         api.upload_folder(
             repo_id=repo_id,
             folder_path=self.save_root,
-            ignore_patterns=["*.yaml", "*.pt"],
+            ignore_patterns=["*.yaml", "*.pt", f"{SHARDED_OPTIMIZER_DIRNAME}/*", "_prompt_embeds_cache/*", "_sample_worker/*"],
             repo_type="model",
         )
 
@@ -33,6 +33,8 @@ class ExtractLoconProcess(BaseExtractProcess):
         self.use_sparse_bias = self.get_conf('use_sparse_bias', False)
         self.sparsity = self.get_conf('sparsity', 0.98)
         self.disable_cp = self.get_conf('disable_cp', False)
+        if self.job.stream_safetensors:
+            raise ValueError("stream_safetensors is only supported by lora extraction")
 
         # set modes
         if self.mode not in list(mode_dict.keys()):
@@ -1,5 +1,5 @@
 from collections import OrderedDict
-from toolkit.lycoris_utils import extract_diff
+from toolkit.lycoris_utils import extract_diff, extract_diff_from_safetensors
 from .BaseExtractProcess import BaseExtractProcess
 
 
@@ -44,10 +44,40 @@ class ExtractLoraProcess(BaseExtractProcess):
         self.conv_param = self.get_conf('conv', mode_dict[self.mode]['conv'], as_type=mode_dict[self.mode]['type'])
         self.use_sparse_bias = self.get_conf('use_sparse_bias', False)
         self.sparsity = self.get_conf('sparsity', 0.98)
+        # full or randomized. randomized finds only the top singular vectors and decomposes same shaped
+        # layers in batches, much faster for a small rank. only used with mode fixed
+        self.svd_method = self.get_conf('svd_method', 'full')
+        # extra random vectors over the rank, more is more accurate
+        self.svd_oversample = self.get_conf('svd_oversample', 8, as_type=int)
+        # power iterations, more is more accurate when the singular values decay slowly
+        self.svd_power_iters = self.get_conf('svd_power_iters', 2, as_type=int)
+        # number of same shaped layers decomposed at once
+        self.svd_batch_size = self.get_conf('svd_batch_size', 8, as_type=int)
+        # prefix of the lora keys when streaming from safetensors
+        self.lora_prefix = self.get_conf('lora_prefix', 'transformer')
+        if self.job.stream_safetensors and self.mode != 'fixed':
+            raise ValueError("stream_safetensors only supports mode fixed")
 
     def run(self):
         super().run()
-        print(f"Running process: {self.mode}, dim: {self.dim}")
+        print(f"Running process: {self.mode}, linear: {self.linear_param}")
+
+        if self.job.stream_safetensors:
+            state_dict, extract_diff_meta = extract_diff_from_safetensors(
+                self.job.base_model_path,
+                self.job.extract_model_path,
+                self.linear_param,
+                prefix=self.lora_prefix,
+                extract_device=self.job.device,
+                svd_oversample=self.svd_oversample,
+                svd_power_iters=self.svd_power_iters,
+                svd_batch_size=self.svd_batch_size,
+                use_bias=self.use_sparse_bias,
+                sparsity=self.sparsity,
+            )
+            self.add_meta(extract_diff_meta)
+            self.save(state_dict)
+            return
 
         state_dict, extract_diff_meta = extract_diff(
             self.job.model_base,
@@ -61,7 +91,11 @@ class ExtractLoraProcess(BaseExtractProcess):
             small_conv=False,
             linear_only=self.conv_param > 0.0000000001,
             extract_unet=self.extract_unet,
-            extract_text_encoder=self.extract_text_encoder
+            extract_text_encoder=self.extract_text_encoder,
+            svd_method=self.svd_method,
+            svd_oversample=self.svd_oversample,
+            svd_power_iters=self.svd_power_iters,
+            svd_batch_size=self.svd_batch_size,
         )
 
         self.add_meta(extract_diff_meta)
@@ -69,5 +103,5 @@ class ExtractLoraProcess(BaseExtractProcess):
 
     def get_output_path(self, prefix=None, suffix=None):
         if suffix is None:
-            suffix = f"_{self.dim}"
+            suffix = f"_{self.linear_param}"
         return super().get_output_path(prefix, suffix)
@@ -0,0 +1,98 @@
+import argparse
+import os
+import sys
+import time
+
+import torch
+import torch.nn as nn
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from toolkit.memory_management import MemoryManager
+
+# times a training step through a stack of transformer sized mlp blocks with layer offloading
+# at different layer_offloading_transformer_percent and prefetch settings
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--num_blocks', type=int, default=24)
+parser.add_argument('--dim', type=int, default=3072)
+parser.add_argument('--tokens', type=int, default=4096)
+parser.add_argument('--percents', type=str, default='0.0,0.25,0.5,0.75,1.0')
+parser.add_argument('--prefetch_layers', type=str, default='0,2,4')
+parser.add_argument('--prefetch_budget_gb', type=float, default=1.0)
+parser.add_argument('--steps', type=int, default=10)
+parser.add_argument('--warmup', type=int, default=3)
+parser.add_argument('--dtype', type=str, default='bf16')
+args = parser.parse_args()
+
+if not torch.cuda.is_available():
+    raise RuntimeError("This benchmark needs a cuda device")
+
+device = torch.device('cuda')
+dtype = {'bf16': torch.bfloat16, 'fp16': torch.float16, 'fp32': torch.float32}[args.dtype]
+
+
+class Block(nn.Module):
+    def __init__(self, dim):
+        super().__init__()
+        self.norm = nn.LayerNorm(dim)
+        self.fc1 = nn.Linear(dim, dim * 4)
+        self.act = nn.GELU()
+        self.fc2 = nn.Linear(dim * 4, dim)
+
+    def forward(self, x):
+        return x + self.fc2(self.act(self.fc1(self.norm(x))))
+
+
+def build_model():
+    model = nn.Sequential(*[Block(args.dim) for _ in range(args.num_blocks)]).to(dtype)
+    # frozen base weights, like when training a lora
+    model.requires_grad_(False)
+    return model
+
+
+def run(percent, prefetch_layers):
+    model = build_model()
+    if percent > 0:
+        MemoryManager.attach(
+            model,
+            device,
+            offload_percent=percent,
+            prefetch_layers=prefetch_layers,
+            prefetch_budget_bytes=int(args.prefetch_budget_gb * 1024 ** 3),
+        )
+    model.to(device)
+
+    x = torch.randn(1, args.tokens, args.dim, device=device, dtype=dtype, requires_grad=True)
+    times = []
+    for step in range(args.warmup + args.steps):
+        torch.cuda.synchronize()
+        start = time.perf_counter()
+        out = model(x)
+        out.float().pow(2).mean().backward()
+        torch.cuda.synchronize()
+        if step >= args.warmup:
+            times.append(time.perf_counter() - start)
+        x.grad = None
+
+    peak = torch.cuda.max_memory_allocated() / 1024 ** 3
+    transfer = 0.0
+    if hasattr(model, '_memory_manager'):
+        transfer = model._memory_manager.plan.transfer_bytes_per_step() / 1024 ** 3
+    del model, x
+    torch.cuda.empty_cache()
+    torch.cuda.reset_peak_memory_stats()
+    return sum(times) / len(times), peak, transfer
+
+
+percents = [float(p) for p in args.percents.split(',')]
+prefetch_layers_list = [int(p) for p in args.prefetch_layers.split(',')]
+
+print(f"{args.num_blocks} blocks, dim {args.dim}, {args.tokens} tokens, {args.dtype}")
+print(f"{'percent':>8} {'prefetch':>8} {'step ms':>10} {'peak GB':>8} {'xfer GB':>8}")
+for percent in percents:
+    for prefetch_layers in prefetch_layers_list:
+        if percent == 0 and prefetch_layers > 0:
+            # nothing is offloaded, nothing to prefetch
+            continue
+        step_time, peak, transfer = run(percent, prefetch_layers)
+        print(f"{percent:>8.2f} {prefetch_layers:>8d} {step_time * 1000:>10.1f} {peak:>8.2f} {transfer:>8.2f}")
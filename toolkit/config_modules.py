@@ -15,6 +15,7 @@ SaveFormat = Literal['safetensors', 'diffusers']
 if TYPE_CHECKING:
     from toolkit.guidance import GuidanceType
     from toolkit.logging_aitk import EmptyLogger
+    from toolkit.sample_writer import SampleWriter
 else:
     EmptyLogger = None
 
@@ -29,6 +30,18 @@ class SaveConfig:
         self.push_to_hub: bool = kwargs.get("push_to_hub", False)
         self.hf_repo_id: Optional[str] = kwargs.get("hf_repo_id", None)
         self.hf_private: Optional[str] = kwargs.get("hf_private", False)
+        # pt saves the optimizer as a single optimizer.pt file. sharded saves per param group
+        # safetensors shards with an index, written atomically and loaded shard by shard on resume
+        self.optimizer_format: str = kwargs.get('optimizer_format', 'pt')
+        if self.optimizer_format not in ['pt', 'sharded']:
+            raise ValueError(f"optimizer_format must be pt or sharded, got {self.optimizer_format}")
+        # delta checkpoints save a full network every delta_full_every saves and only the compressed
+        # change since the previous save in between. Only applies to network (LoRA, LoKr, etc) saves
+        self.delta_checkpoints: bool = kwargs.get('delta_checkpoints', False)
+        self.delta_full_every: int = kwargs.get('delta_full_every', 10)
+        self.delta_format: str = kwargs.get('delta_format', 'int8')
+        if self.delta_format not in ['int8', 'sparse']:
+            raise ValueError(f"delta_format must be int8 or sparse, got {self.delta_format}")
 
 class LoggingConfig:
     def __init__(self, **kwargs):
@@ -36,8 +49,19 @@ class LoggingConfig:
         self.verbose: bool = kwargs.get('verbose', False)
         self.use_wandb: bool = kwargs.get('use_wandb', False)
         self.use_ui_logger: bool = kwargs.get('use_ui_logger', False)
+        # step buckets the ui logger keeps min/max/mean/last for, charts read these on long runs
+        self.ui_logger_rollup_resolutions: List[int] = kwargs.get('ui_logger_rollup_resolutions', [10, 100, 1000])
+        # drop raw numeric log rows older than this many steps, the rollups keep them. None keeps all
+        self.ui_logger_retain_raw_steps: Optional[int] = kwargs.get('ui_logger_retain_raw_steps', None)
         self.project_name: str = kwargs.get('project_name', 'ai-toolkit')
         self.run_name: str = kwargs.get('run_name', None)
+        # step profiler. Records cpu/device time per timer section, transfers, dataloader waits and
+        # optionally host syncs into a ring buffer. Summaries go to the logger every performance_log_every
+        self.profile: bool = kwargs.get('profile', False)
+        self.profile_buffer_size: int = kwargs.get('profile_buffer_size', 65536)
+        self.profile_device_time: bool = kwargs.get('profile_device_time', True)
+        self.profile_count_syncs: bool = kwargs.get('profile_count_syncs', False)
+        self.profile_chrome_trace: bool = kwargs.get('profile_chrome_trace', False)
 
 class SampleItem:
     def __init__(
@@ -94,6 +118,15 @@ class SampleConfig:
         self.extra_values = kwargs.get('extra_values', [])
         self.num_frames = kwargs.get('num_frames', 1)
         self.fps: int = kwargs.get('fps', 16)
+        # samples that share resolution, steps, guidance and network multiplier are generated together
+        # in batches of this size on models that support it. Seeds are kept per sample
+        self.batch_size: int = kwargs.get('batch_size', 1)
+        # threads used to encode and write the sample files in the background. 0 (default) writes them in the sampling loop
+        self.write_workers: int = kwargs.get('write_workers', 0)
+        # generate samples in a separate process with its own copy of the base model so training does not
+        # stop for them. Only for lora / lycoris training. worker_device defaults to the second gpu, or cpu
+        self.worker: bool = kwargs.get('worker', False)
+        self.worker_device: Optional[str] = kwargs.get('worker_device', None)
         if self.num_frames > 1 and self.ext not in ['webp']:
             print("Changing sample extention to animated webp")
             self.ext = 'webp'
@@ -219,6 +252,18 @@ class NetworkConfig:
         # start from a pretrained lora
         self.pretrained_lora_path = kwargs.get('pretrained_lora_path', None)
 
+        # merge into quantized (quanto) weights for sampling by quantizing the merged weight again.
+        # faster sampling, but the merged weights are slightly off from the unmerged forward and it
+        # needs room for a second copy of the quantized weights while sampling
+        self.merge_quantized = kwargs.get('merge_quantized', False)
+        # keep a pinned cpu copy of each dense weight merged for sampling and copy it back afterwards, so
+        # the restore is bit exact. The copy is reused, so it holds host ram for the merged weights. Set to
+        # False to subtract the delta again instead, which drifts low precision weights a little every sample
+        self.exact_merge_restore = kwargs.get('exact_merge_restore', True)
+        # save which modules get a lora, keyed by the model architecture and the module rules, so
+        # later runs (resumes, sampling) build the network without scanning the whole model again
+        self.cache_module_plan = kwargs.get('cache_module_plan', False)
+
 
 AdapterTypes = Literal['t2i', 'ip', 'ip+', 'clip', 'ilora', 'photo_maker', 'control_net', 'control_lora', 'i2v']
 
@@ -525,10 +570,18 @@ class TrainConfig:
         self.unload_text_encoder = kwargs.get('unload_text_encoder', False)
         # will toggle all datasets to cache text embeddings
         self.cache_text_embeddings: bool = kwargs.get('cache_text_embeddings', False)
+        # keeps the embeds for sample prompts, blank and trigger prompts on disk when the text encoder is unloaded
+        # so restarts do not have to encode them again. Off by default. The cache dir defaults to a folder in the training folder
+        self.prompt_embeds_cache: bool = kwargs.get('prompt_embeds_cache', False)
+        self.prompt_embeds_cache_dir: Optional[str] = kwargs.get('prompt_embeds_cache_dir', None)
         # for swapping which parameters are trained during training
         self.do_paramiter_swapping = kwargs.get('do_paramiter_swapping', False)
         # 0.1 is 10% of the parameters active at a time lower is less vram, higher is more
         self.paramiter_swapping_factor = kwargs.get('paramiter_swapping_factor', 0.1)
+        # tunes num_workers and prefetch_factor during the first auto_tune_dataloader_steps steps if the
+        # training loop is waiting on the dataloader. Stalls are always reported, this only adds tuning
+        self.auto_tune_dataloader: bool = kwargs.get('auto_tune_dataloader', False)
+        self.auto_tune_dataloader_steps: int = kwargs.get('auto_tune_dataloader_steps', 100)
         # bypass the guidance embedding for training. For open flux with guidance embedding
         self.bypass_guidance_embedding = kwargs.get('bypass_guidance_embedding', False)
         
@@ -636,6 +689,15 @@ class ModelConfig:
         self.ignore_if_contains: Optional[List[str]] = kwargs.get("ignore_if_contains", None)
         self.only_if_contains: Optional[List[str]] = kwargs.get("only_if_contains", None)
         self.quantize_kwargs = kwargs.get("quantize_kwargs", {})
+        # save the quantized transformer to disk the first time so later runs load it directly instead of
+        # loading full precision weights and quantizing them again. only supported by some models, and only
+        # for quanto qtypes. torchao qtypes are always quantized on load
+        self.quantized_cache = kwargs.get("quantized_cache", False)
+        # defaults to a folder in MODELS_PATH so it is shared between jobs
+        self.quantized_cache_dir = kwargs.get("quantized_cache_dir", None)
+        # load the transformer one block at a time from the checkpoint and quantize each block before
+        # loading the next, so the full precision model is never in ram at once. only supported by some models
+        self.quantize_streaming = kwargs.get("quantize_streaming", False)
         
         # splits the model over the available gpus WIP
         self.split_model_over_gpus = kwargs.get("split_model_over_gpus", False)
@@ -661,9 +723,30 @@ class ModelConfig:
         # verbose logging flag for detailed output
         self.verbose = kwargs.get("verbose", False)
         
-        # 0 is off and 1.0 is 100% of the layers
+        # 0 is off and 1.0 is 100% of the layer weights. this is a fraction of the weight bytes, not of the
+        # number of layers. layers that do the most compute per byte are offloaded first since their
+        # transfers are easiest to hide, size breaks ties
         self.layer_offloading_transformer_percent = kwargs.get("layer_offloading_transformer_percent", 1.0)
         self.layer_offloading_text_encoder_percent = kwargs.get("layer_offloading_text_encoder_percent", 1.0)
+        # keep this many GB of transformer layer weights on the gpu and offload the rest.
+        # overrides layer_offloading_transformer_percent
+        self.layer_offloading_transformer_vram_budget_gb = kwargs.get("layer_offloading_transformer_vram_budget_gb", None)
+        # folder on a fast local disk (nvme) to keep offloaded transformer weights in, memory mapped,
+        # instead of pinned ram. the weights are frozen, so it cannot be used for full fine tuning
+        self.layer_offloading_disk_dir = kwargs.get("layer_offloading_disk_dir", None)
+        # pinned ram used to stage weights read from disk before they go to the gpu, in GB
+        self.layer_offloading_disk_staging_gb = kwargs.get("layer_offloading_disk_staging_gb", 4.0)
+        # how many layers ahead of the current one to read from disk
+        self.layer_offloading_disk_prefetch = kwargs.get("layer_offloading_disk_prefetch", 4)
+        # once the layer order is known, copy the weights of this many upcoming layers to the gpu
+        # while the current one computes. 0 keeps the plain ping-pong transfer
+        self.layer_offloading_prefetch_layers = kwargs.get("layer_offloading_prefetch_layers", 0)
+        # max gpu memory the prefetched weights can take up, in GB
+        self.layer_offloading_prefetch_budget_gb = kwargs.get("layer_offloading_prefetch_budget_gb", 1.0)
+
+        # while sampling, run loras stacked on the same layer (the trained network and an inference or
+        # assistant lora) as one wider lora instead of one after the other
+        self.fuse_sampling_loras = kwargs.get("fuse_sampling_loras", False)
 
         # can be used to load the extras like text encoder or vae from here
         # only setup for some models but will prevent having to download the te for
@@ -1049,6 +1132,7 @@ class GenerateImageConfig:
             fps: int = 15,
             ctrl_idx: int = 0,
             do_cfg_norm: bool = False,
+            sample_writer: Optional['SampleWriter'] = None,  # writes the files in the background if set
     ):
         self.width: int = width
         self.height: int = height
@@ -1088,6 +1172,7 @@ class GenerateImageConfig:
         self.ctrl_img_1 = ctrl_img_1
         self.ctrl_img_2 = ctrl_img_2
         self.ctrl_img_3 = ctrl_img_3
+        self.sample_writer = sample_writer
 
         # prompt string will override any settings above
         self._process_prompt_string()
@@ -1156,6 +1241,15 @@ class GenerateImageConfig:
         # make parent dirs
         os.makedirs(self.output_folder, exist_ok=True)
         self.set_gen_time()
+        if self.sample_writer is None:
+            self._write_image(image, count, max_count)
+            return
+        if isinstance(image, torch.Tensor):
+            # audio, get it off the gpu now so the writer does not hold on to vram
+            image = image.to('cpu')
+        self.sample_writer.submit(self._write_image, image, count, max_count)
+
+    def _write_image(self, image, count: int = 0, max_count=0):
         if isinstance(image, list):
             # video
             if self.num_frames == 1:
@@ -0,0 +1,184 @@
+import os
+import time
+from collections import deque
+from typing import List, Optional
+
+from torch.utils.data import DataLoader
+
+from toolkit.print import print_acc
+
+
+class DataloaderStallMonitor:
+    """
+    Measures how long the training loop waits in next(dataloader_iterator) against how long the
+    step takes to compute, and warns when the GPU is being starved. If auto_tune is set, it will
+    also raise num_workers / prefetch_factor during the first auto_tune_steps steps, keeping
+    changes only if they actually reduce the stall. Changes are queued and only applied at the next
+    epoch boundary (see on_new_epoch), so the current shuffled epoch is never cut short.
+    Decisions are kept in self.decisions so they can be stored in the run metadata.
+    """
+
+    def __init__(
+            self,
+            dataloader: DataLoader,
+            window: int = 20,
+            stall_threshold: float = 0.1,
+            auto_tune: bool = False,
+            auto_tune_steps: int = 100,
+            max_workers: Optional[int] = None,
+            max_prefetch_factor: int = 8,
+    ):
+        self.dataloader = dataloader
+        self.window = window
+        self.stall_threshold = stall_threshold
+        self.auto_tune = auto_tune and dataloader.num_workers > 0
+        self.auto_tune_steps = auto_tune_steps
+        self.max_workers = max_workers if max_workers is not None else max(1, (os.cpu_count() or 1) - 1)
+        self.max_prefetch_factor = max_prefetch_factor
+
+        self.wait_times = deque(maxlen=window)
+        self.compute_times = deque(maxlen=window)
+        self._wait_this_step = 0.0
+        self._step_start: Optional[float] = None
+        self.num_steps = 0
+        self._last_warning_step = -1
+
+        self.decisions: List[dict] = []
+        # setting and stall ratio we go back to if a change does not help
+        self._previous_setting: Optional[tuple] = None
+        self._previous_stall: Optional[float] = None
+        self._tuning_done = not self.auto_tune
+        self._steps_since_change = 0
+        # (num_workers, prefetch_factor) waiting for the next epoch
+        self._pending_setting: Optional[tuple] = None
+
+    @property
+    def stall_ratio(self) -> float:
+        total = sum(self.wait_times) + sum(self.compute_times)
+        if total <= 0:
+            return 0.0
+        return sum(self.wait_times) / total
+
+    def get_batch(self, dataloader_iterator):
+        # drop in for next(dataloader_iterator) that records the wait
+        start = time.perf_counter()
+        try:
+            return next(dataloader_iterator)
+        finally:
+            self._wait_this_step += time.perf_counter() - start
+
+    def start_step(self):
+        self._step_start = time.perf_counter()
+        self._wait_this_step = 0.0
+
+    def end_step(self, step: int) -> bool:
+        """
+        Call at the end of each training step. Returns True if new dataloader settings were queued,
+        they get applied by on_new_epoch right before the next iterator is created.
+        """
+        if self._step_start is None:
+            return False
+        step_time = time.perf_counter() - self._step_start
+        self._step_start = None
+        self.wait_times.append(self._wait_this_step)
+        self.compute_times.append(max(step_time - self._wait_this_step, 0.0))
+        self.num_steps += 1
+        self._steps_since_change += 1
+
+        if self._pending_setting is not None:
+            # nothing to judge until the queued change is actually in use
+            return False
+
+        if len(self.wait_times) < self.window or self._steps_since_change < self.window:
+            return False
+
+        stall = self.stall_ratio
+        if not self._tuning_done:
+            return self._tune(step, stall)
+
+        if stall > self.stall_threshold and step - self._last_warning_step >= self.window * 10:
+            self._last_warning_step = step
+            print_acc(
+                f"\nDataloader is stalling training, waiting {stall * 100:.1f}% of the step time "
+                f"(num_workers={self.dataloader.num_workers}, prefetch_factor={self.dataloader.prefetch_factor}). "
+                f"Consider raising num_workers or prefetch_factor, or enable auto_tune_dataloader."
+            )
+        return False
+
+    def _record(self, step: int, stall: float, action: str):
+        num_workers, prefetch_factor = self._pending_setting or (
+            self.dataloader.num_workers, self.dataloader.prefetch_factor
+        )
+        decision = {
+            'step': step,
+            'action': action,
+            'stall_ratio': round(stall, 4),
+            'num_workers': num_workers,
+            'prefetch_factor': prefetch_factor,
+        }
+        self.decisions.append(decision)
+        print_acc(
+            f"\nDataloader auto tune at step {step}: {action} "
+            f"(stall={stall * 100:.1f}%, num_workers={decision['num_workers']}, "
+            f"prefetch_factor={decision['prefetch_factor']})"
+        )
+
+    def on_new_epoch(self):
+        # call right before iter(dataloader) at an epoch boundary. DataLoader allows changing these
+        # after init and they take effect on the next iter()
+        if self._pending_setting is None:
+            return
+        num_workers, prefetch_factor = self._pending_setting
+        self._pending_setting = None
+        self.dataloader.num_workers = num_workers
+        self.dataloader.prefetch_factor = prefetch_factor
+        self.wait_times.clear()
+        self.compute_times.clear()
+        self._steps_since_change = 0
+
+    def _apply(self, num_workers: int, prefetch_factor: Optional[int]):
+        # prefetch_factor has to be None without workers and set with them or iter() raises
+        if num_workers == 0:
+            prefetch_factor = None
+        elif prefetch_factor is None:
+            prefetch_factor = 2
+        self._pending_setting = (num_workers, prefetch_factor)
+
+    def _tune(self, step: int, stall: float) -> bool:
+        current = (self.dataloader.num_workers, self.dataloader.prefetch_factor)
+
+        if self._previous_stall is not None and stall > self._previous_stall * 0.9:
+            # last change did not help enough, go back and stop
+            self._apply(*self._previous_setting)
+            self._tuning_done = True
+            self._record(step, stall, "reverted, last change did not reduce stall")
+            return True
+
+        if stall <= self.stall_threshold or self.num_steps >= self.auto_tune_steps:
+            self._tuning_done = True
+            self._record(step, stall, "done")
+            return False
+
+        num_workers, prefetch_factor = current
+        if num_workers == 0:
+            # workers are forced off (native windows), there is nothing to tune
+            self._tuning_done = True
+            self._record(step, stall, "num_workers is 0, not tuning")
+            return False
+        if prefetch_factor is None:
+            # torch default when workers are used
+            prefetch_factor = 2
+        if num_workers < self.max_workers:
+            num_workers = min(self.max_workers, num_workers + max(1, num_workers // 2))
+        elif prefetch_factor < self.max_prefetch_factor:
+            prefetch_factor += 1
+        else:
+            self._tuning_done = True
+            self._record(step, stall, "at limits, stopping")
+            return False
+
+        self._previous_setting = current
+        self._previous_stall = stall
+        self._apply(num_workers, prefetch_factor)
+        self._record(step, stall, "increased")
+        return True
@@ -0,0 +1,136 @@
+import os
+from collections import OrderedDict
+from typing import Literal, Optional, Tuple
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import load_file
+
+# delta checkpoints only store the change since the previous save. They are chained back to a
+# normal full save through the aitk_delta_parent metadata entry and reconstructed on load.
+DELTA_CHECKPOINT_SUFFIX = '.delta.safetensors'
+DELTA_PARENT_META_KEY = 'aitk_delta_parent'
+DELTA_FORMAT_META_KEY = 'aitk_delta_format'
+
+DeltaFormat = Literal['int8', 'sparse']
+
+
+def is_delta_checkpoint(file_path: str) -> bool:
+    return file_path.endswith(DELTA_CHECKPOINT_SUFFIX)
+
+
+def get_delta_parent_path(file_path: str) -> Optional[str]:
+    with safe_open(file_path, framework="pt") as f:
+        metadata = f.metadata()
+    if metadata is None or DELTA_PARENT_META_KEY not in metadata:
+        return None
+    return os.path.join(os.path.dirname(file_path), metadata[DELTA_PARENT_META_KEY])
+
+
+def _quantize_delta(key: str, delta: torch.Tensor, delta_dict: OrderedDict) -> torch.Tensor:
+    # int8 with a scale per output row, returns what the loader will add back
+    if delta.dim() > 1:
+        abs_max = delta.abs().flatten(1).amax(dim=1).view(-1, *([1] * (delta.dim() - 1)))
+    else:
+        abs_max = delta.abs().amax()
+    scale = (abs_max / 127.0).clamp(min=1e-12)
+    quantized = torch.clamp(torch.round(delta / scale), -127, 127).to(torch.int8)
+    delta_dict[f"{key}.delta_q"] = quantized
+    delta_dict[f"{key}.delta_scale"] = scale.to(torch.float32)
+    return quantized.to(torch.float32) * scale
+
+
+def _sparsify_delta(
+        key: str,
+        delta: torch.Tensor,
+        delta_dict: OrderedDict,
+        value_dtype: torch.dtype,
+        threshold: float
+) -> torch.Tensor:
+    # keep only entries that moved more than threshold * the largest change in the tensor
+    flat_delta = delta.flatten()
+    indices = torch.nonzero(flat_delta.abs() > flat_delta.abs().amax() * threshold).flatten()
+    values = flat_delta[indices].to(value_dtype)
+    delta_dict[f"{key}.delta_idx"] = indices.to(torch.int64)
+    delta_dict[f"{key}.delta_val"] = values
+    applied = torch.zeros_like(flat_delta)
+    applied[indices] = values.to(torch.float32)
+    return applied.view_as(delta)
+
+
+def make_delta_state_dict(
+        state_dict: OrderedDict,
+        parent_state_dict: OrderedDict,
+        delta_format: DeltaFormat = 'int8',
+        sparse_threshold: float = 0.01,
+) -> Tuple[OrderedDict, OrderedDict]:
+    """
+    Builds the compressed delta of state_dict against parent_state_dict. Returns the delta state dict
+    to save and the state dict a loader will reconstruct from it. The next delta should be taken
+    against the reconstructed one, so compression error is carried forward instead of accumulating.
+    """
+    if set(state_dict.keys()) != set(parent_state_dict.keys()):
+        raise ValueError("Cannot make a delta checkpoint, the keys differ from the parent")
+    delta_dict = OrderedDict()
+    reconstructed = OrderedDict()
+    for key, value in state_dict.items():
+        value = value.detach().to('cpu')
+        parent_value = parent_state_dict[key]
+        if value.shape != parent_value.shape or value.dtype != parent_value.dtype:
+            raise ValueError(f"Cannot make a delta checkpoint, {key} changed shape or dtype")
+        if not value.is_floating_point():
+            # nothing to compress, store it as is
+            delta_dict[f"{key}.delta_full"] = value.clone()
+            reconstructed[key] = value.clone()
+            continue
+        delta = value.to(torch.float32) - parent_value.to(torch.float32)
+        if not torch.any(delta != 0):
+            # unchanged tensors are left out completely
+            reconstructed[key] = parent_value
+            continue
+        if delta_format == 'int8':
+            applied = _quantize_delta(key, delta, delta_dict)
+        elif delta_format == 'sparse':
+            applied = _sparsify_delta(key, delta, delta_dict, value.dtype, sparse_threshold)
+        else:
+            raise ValueError(f"Unknown delta format {delta_format}")
+        reconstructed[key] = (parent_value.to(torch.float32) + applied).to(parent_value.dtype)
+    return delta_dict, reconstructed
+
+
+def apply_delta_state_dict(parent_state_dict: OrderedDict, delta_dict: OrderedDict) -> OrderedDict:
+    state_dict = OrderedDict()
+    for key, parent_value in parent_state_dict.items():
+        if f"{key}.delta_full" in delta_dict:
+            state_dict[key] = delta_dict[f"{key}.delta_full"]
+        elif f"{key}.delta_q" in delta_dict:
+            applied = delta_dict[f"{key}.delta_q"].to(torch.float32) * delta_dict[f"{key}.delta_scale"]
+            state_dict[key] = (parent_value.to(torch.float32) + applied).to(parent_value.dtype)
+        elif f"{key}.delta_idx" in delta_dict:
+            flat_delta = torch.zeros(parent_value.numel(), dtype=torch.float32)
+            flat_delta[delta_dict[f"{key}.delta_idx"]] = delta_dict[f"{key}.delta_val"].to(torch.float32)
+            state_dict[key] = (parent_value.to(torch.float32) + flat_delta.view_as(parent_value)).to(parent_value.dtype)
+        else:
+            state_dict[key] = parent_value
+    return state_dict
+
+
+def load_delta_checkpoint(file_path: str) -> OrderedDict:
+    # walk back to the full save, then replay the deltas forward
+    chain = [file_path]
+    current = file_path
+    while is_delta_checkpoint(current):
+        parent = get_delta_parent_path(current)
+        if parent is None:
+            raise ValueError(f"Delta checkpoint {current} has no parent")
+        if not os.path.exists(parent):
+            raise FileNotFoundError(f"Missing parent checkpoint {parent} needed to load {file_path}")
+        if parent in chain:
+            raise ValueError(f"Delta checkpoint chain for {file_path} has a cycle")
+        chain.append(parent)
+        current = parent
+
+    state_dict = load_file(chain[-1])
+    for delta_path in reversed(chain[:-1]):
+        state_dict = apply_delta_state_dict(state_dict, load_file(delta_path))
+    return state_dict
@@ -46,6 +46,9 @@ def hacked_state_dict(self, *args, **kwargs):
 
 # hacks the state dict so we can dequantize before saving
 def patch_dequantization_on_save(model):
+    if hasattr(model, "orig_state_dict"):
+        # already patched, patching again would make it call itself
+        return
     model.orig_state_dict = model.state_dict
     model.state_dict = partial(hacked_state_dict, model)
   
@@ -1,9 +1,6 @@
-import os
-import importlib
-import pkgutil
-from typing import List
+from typing import List, Optional
 
-from toolkit.paths import TOOLKIT_ROOT
+from toolkit.util.extension_registry import get_all_registered_extensions, get_registered_extension
 
 
 class Extension(object):
@@ -25,33 +22,22 @@ class Extension(object):
 
 
 def get_all_extensions() -> List[Extension]:
-    extension_folders = ['extensions', 'extensions_built_in']
-
-    # This will hold the classes from all extension modules
-    all_extension_classes: List[Extension] = []
-
-    # Iterate over all directories (i.e., packages) in the "extensions" directory
-    for sub_dir in extension_folders:
-        extensions_dir = os.path.join(TOOLKIT_ROOT, sub_dir)
-        for (_, name, _) in pkgutil.iter_modules([extensions_dir]):
-            # try:
-                # Import the module
-                module = importlib.import_module(f"{sub_dir}.{name}")
-                # Get the value of the AI_TOOLKIT_EXTENSIONS variable
-                extensions = getattr(module, "AI_TOOLKIT_EXTENSIONS", None)
-                # Check if the value is a list
-                if isinstance(extensions, list):
-                    # Iterate over the list and add the classes to the main list
-                    all_extension_classes.extend(extensions)
-            # except ImportError as e:
-            #     print(f"Failed to import the {name} module. Error: {str(e)}")
-
-    return all_extension_classes
+    # every extension class, from the cached registry
+    return get_all_registered_extensions()
 
 
-def get_all_extensions_process_dict():
-    all_extensions = get_all_extensions()
+def get_extensions_process_dict(uids: Optional[List[str]] = None):
+    # process classes by uid. with uids, only those extensions and their processes are imported
+    if uids is None:
+        extensions = get_all_extensions()
+    else:
+        extensions = [get_registered_extension(uid) for uid in uids]
     process_dict = {}
-    for extension in all_extensions:
-        process_dict[extension.uid] = extension.get_process()
+    for extension in extensions:
+        if extension is not None:
+            process_dict[extension.uid] = extension.get_process()
     return process_dict
+
+
+def get_all_extensions_process_dict():
+    return get_extensions_process_dict()
@@ -0,0 +1,176 @@
+from typing import TYPE_CHECKING, List, Optional
+
+import torch
+import torch.nn.functional as F
+from optimum.quanto import QTensor
+
+if TYPE_CHECKING:
+    from toolkit.lora_special import LoRAModule
+    from toolkit.network_mixins import Network
+
+
+def _get_lora_module(forward) -> Optional['LoRAModule']:
+    # the lora module a forward belongs to, if it is one of ours
+    module = getattr(forward, '__self__', None)
+    if module is None or not hasattr(module, 'network_ref') or not hasattr(module, 'org_forward'):
+        return None
+    return module
+
+
+def _can_fuse(module: 'LoRAModule') -> bool:
+    # plain low rank loras only. dora, lokr, full rank and lorm have their own forward
+    if module.__class__.__name__ != 'LoRAModule' or module.full_rank:
+        return False
+    if module.network_ref().is_lorm or getattr(module, 'lora_mid', None) is not None:
+        return False
+    if getattr(module.lora_up, 'bias', None) is not None:
+        return False
+    return module.lora_down.__class__.__name__ in ['Linear', 'Conv2d']
+
+
+def _get_layout(module: 'LoRAModule') -> tuple:
+    # loras can only be concatenated if they run the same op on the same device
+    down = module.lora_down
+    return (
+        down.weight.device,
+        getattr(down, 'kernel_size', None),
+        getattr(down, 'stride', None),
+        getattr(down, 'padding', None),
+        getattr(down, 'dilation', None),
+    )
+
+
+class FusedLoRAForward:
+    """
+    Runs every lora stacked on one layer as a single lora. The down and up projections of all of
+    them are concatenated along the rank, and each adapter's scale and multiplier are applied to
+    its slice of the rank, so N loras cost one down and one up matmul. The multipliers and
+    is_active of the networks are read on every call, so adapters can be turned on and off or
+    reweighted without rebuilding. Falls back to the normal chained forward while training.
+    """
+
+    def __init__(self, org_module: torch.nn.Module, lora_modules: List['LoRAModule']):
+        # lora_modules are in the order they were applied, the last one is the outermost forward
+        self.org_module = org_module
+        self.lora_modules = lora_modules
+        self.top_forward = org_module.forward
+        self.base_forward = lora_modules[0].org_forward
+        self.is_conv = lora_modules[0].lora_down.__class__.__name__ == 'Conv2d'
+        self.ranks = [m.lora_dim for m in lora_modules]
+        self._key = None
+        self.down_weight: Optional[torch.Tensor] = None
+        self.up_weight: Optional[torch.Tensor] = None
+
+    def _get_weights(self):
+        # rebuild the concatenated weights if any adapter was updated or moved (load_weights, force_to)
+        key = tuple(
+            (id(w), w._version, w.device, w.dtype)
+            for m in self.lora_modules
+            for w in (m.lora_down.weight, m.lora_up.weight)
+        )
+        if key != self._key:
+            dtype = self.lora_modules[0].lora_down.weight.dtype
+            for m in self.lora_modules[1:]:
+                dtype = torch.promote_types(dtype, m.lora_down.weight.dtype)
+            device = self.lora_modules[0].lora_down.weight.device
+            with torch.no_grad():
+                self.down_weight = torch.cat(
+                    [m.lora_down.weight.to(device, dtype=dtype) for m in self.lora_modules], dim=0
+                )
+                self.up_weight = torch.cat(
+                    [m.lora_up.weight.to(device, dtype=dtype) for m in self.lora_modules], dim=1
+                )
+            self._key = key
+        return self.down_weight, self.up_weight
+
+    def _get_coefficients(self, batch_size: int, device) -> Optional[torch.Tensor]:
+        # [batch, total rank] with scale * multiplier of each adapter on its slice, None if all are off
+        columns = []
+        any_active = False
+        for module, rank in zip(self.lora_modules, self.ranks):
+            network = module.network_ref()
+            if (
+                not network.is_active
+                or network._multiplier == 0
+                or (network.is_merged_in and module.is_weight_merged)
+            ):
+                columns.append(torch.zeros(batch_size, rank, device=device))
+                continue
+            any_active = True
+            multiplier = network.torch_multiplier.to(device, dtype=torch.float32)
+            if multiplier.size(0) != batch_size:
+                multiplier = multiplier.repeat_interleave(batch_size // multiplier.size(0))
+            coefficient = multiplier * module.scale * module.scalar.to(device, dtype=torch.float32)
+            columns.append(coefficient.view(-1, 1).expand(batch_size, rank))
+        if not any_active:
+            return None
+        return torch.cat(columns, dim=1)
+
+    def forward(self, x, *args, **kwargs):
+        if args or kwargs or any(m.training for m in self.lora_modules):
+            return self.top_forward(x, *args, **kwargs)
+
+        org_forwarded = self.base_forward(x)
+        if isinstance(x, QTensor):
+            x = x.dequantize()
+        down_weight, up_weight = self._get_weights()
+        coefficients = self._get_coefficients(x.size(0), down_weight.device)
+        if coefficients is None:
+            return org_forwarded
+
+        lora_input = x.to(down_weight.dtype)
+        if self.is_conv:
+            down = self.lora_modules[0].lora_down
+            lx = F.conv2d(lora_input, down_weight, None, down.stride, down.padding, down.dilation)
+            lx = lx * coefficients.to(lx.dtype).view(*coefficients.shape, 1, 1)
+            lora_output = F.conv2d(lx, up_weight)
+        else:
+            lx = F.linear(lora_input, down_weight)
+            coefficients = coefficients.view(coefficients.size(0), *[1] * (lx.dim() - 2), -1)
+            lora_output = F.linear(lx * coefficients.to(lx.dtype), up_weight)
+        return org_forwarded + lora_output.to(org_forwarded.dtype)
+
+    def fuse(self):
+        self.org_module.forward = self.forward
+
+    def unfuse(self):
+        self.org_module.forward = self.top_forward
+
+
+def fuse_lora_networks(networks: List['Network']) -> List[FusedLoRAForward]:
+    """
+    Fuses every layer that has a lora from more than one of the given networks applied to it.
+    Returns the fused layers, pass them to unfuse_lora_networks to go back to the chained forwards.
+    """
+    network_ids = set(id(n) for n in networks)
+    fused = []
+    seen = set()
+    for network in networks:
+        for lora_module in network.get_all_modules():
+            org_module = lora_module.org_module[0]
+            if id(org_module) in seen:
+                continue
+            seen.add(id(org_module))
+            # walk the chain of forwards from the outermost one down to the layer itself
+            chain = []
+            module = _get_lora_module(org_module.forward)
+            while module is not None:
+                chain.append(module)
+                module = _get_lora_module(module.org_forward)
+            chain.reverse()
+            if len(chain) < 2:
+                continue
+            if any(id(m.network_ref()) not in network_ids or not _can_fuse(m) for m in chain):
+                continue
+            if len(set(_get_layout(m) for m in chain)) > 1:
+                continue
+            fused_forward = FusedLoRAForward(org_module, chain)
+            fused_forward.fuse()
+            fused.append(fused_forward)
+    return fused
+
+
+def unfuse_lora_networks(fused: List[FusedLoRAForward]):
+    # in reverse, so the outermost forward is restored last
+    for fused_forward in reversed(fused):
+        fused_forward.unfuse()
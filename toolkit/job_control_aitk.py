@@ -0,0 +1,175 @@
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional
+
+
+class UIJobControl:
+    """
+    Owns one long lived connection to the ui database for a running job, on its own thread. The
+    stop and return_to_queue flags are only re-read when PRAGMA data_version says another connection
+    (the ui) committed something, and status / progress writes are collected and written in one
+    transaction every flush_interval, so the training loop never touches the database itself.
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        job_id: str,
+        poll_interval: float = 0.5,
+        flush_interval: float = 1.0,
+        can_write: bool = True,
+    ):
+        self.db_path = db_path
+        self.job_id = job_id
+        self.poll_interval = poll_interval
+        self.flush_interval = flush_interval
+        # only the main process writes, every process reads the flags
+        self.can_write = can_write
+
+        self._stop = False
+        self._return_to_queue = False
+        self._data_version: Optional[int] = None
+
+        # latest value of every column waiting to be written
+        self._pending: Dict[str, Any] = {}
+        self._cond = threading.Condition()
+        self._flush_requested = 0
+        self._flushed = 0
+        self._closing = False
+        self._ready = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        # flags are read once before returning so the first check is never stale
+        self._ready.wait(timeout=30.0)
+
+    def should_stop(self) -> bool:
+        return self._stop
+
+    def should_return_to_queue(self) -> bool:
+        return self._return_to_queue
+
+    def update(self, **columns):
+        # queues the columns, a later value for the same column replaces the earlier one
+        if not self.can_write:
+            return
+        with self._cond:
+            self._pending.update(columns)
+
+    def flush(self, timeout: float = 30.0):
+        # writes everything queued now and waits for it
+        if self._thread is None or not self._thread.is_alive():
+            return
+        with self._cond:
+            self._flush_requested += 1
+            target = self._flush_requested
+            self._cond.notify_all()
+            end_time = time.monotonic() + timeout
+            while self._flushed < target and self._thread.is_alive():
+                remaining = end_time - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(min(remaining, 0.1))
+
+    def close(self):
+        if self._thread is None:
+            return
+        self.flush()
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        self._thread.join(timeout=30.0)
+        self._thread = None
+
+    def _connect(self) -> sqlite3.Connection:
+        # autocommit, we open the write transactions ourselves
+        con = sqlite3.connect(self.db_path, timeout=10.0, isolation_level=None)
+        con.execute("PRAGMA busy_timeout=10000;")
+        return con
+
+    def _poll(self, con: sqlite3.Connection):
+        # data_version only changes when a different connection commits, so our own writes
+        # and an idle ui cost one pragma and no reads of the job table
+        version = con.execute("PRAGMA data_version;").fetchone()[0]
+        if version == self._data_version:
+            return
+        row = con.execute(
+            "SELECT stop, return_to_queue FROM Job WHERE id = ?", (self.job_id,)
+        ).fetchone()
+        self._data_version = version
+        if row is None:
+            self._stop = False
+            self._return_to_queue = False
+        else:
+            self._stop = row[0] == 1
+            self._return_to_queue = row[1] == 1
+
+    def _flush(self, con: sqlite3.Connection):
+        with self._cond:
+            pending, self._pending = self._pending, {}
+        if len(pending) == 0:
+            return
+        # column names only ever come from the trainer, values are parameters
+        columns = list(pending.keys())
+        set_sql = ", ".join(f"{column} = ?" for column in columns)
+        try:
+            con.execute("BEGIN IMMEDIATE")
+            con.execute(
+                f"UPDATE Job SET {set_sql} WHERE id = ?",
+                (*[pending[c] for c in columns], self.job_id),
+            )
+            con.execute("COMMIT")
+        except Exception:
+            with self._cond:
+                # keep anything that was not replaced in the meantime for the next flush
+                for column, value in pending.items():
+                    self._pending.setdefault(column, value)
+            # BEGIN can fail on a locked db, then there is no transaction to roll back
+            if con.in_transaction:
+                try:
+                    con.execute("ROLLBACK")
+                except sqlite3.Error:
+                    pass
+            raise
+
+    def _run(self):
+        con = None
+        try:
+            con = self._connect()
+            self._poll(con)
+        except Exception as e:
+            print(f"Error reading job {self.job_id} from {self.db_path}: {e}")
+        finally:
+            self._ready.set()
+
+        last_flush = time.monotonic()
+        while True:
+            with self._cond:
+                if not self._closing and self._flush_requested == self._flushed:
+                    self._cond.wait(self.poll_interval)
+                closing = self._closing
+                flush_requested = self._flush_requested
+            try:
+                if con is None:
+                    con = self._connect()
+                now = time.monotonic()
+                if closing or flush_requested != self._flushed or now - last_flush >= self.flush_interval:
+                    self._flush(con)
+                    last_flush = now
+                self._poll(con)
+            except Exception as e:
+                print(f"Error updating job {self.job_id} in {self.db_path}: {e}")
+            with self._cond:
+                # mark requests as handled even on an error so flush never hangs
+                self._flushed = flush_requested
+                self._cond.notify_all()
+            if closing:
+                break
+
+        if con is not None:
+            con.close()
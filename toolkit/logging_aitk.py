@@ -2,11 +2,15 @@ from typing import OrderedDict, Optional
 from PIL import Image
 
 from toolkit.config_modules import LoggingConfig
+import math
 import os
 import sqlite3
 import time
 from typing import Any, Dict, Tuple, List
 
+# buckets of steps the ui logger keeps min/max/mean/last for, so charts never read every raw row
+DEFAULT_ROLLUP_RESOLUTIONS = [10, 100, 1000]
+
 
 # Base logger class
 # This class does nothing, it's just a placeholder
@@ -89,6 +93,9 @@ class UILogger:
         log_file: str,
         flush_every_n: int = 256,
         flush_every_secs: float = 0.25,
+        rollup_resolutions: Optional[List[int]] = None,
+        retain_raw_steps: Optional[int] = None,
+        compact_every_secs: float = 60.0,
     ) -> None:
         self.log_file = log_file
         self._log_to_commit: Dict[str, Any] = {}
@@ -109,6 +116,20 @@ class UILogger:
         self._flush_every_secs = float(flush_every_secs)
         self._last_flush = time.time()
 
+        # rollups
+        if rollup_resolutions is None:
+            rollup_resolutions = DEFAULT_ROLLUP_RESOLUTIONS
+        self._rollup_resolutions = sorted(set(int(r) for r in rollup_resolutions if int(r) > 1))
+        # last step written per key, a step at or before it is a rewrite and its buckets are rebuilt
+        self._key_last_step: Dict[str, int] = {}
+
+        # retention, raw numeric rows older than this many steps are dropped, the rollups stay
+        if retain_raw_steps is not None and len(self._rollup_resolutions) == 0:
+            raise ValueError("retain_raw_steps needs rollup_resolutions, old values would be lost")
+        self._retain_raw_steps = retain_raw_steps
+        self._compact_every_secs = float(compact_every_secs)
+        self._last_compact = time.time()
+
     # start logging the training
     def start(self):
         if self._started:
@@ -119,6 +140,8 @@ class UILogger:
             os.makedirs(parent, exist_ok=True)
 
         self._con = sqlite3.connect(self.log_file, timeout=30.0, isolation_level=None)
+        # only takes effect on a new file, lets compaction give space back to the os
+        self._con.execute("PRAGMA auto_vacuum=INCREMENTAL;")
         self._con.execute("PRAGMA journal_mode=WAL;")
         self._con.execute("PRAGMA synchronous=NORMAL;")
         self._con.execute("PRAGMA temp_store=MEMORY;")
@@ -127,6 +150,17 @@ class UILogger:
 
         self._init_schema(self._con)
 
+        # logs written before rollups existed, or with other resolutions, only have raw rows
+        if self._rollup_resolutions:
+            self._backfill_rollups(self._con)
+
+        # when resuming, steps already in the file count as written
+        self._key_last_step = {
+            k: hi for k, hi in self._con.execute(
+                "SELECT key, last_seen_step FROM metric_keys;"
+            ) if hi is not None
+        }
+
         self._started = True
         self._last_flush = time.time()
 
@@ -190,6 +224,15 @@ class UILogger:
         # this doesnt log images for now
         pass
 
+    # chart ready series of a metric, see query_metric_series
+    def query_series(self, key: str, **kwargs) -> Dict[str, Any]:
+        if not self._started:
+            self.start()
+        self._flush()
+        return _query_metric_series(
+            self._con, key, resolutions=self._rollup_resolutions, **kwargs
+        )
+
     # finish logging
     def finish(self):
         if not self._started:
@@ -239,6 +282,23 @@ class UILogger:
             "CREATE INDEX IF NOT EXISTS idx_metrics_key_step ON metrics (key, step);"
         )
 
+        # one row per key, resolution and bucket of resolution steps (bucket = step // resolution)
+        con.execute("""
+            CREATE TABLE IF NOT EXISTS metric_rollups (
+                key            TEXT NOT NULL,
+                resolution     INTEGER NOT NULL,
+                bucket         INTEGER NOT NULL,
+                count          INTEGER NOT NULL,
+                value_min      REAL,
+                value_max      REAL,
+                value_sum      REAL,
+                value_last     REAL,
+                last_step      INTEGER NOT NULL,
+                last_wall_time REAL,
+                PRIMARY KEY (key, resolution, bucket)
+            );
+        """)
+
         con.execute("COMMIT;")
 
     def _coerce_value(self, v: Any) -> Tuple[Optional[float], Optional[str]]:
@@ -289,13 +349,290 @@ class UILogger:
                 self._pending_metrics,
             )
 
+        # rollups, in the same transaction so they always match the raw rows
+        if self._pending_metrics and self._rollup_resolutions:
+            self._update_rollups(con)
+
         con.execute("COMMIT;")
 
+        for k, (lo, hi) in self._pending_key_minmax.items():
+            if hi > self._key_last_step.get(k, -1):
+                self._key_last_step[k] = hi
+
         self._pending_steps.clear()
         self._pending_metrics.clear()
         self._pending_key_minmax.clear()
         self._last_flush = time.time()
 
+        if (
+            self._retain_raw_steps is not None
+            and (self._last_flush - self._last_compact) >= self._compact_every_secs
+        ):
+            self._compact()
+
+    def _update_rollups(self, con: sqlite3.Connection) -> None:
+        wall_times = dict(self._pending_steps)
+        # the same step can be committed twice before a flush, the last value is the one stored
+        values: Dict[Tuple[int, str], float] = {}
+        for step, k, vr, _ in self._pending_metrics:
+            values[(step, k)] = vr
+
+        merged: Dict[Tuple[str, int, int], List[Any]] = {}
+        rebuild = set()
+        for (step, k), vr in values.items():
+            is_rewrite = step <= self._key_last_step.get(k, -1)
+            for resolution in self._rollup_resolutions:
+                bucket_id = (k, resolution, step // resolution)
+                if is_rewrite:
+                    # the old value is already counted in the bucket, so it is rebuilt from the raw rows
+                    rebuild.add(bucket_id)
+                # nan is stored as null and inf would poison the mean
+                elif vr is not None and math.isfinite(vr):
+                    _merge_rollup(merged, bucket_id, step, vr, wall_times.get(step))
+
+        # rebuilt buckets already include the new rows
+        for bucket_id in rebuild:
+            merged.pop(bucket_id, None)
+
+        if merged:
+            con.executemany(
+                "INSERT INTO metric_rollups(key, resolution, bucket, count, value_min, value_max, "
+                "value_sum, value_last, last_step, last_wall_time) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(key, resolution, bucket) DO UPDATE SET "
+                "count=metric_rollups.count + excluded.count, "
+                "value_min=MIN(metric_rollups.value_min, excluded.value_min), "
+                "value_max=MAX(metric_rollups.value_max, excluded.value_max), "
+                "value_sum=metric_rollups.value_sum + excluded.value_sum, "
+                "value_last=CASE WHEN excluded.last_step >= metric_rollups.last_step "
+                "THEN excluded.value_last ELSE metric_rollups.value_last END, "
+                "last_wall_time=CASE WHEN excluded.last_step >= metric_rollups.last_step "
+                "THEN excluded.last_wall_time ELSE metric_rollups.last_wall_time END, "
+                "last_step=MAX(metric_rollups.last_step, excluded.last_step);",
+                [(*bucket_id, *agg) for bucket_id, agg in merged.items()],
+            )
+
+        # only exact while the raw rows of the bucket are kept, see retain_raw_steps
+        for k, resolution, bucket in rebuild:
+            rebuilt: Dict[Tuple[str, int, int], List[Any]] = {}
+            rows = con.execute(
+                "SELECT m.step, m.value_real, s.wall_time FROM metrics m "
+                "LEFT JOIN steps s ON s.step = m.step "
+                "WHERE m.key = ? AND m.step >= ? AND m.step < ? AND m.value_real IS NOT NULL "
+                "ORDER BY m.step ASC;",
+                (k, bucket * resolution, (bucket + 1) * resolution),
+            )
+            for step, vr, wall_time in rows:
+                if math.isfinite(vr):
+                    _merge_rollup(rebuilt, (k, resolution, bucket), step, vr, wall_time)
+            con.execute(
+                "DELETE FROM metric_rollups WHERE key = ? AND resolution = ? AND bucket = ?;",
+                (k, resolution, bucket),
+            )
+            if rebuilt:
+                con.execute(
+                    "INSERT INTO metric_rollups(key, resolution, bucket, count, value_min, value_max, "
+                    "value_sum, value_last, last_step, last_wall_time) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?);",
+                    (k, resolution, bucket, *rebuilt[(k, resolution, bucket)]),
+                )
+
+    def _backfill_rollups(self, con: sqlite3.Connection) -> None:
+        # builds rollups from raw rows not counted in them yet, so compaction never drops history
+        # that only exists as raw rows. rows up to the first rolled up bucket of each resolution are
+        # read, and a bucket is replaced when the raw rows hold more values than it does
+        keys = [k for (k,) in con.execute("SELECT key FROM metric_keys;")]
+        con.execute("BEGIN;")
+        for k in keys:
+            end = None
+            for resolution in self._rollup_resolutions:
+                first_bucket = con.execute(
+                    "SELECT MIN(bucket) FROM metric_rollups WHERE key = ? AND resolution = ?;",
+                    (k, resolution),
+                ).fetchone()[0]
+                if first_bucket is None:
+                    end = None
+                    break
+                end = max(end or 0, (first_bucket + 1) * resolution)
+
+            query = (
+                "SELECT m.step, m.value_real, s.wall_time FROM metrics m "
+                "LEFT JOIN steps s ON s.step = m.step "
+                "WHERE m.key = ? AND m.value_real IS NOT NULL"
+            )
+            params: Tuple[Any, ...] = (k,)
+            if end is not None:
+                query += " AND m.step < ?"
+                params = (k, end)
+            rebuilt: Dict[Tuple[str, int, int], List[Any]] = {}
+            for step, vr, wall_time in con.execute(query + ";", params):
+                if math.isfinite(vr):
+                    for resolution in self._rollup_resolutions:
+                        _merge_rollup(rebuilt, (k, resolution, step // resolution), step, vr, wall_time)
+
+            for bucket_id, agg in rebuilt.items():
+                row = con.execute(
+                    "SELECT count FROM metric_rollups WHERE key = ? AND resolution = ? AND bucket = ?;",
+                    bucket_id,
+                ).fetchone()
+                # a bucket whose raw rows were partly compacted already counts more than the raw rows
+                if row is not None and row[0] >= agg[0]:
+                    continue
+                con.execute(
+                    "INSERT OR REPLACE INTO metric_rollups(key, resolution, bucket, count, value_min, "
+                    "value_max, value_sum, value_last, last_step, last_wall_time) "
+                    "VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?);",
+                    (*bucket_id, *agg),
+                )
+        con.execute("COMMIT;")
+
+    def _compact(self) -> None:
+        assert self._con is not None
+        con = self._con
+        self._last_compact = time.time()
+
+        cutoff = self._step_counter - self._retain_raw_steps
+        if cutoff <= 0:
+            return
+
+        con.execute("BEGIN;")
+        # numeric values live on in the rollups, text values are kept
+        con.execute(
+            "DELETE FROM metrics WHERE step < ? AND value_real IS NOT NULL;", (cutoff,)
+        )
+        con.execute(
+            "DELETE FROM steps WHERE step < ? "
+            "AND NOT EXISTS (SELECT 1 FROM metrics m WHERE m.step = steps.step);",
+            (cutoff,),
+        )
+        con.execute("COMMIT;")
+        con.execute("PRAGMA incremental_vacuum;")
+
+
+def _merge_rollup(
+    merged: Dict[Tuple[str, int, int], List[Any]],
+    bucket_id: Tuple[str, int, int],
+    step: int,
+    value: float,
+    wall_time: Optional[float],
+) -> None:
+    # [count, min, max, sum, last, last_step, last_wall_time]
+    agg = merged.get(bucket_id)
+    if agg is None:
+        merged[bucket_id] = [1, value, value, value, value, step, wall_time]
+        return
+    agg[0] += 1
+    agg[1] = min(agg[1], value)
+    agg[2] = max(agg[2], value)
+    agg[3] += value
+    if step >= agg[5]:
+        agg[4] = value
+        agg[5] = step
+        agg[6] = wall_time
+
+
+def _query_metric_series(
+    con: sqlite3.Connection,
+    key: str,
+    max_points: int = 2000,
+    start_step: Optional[int] = None,
+    end_step: Optional[int] = None,
+    resolutions: Optional[List[int]] = None,
+) -> Dict[str, Any]:
+    if resolutions is None:
+        resolutions = DEFAULT_ROLLUP_RESOLUTIONS
+    max_points = max(1, int(max_points))
+
+    row = con.execute(
+        "SELECT first_seen_step, last_seen_step FROM metric_keys WHERE key = ?;", (key,)
+    ).fetchone()
+    if row is None or row[0] is None:
+        return {"key": key, "resolution": 1, "points": []}
+    lo = row[0] if start_step is None else max(int(start_step), row[0])
+    hi = row[1] if end_step is None else min(int(end_step), row[1])
+    if hi < lo:
+        return {"key": key, "resolution": 1, "points": []}
+    span = hi - lo + 1
+
+    # raw rows before the oldest one left were compacted away
+    raw_min = con.execute("SELECT MIN(step) FROM metrics WHERE key = ?;", (key,)).fetchone()[0]
+    has_raw = raw_min is not None and raw_min <= lo
+
+    resolution = None
+    if not (has_raw and span <= max_points):
+        available = [
+            r for r in sorted(int(r) for r in resolutions)
+            if con.execute(
+                "SELECT 1 FROM metric_rollups WHERE key = ? AND resolution = ? LIMIT 1;", (key, r)
+            ).fetchone() is not None
+        ]
+        for r in available:
+            if span / r <= max_points:
+                resolution = r
+                break
+        if resolution is None and len(available) > 0:
+            resolution = available[-1]
+
+    if resolution is None:
+        # no rollups to use, thin the raw rows instead
+        stride = max(1, math.ceil(span / max_points))
+        rows = con.execute(
+            "SELECT m.step, s.wall_time, m.value_real, m.value_text FROM metrics m "
+            "LEFT JOIN steps s ON s.step = m.step "
+            "WHERE m.key = ? AND m.step >= ? AND m.step <= ? AND (m.step % ?) = 0 "
+            "ORDER BY m.step ASC;",
+            (key, lo, hi, stride),
+        )
+        points = []
+        for step, wall_time, vr, vt in rows:
+            if vr is None and vt is not None:
+                try:
+                    vr = float(vt)
+                except ValueError:
+                    pass
+            points.append({
+                "step": step, "wall_time": wall_time, "value": vr,
+                "min": vr, "max": vr, "last": vr, "count": 1,
+            })
+        return {"key": key, "resolution": stride, "points": points}
+
+    rows = con.execute(
+        "SELECT bucket, count, value_min, value_max, value_sum, value_last, last_wall_time "
+        "FROM metric_rollups WHERE key = ? AND resolution = ? AND bucket >= ? AND bucket <= ? "
+        "ORDER BY bucket ASC;",
+        (key, resolution, lo // resolution, hi // resolution),
+    )
+    points = [
+        {
+            "step": bucket * resolution, "wall_time": wall_time, "value": vsum / count,
+            "min": vmin, "max": vmax, "last": vlast, "count": count,
+        }
+        for bucket, count, vmin, vmax, vsum, vlast, wall_time in rows
+    ]
+    return {"key": key, "resolution": resolution, "points": points}
+
+
+def query_metric_series(
+    log_file: str,
+    key: str,
+    max_points: int = 2000,
+    start_step: Optional[int] = None,
+    end_step: Optional[int] = None,
+    resolutions: Optional[List[int]] = None,
+) -> Dict[str, Any]:
+    """
+    Returns {"key", "resolution", "points"} for a metric in a ui logger file with at most about
+    max_points points. Each point has step, wall_time, value (the mean), min, max, last and count.
+    Uses the raw rows when they fit, otherwise the finest rollup that does.
+    """
+    con = sqlite3.connect(f"file:{log_file}?mode=ro", uri=True, timeout=30.0)
+    try:
+        con.execute("PRAGMA busy_timeout=30000;")
+        return _query_metric_series(
+            con, key, max_points=max_points, start_step=start_step, end_step=end_step,
+            resolutions=resolutions,
+        )
+    finally:
+        con.close()
+
 
 # create logger based on the logging config
 def create_logger(
@@ -311,6 +648,10 @@ def create_logger(
         if save_root is None:
             raise ValueError("save_root must be provided when using UILogger")
         log_file = os.path.join(save_root, "loss_log.db")
-        return UILogger(log_file=log_file)
+        return UILogger(
+            log_file=log_file,
+            rollup_resolutions=logging_config.ui_logger_rollup_resolutions,
+            retain_raw_steps=logging_config.ui_logger_retain_raw_steps,
+        )
     else:
         return EmptyLogger()
@@ -12,7 +12,8 @@ from transformers import CLIPTextModel
 from toolkit.models.lokr import LokrModule
 
 from .config_modules import NetworkConfig
-from .lorm import count_parameters
+from .network_module_plan import ModuleSelectionRules, get_lora_names, get_module_plan
+from .paths import MODELS_PATH
 from .network_mixins import ToolkitNetworkMixin, ToolkitModuleMixin, ExtractableModuleMixin
 
 from toolkit.kohya_lora import LoRANetwork
@@ -331,137 +332,113 @@ class LoRASpecialNetwork(ToolkitNetworkMixin, LoRANetwork):
                     else (self.LORA_PREFIX_TEXT_ENCODER1 if text_encoder_idx == 1 else self.LORA_PREFIX_TEXT_ENCODER2)
                 )
             )
+            # compile the name rules once instead of checking every word on every child
+            required_groups = []
+            if self.transformer_only and is_unet:
+                transformer_block_names = None
+                if base_model is not None:
+                    transformer_block_names = base_model.get_transformer_block_names()
+
+                if transformer_block_names is not None:
+                    required_groups.append(transformer_block_names)
+                else:
+                    if self.is_pixart or self.is_flux or self.is_v3:
+                        required_groups.append(["transformer_blocks"])
+                    if self.is_lumina2:
+                        required_groups.append(["layers$$", "noise_refiner$$", "context_refiner$$"])
+
+                    # handle custom models
+                    if hasattr(root_module, 'transformer_blocks'):
+                        required_groups.append(["transformer_blocks"])
+                    if hasattr(root_module, 'blocks'):
+                        required_groups.append(["blocks"])
+                    if hasattr(root_module, 'single_blocks'):
+                        required_groups.append(["single_blocks", "double_blocks"])
+            rules = ModuleSelectionRules(
+                ignore_if_contains=self.ignore_if_contains,
+                only_if_contains=self.only_if_contains,
+                required_groups=required_groups,
+                parameter_threshold=parameter_threshold,
+            )
+            module_plan_cache_dir = None
+            if self.network_config is not None and self.network_config.cache_module_plan:
+                module_plan_cache_dir = os.path.join(MODELS_PATH, "_network_module_plan_cache")
+            module_plan = get_module_plan(
+                root_module,
+                target_replace_modules,
+                LINEAR_MODULES + CONV_MODULES,
+                prefix,
+                self.peft_format,
+                rules,
+                cache_dir=module_plan_cache_dir,
+            )
+
             loras = []
             skipped = []
-            attached_modules = []
             lora_shape_dict = {}
-            for name, module in root_module.named_modules():
-                if module.__class__.__name__ in target_replace_modules:
-                    for child_name, child_module in module.named_modules():
-                        is_linear = child_module.__class__.__name__ in LINEAR_MODULES
-                        is_conv2d = child_module.__class__.__name__ in CONV_MODULES
-                        is_conv2d_1x1 = is_conv2d and child_module.kernel_size == (1, 1)
-
-
-                        lora_name = [prefix, name, child_name]
-                        # filter out blank
-                        lora_name = [x for x in lora_name if x and x != ""]
-                        lora_name = ".".join(lora_name)
-                        # if it doesnt have a name, it wil have two dots
-                        lora_name.replace("..", ".")
-                        clean_name = lora_name
-                        if self.peft_format:
-                            # we replace this on saving
-                            lora_name = lora_name.replace(".", "$$")
-                        else:
-                            lora_name = lora_name.replace(".", "_")
-
-                        skip = False
-                        if any([word in clean_name for word in self.ignore_if_contains]):
-                            skip = True
-
-                        # see if it is over threshold
-                        if count_parameters(child_module) < parameter_threshold:
-                            skip = True
-                        
-                        if self.transformer_only and is_unet:
-                            transformer_block_names = None
-                            if base_model is not None:
-                                transformer_block_names = base_model.get_transformer_block_names()
-                            
-                            if transformer_block_names is not None:
-                                if not any([name in lora_name for name in transformer_block_names]):
-                                    skip = True
-                            else:
-                                if self.is_pixart:
-                                    if "transformer_blocks" not in lora_name:
-                                        skip = True
-                                if self.is_flux:
-                                    if "transformer_blocks" not in lora_name:
-                                        skip = True
-                                if self.is_lumina2:
-                                    if "layers$$" not in lora_name and "noise_refiner$$" not in lora_name and "context_refiner$$" not in lora_name:
-                                        skip = True
-                                if  self.is_v3:
-                                    if "transformer_blocks" not in lora_name:
-                                        skip = True
-                                
-                                # handle custom models
-                                if hasattr(root_module, 'transformer_blocks'):
-                                    if "transformer_blocks" not in lora_name:
-                                        skip = True
-                                        
-                                if hasattr(root_module, 'blocks'):
-                                    if "blocks" not in lora_name:
-                                        skip = True
-                                
-                                if hasattr(root_module, 'single_blocks'):
-                                    if "single_blocks" not in lora_name and "double_blocks" not in lora_name:
-                                        skip = True
-
-                        if (is_linear or is_conv2d) and not skip:
-
-                            if self.only_if_contains is not None:
-                                if not any([word in clean_name for word in self.only_if_contains]) and not any([word in lora_name for word in self.only_if_contains]):
-                                    continue
-
-                            dim = None
-                            alpha = None
-
-                            if modules_dim is not None:
-                                # モジュール指定あり
-                                if lora_name in modules_dim:
-                                    dim = modules_dim[lora_name]
-                                    alpha = modules_alpha[lora_name]
-                            else:
-                                # 通常、すべて対象とする
-                                if is_linear or is_conv2d_1x1:
-                                    dim = self.lora_dim
-                                    alpha = self.alpha
-                                elif self.conv_lora_dim is not None:
-                                    dim = self.conv_lora_dim
-                                    alpha = self.conv_alpha
-
-                            if dim is None or dim == 0:
-                                # skipした情報を出力
-                                if is_linear or is_conv2d_1x1 or (
-                                        self.conv_lora_dim is not None or conv_block_dims is not None):
-                                    skipped.append(lora_name)
-                                continue
-                            
-                            module_kwargs = {}
-                            
-                            if self.network_type.lower() == "lokr":
-                                module_kwargs["factor"] = self.network_config.lokr_factor
-                            
-                            if self.is_ara:
-                                module_kwargs["is_ara"] = True
-
-                            lora = module_class(
-                                lora_name,
-                                child_module,
-                                self.multiplier,
-                                dim,
-                                alpha,
-                                dropout=dropout,
-                                rank_dropout=rank_dropout,
-                                module_dropout=module_dropout,
-                                network=self,
-                                parent=module,
-                                use_bias=use_bias,
-                                **module_kwargs
-                            )
-                            loras.append(lora)
-                            if self.network_type.lower() == "lokr":
-                                try:
-                                    lora_shape_dict[lora_name] = [list(lora.lokr_w1.weight.shape), list(lora.lokr_w2.weight.shape)]
-                                except:
-                                    pass
-                            else:
-                                if self.full_rank:
-                                    lora_shape_dict[lora_name] = [list(lora.lora_down.weight.shape)]
-                                else:
-                                    lora_shape_dict[lora_name] = [list(lora.lora_down.weight.shape), list(lora.lora_up.weight.shape)]
+            for name, module, child_name, child_module in module_plan:
+                is_linear = child_module.__class__.__name__ in LINEAR_MODULES
+                is_conv2d = child_module.__class__.__name__ in CONV_MODULES
+                is_conv2d_1x1 = is_conv2d and child_module.kernel_size == (1, 1)
+                lora_name, _ = get_lora_names(prefix, name, child_name, self.peft_format)
+
+                dim = None
+                alpha = None
+
+                if modules_dim is not None:
+                    # モジュール指定あり
+                    if lora_name in modules_dim:
+                        dim = modules_dim[lora_name]
+                        alpha = modules_alpha[lora_name]
+                else:
+                    # 通常、すべて対象とする
+                    if is_linear or is_conv2d_1x1:
+                        dim = self.lora_dim
+                        alpha = self.alpha
+                    elif self.conv_lora_dim is not None:
+                        dim = self.conv_lora_dim
+                        alpha = self.conv_alpha
+
+                if dim is None or dim == 0:
+                    # skipした情報を出力
+                    if is_linear or is_conv2d_1x1 or (
+                            self.conv_lora_dim is not None or conv_block_dims is not None):
+                        skipped.append(lora_name)
+                    continue
+
+                module_kwargs = {}
+
+                if self.network_type.lower() == "lokr":
+                    module_kwargs["factor"] = self.network_config.lokr_factor
+
+                if self.is_ara:
+                    module_kwargs["is_ara"] = True
+
+                lora = module_class(
+                    lora_name,
+                    child_module,
+                    self.multiplier,
+                    dim,
+                    alpha,
+                    dropout=dropout,
+                    rank_dropout=rank_dropout,
+                    module_dropout=module_dropout,
+                    network=self,
+                    parent=module,
+                    use_bias=use_bias,
+                    **module_kwargs
+                )
+                loras.append(lora)
+                if self.network_type.lower() == "lokr":
+                    try:
+                        lora_shape_dict[lora_name] = [list(lora.lokr_w1.weight.shape), list(lora.lokr_w2.weight.shape)]
+                    except:
+                        pass
+                else:
+                    if self.full_rank:
+                        lora_shape_dict[lora_name] = [list(lora.lora_down.weight.shape)]
+                    else:
+                        lora_shape_dict[lora_name] = [list(lora.lora_down.weight.shape), list(lora.lora_up.weight.shape)]
             return loras, skipped
 
         text_encoders = text_encoder if type(text_encoder) == list else [text_encoder]
@@ -2,6 +2,9 @@
 
 from typing import *
 
+import glob
+import os
+
 import numpy as np
 
 import torch
@@ -22,18 +25,33 @@ def make_sparse(t: torch.Tensor, sparsity=0.95):
     return sparse_t
 
 
-def extract_conv(
-        weight: Union[torch.Tensor, nn.Parameter],
-        mode='fixed',
-        mode_param=0,
-        device='cpu',
-        is_cp=False,
-) -> Tuple[nn.Parameter, nn.Parameter]:
-    weight = weight.to(device)
-    out_ch, in_ch, kernel_size, _ = weight.shape
+def randomized_svd(
+        weight: torch.Tensor,
+        rank: int,
+        oversample: int = 8,
+        power_iters: int = 2,
+        generator: Optional[torch.Generator] = None,
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    # top rank singular vectors of weight [..., m, n] with a randomized range finder (Halko et al.).
+    # a batch of same shaped matrices is decomposed at once. cost is O(m * n * (rank + oversample))
+    # per power iteration instead of a full svd. more power iterations sharpen a flat spectrum
+    m, n = weight.shape[-2:]
+    sketch_size = min(rank + oversample, m, n)
+    weight_t = weight.transpose(-2, -1)
+    omega = torch.randn(
+        (*weight.shape[:-2], n, sketch_size), generator=generator, device=weight.device, dtype=weight.dtype
+    )
+    Q, _ = linalg.qr(weight @ omega)
+    for _ in range(power_iters):
+        # re-orthonormalize every half step so small singular values are not lost to rounding
+        Z, _ = linalg.qr(weight_t @ Q)
+        Q, _ = linalg.qr(weight @ Z)
+    U_small, S, Vh = linalg.svd(Q.transpose(-2, -1) @ weight, full_matrices=False)
+    U = Q @ U_small
+    return U[..., :rank], S[..., :rank], Vh[..., :rank, :]
 
-    U, S, Vh = linalg.svd(weight.reshape(out_ch, -1))
 
+def get_lora_rank(S: torch.Tensor, mode='fixed', mode_param=0):
     if mode == 'fixed':
         lora_rank = mode_param
     elif mode == 'threshold':
@@ -50,6 +68,42 @@ def extract_conv(
         lora_rank = torch.sum(s_cum < min_cum_sum)
     else:
         raise NotImplementedError('Extract mode should be "fixed", "threshold", "ratio" or "quantile"')
+    return lora_rank
+
+
+def _get_svd(weight: torch.Tensor, mode, mode_param, max_rank, svd_method='full', oversample=8, power_iters=2):
+    # the randomized svd only finds the top singular values, so it needs the rank up front
+    if svd_method == 'randomized' and mode == 'fixed':
+        lora_rank = min(max_rank, max(1, mode_param))
+        generator = torch.Generator(device=weight.device).manual_seed(0)
+        U, S, Vh = randomized_svd(weight.float(), lora_rank, oversample, power_iters, generator)
+        return U.to(weight.dtype), S.to(weight.dtype), Vh.to(weight.dtype), lora_rank
+    U, S, Vh = linalg.svd(weight)
+    return U, S, Vh, get_lora_rank(S, mode, mode_param)
+
+
+def extract_conv(
+        weight: Union[torch.Tensor, nn.Parameter],
+        mode='fixed',
+        mode_param=0,
+        device='cpu',
+        is_cp=False,
+        svd_method='full',
+        oversample=8,
+        power_iters=2,
+) -> Tuple[nn.Parameter, nn.Parameter]:
+    weight = weight.to(device)
+    out_ch, in_ch, kernel_size, _ = weight.shape
+
+    if svd_method == 'randomized' and mode == 'fixed' and not is_cp:
+        # skip the decomposition entirely when it would be stored full anyway
+        if min(out_ch, in_ch, max(1, mode_param)) >= out_ch / 2:
+            return weight, 'full'
+
+    U, S, Vh, lora_rank = _get_svd(
+        weight.reshape(out_ch, -1), mode, mode_param, min(out_ch, in_ch), svd_method, oversample, power_iters
+    )
+
     lora_rank = max(1, lora_rank)
     lora_rank = min(out_ch, in_ch, lora_rank)
     if lora_rank >= out_ch / 2 and not is_cp:
@@ -72,28 +126,21 @@ def extract_linear(
         mode='fixed',
         mode_param=0,
         device='cpu',
+        svd_method='full',
+        oversample=8,
+        power_iters=2,
 ) -> Tuple[nn.Parameter, nn.Parameter]:
     weight = weight.to(device)
     out_ch, in_ch = weight.shape
 
-    U, S, Vh = linalg.svd(weight)
+    if svd_method == 'randomized' and mode == 'fixed':
+        if min(out_ch, in_ch, max(1, mode_param)) >= out_ch / 2:
+            return weight, 'full'
+
+    U, S, Vh, lora_rank = _get_svd(
+        weight, mode, mode_param, min(out_ch, in_ch), svd_method, oversample, power_iters
+    )
 
-    if mode == 'fixed':
-        lora_rank = mode_param
-    elif mode == 'threshold':
-        assert mode_param >= 0
-        lora_rank = torch.sum(S > mode_param)
-    elif mode == 'ratio':
-        assert 1 >= mode_param >= 0
-        min_s = torch.max(S) * mode_param
-        lora_rank = torch.sum(S > min_s)
-    elif mode == 'quantile' or mode == 'percentile':
-        assert 1 >= mode_param >= 0
-        s_cum = torch.cumsum(S, dim=0)
-        min_cum_sum = mode_param * torch.sum(S)
-        lora_rank = torch.sum(s_cum < min_cum_sum)
-    else:
-        raise NotImplementedError('Extract mode should be "fixed", "threshold", "ratio" or "quantile"')
     lora_rank = max(1, lora_rank)
     lora_rank = min(out_ch, in_ch, lora_rank)
     if lora_rank >= out_ch / 2:
@@ -111,6 +158,48 @@ def extract_linear(
     return (extract_weight_A, extract_weight_B, diff), 'low rank'
 
 
+def extract_low_rank_batched(
+        weights: List[torch.Tensor],
+        rank: int,
+        device='cpu',
+        oversample=8,
+        power_iters=2,
+        return_diff=False,
+) -> List[Tuple[Tuple[torch.Tensor, torch.Tensor, Optional[torch.Tensor]], float]]:
+    """
+    Rank rank lora factors of a list of same shaped linear or conv weights, decomposed together with
+    one batched randomized svd. Returns ((down, up, diff), relative error) per weight, where the
+    relative error is ||W - up @ down|| / ||W|| (frobenius), diff is None unless return_diff.
+    """
+    shape = weights[0].shape
+    out_ch = shape[0]
+    stacked = torch.stack([w.to(device, torch.float32).reshape(out_ch, -1) for w in weights])
+    generator = torch.Generator(device=stacked.device).manual_seed(0)
+    U, S, Vh = randomized_svd(stacked, rank, oversample, power_iters, generator)
+    # U and Vh are orthonormal, so the error is the energy the kept singular values miss
+    total_sq = stacked.pow(2).sum(dim=(-2, -1))
+    rel_err = ((total_sq - S.pow(2).sum(dim=-1)).clamp_min(0) / total_sq.clamp_min(1e-12)).sqrt()
+    U = U * S.unsqueeze(-2)
+
+    results = []
+    for i in range(len(weights)):
+        extract_weight_A = Vh[i].reshape(rank, *shape[1:])
+        extract_weight_B = U[i].reshape(out_ch, rank, *[1] * (len(shape) - 2))
+        diff = None
+        if return_diff:
+            diff = (stacked[i] - U[i] @ Vh[i]).reshape(shape)
+        results.append(((extract_weight_A, extract_weight_B, diff), rel_err[i].item()))
+    del stacked, U, S, Vh
+    return results
+
+
+def print_extract_error(rel_errors: List[float]):
+    if len(rel_errors) == 0:
+        return
+    mean_err = sum(rel_errors) / len(rel_errors)
+    print(f"Randomized svd relative error over {len(rel_errors)} layers: mean {mean_err:.4f}, max {max(rel_errors):.4f}")
+
+
 def extract_diff(
         base_model,
         db_model,
@@ -124,8 +213,15 @@ def extract_diff(
         linear_only=False,
         extract_unet=True,
         extract_text_encoder=True,
+        svd_method='full',
+        svd_oversample=8,
+        svd_power_iters=2,
+        svd_batch_size=8,
 ):
     meta = OrderedDict()
+    # fixed rank randomized extraction decomposes same shaped layers together
+    batched = svd_method == 'randomized' and mode == 'fixed'
+    rel_errors = []
 
     UNET_TARGET_REPLACE_MODULE = [
         "Transformer2DModel",
@@ -169,6 +265,57 @@ def extract_diff(
         loras = {}
         temp = {}
         temp_name = {}
+        # (shape, rank) -> [(lora_name, diff)] waiting for a batched decomposition
+        pending = {}
+
+        def save_low_rank(lora_name, extract_a, extract_b, diff):
+            loras[f'{lora_name}.lora_down.weight'] = extract_a.detach().cpu().contiguous().half()
+            loras[f'{lora_name}.lora_up.weight'] = extract_b.detach().cpu().contiguous().half()
+            loras[f'{lora_name}.alpha'] = torch.Tensor([extract_a.shape[0]]).half()
+            if use_bias:
+                diff = diff.detach().cpu().reshape(extract_b.size(0), -1)
+                sparse_diff = make_sparse(diff, sparsity).to_sparse().coalesce()
+
+                indices = sparse_diff.indices().to(torch.int16)
+                values = sparse_diff.values().half()
+                loras[f'{lora_name}.bias_indices'] = indices
+                loras[f'{lora_name}.bias_values'] = values
+                loras[f'{lora_name}.bias_size'] = torch.tensor(diff.shape).to(torch.int16)
+
+        def flush_pending(key):
+            names, diffs = zip(*pending.pop(key))
+            results = extract_low_rank_batched(
+                list(diffs), key[1], extract_device, svd_oversample, svd_power_iters, return_diff=use_bias
+            )
+            for lora_name, ((extract_a, extract_b, diff), rel_err) in zip(names, results):
+                save_low_rank(lora_name, extract_a, extract_b, diff)
+                rel_errors.append(rel_err)
+
+        def queue_low_rank(lora_name, layer, weight, base_weight):
+            # returns True if the layer was handled here
+            if layer in {'Linear', 'LoRACompatibleLinear'}:
+                mode_param = linear_mode_param
+            elif layer in {'Conv2d', 'LoRACompatibleConv'}:
+                is_linear = weight.shape[2] == 1 and weight.shape[3] == 1
+                if not is_linear and linear_only:
+                    return True
+                if small_conv and not is_linear:
+                    # needs the cp decomposition below
+                    return False
+                mode_param = linear_mode_param if is_linear else conv_mode_param
+            else:
+                return False
+            diff = (weight - base_weight).detach()
+            out_ch, in_ch = diff.shape[:2]
+            lora_rank = min(out_ch, in_ch, max(1, mode_param))
+            if lora_rank >= out_ch / 2:
+                loras[f'{lora_name}.diff'] = diff.cpu().contiguous().half()
+                return True
+            key = (tuple(diff.shape), lora_rank)
+            pending.setdefault(key, []).append((lora_name, diff))
+            if len(pending[key]) >= svd_batch_size:
+                flush_pending(key)
+            return True
 
         for name, module in root_module.named_modules():
             if module.__class__.__name__ in target_replace_modules:
@@ -192,6 +339,9 @@ def extract_diff(
                         if torch.allclose(root_weight, weights[child_name]):
                             continue
 
+                        if batched and queue_low_rank(lora_name, layer, root_weight, weights[child_name]):
+                            continue
+
                     if layer == 'Linear' or layer == 'LoRACompatibleLinear':
                         weight, decompose_mode = extract_linear(
                             (child_module.weight - weights[child_name]),
@@ -260,6 +410,9 @@ def extract_diff(
                     if torch.allclose(root_weight, weights):
                         continue
 
+                    if batched and queue_low_rank(lora_name, layer, root_weight, weights):
+                        continue
+
                 if layer == 'Linear' or layer == 'LoRACompatibleLinear':
                     weight, decompose_mode = extract_linear(
                         (root_weight - weights),
@@ -319,6 +472,9 @@ def extract_diff(
                     loras[f'{lora_name}.diff'] = weight.detach().cpu().contiguous().half()
                 else:
                     raise NotImplementedError
+
+        for key in list(pending.keys()):
+            flush_pending(key)
         return loras
 
     text_encoder_loras = make_state_dict(
@@ -334,10 +490,113 @@ def extract_diff(
         UNET_TARGET_REPLACE_NAME
     )
     print(len(text_encoder_loras), len(unet_loras))
+    print_extract_error(rel_errors)
     # the | will
     return (text_encoder_loras | unet_loras), meta
 
 
+def _get_safetensors_files(path: Union[str, List[str]]) -> List[str]:
+    if isinstance(path, (list, tuple)):
+        return list(path)
+    if os.path.isdir(path):
+        files = sorted(glob.glob(os.path.join(path, '*.safetensors')))
+        if len(files) == 0:
+            raise FileNotFoundError(f"No .safetensors files found in {path}")
+        return files
+    return [path]
+
+
+@torch.no_grad()
+def extract_diff_from_safetensors(
+        base_path: Union[str, List[str]],
+        tuned_path: Union[str, List[str]],
+        rank: int,
+        prefix='transformer',
+        key_filter: Optional[Callable[[str], bool]] = None,
+        extract_device='cpu',
+        svd_oversample=8,
+        svd_power_iters=2,
+        svd_batch_size=8,
+        use_bias=False,
+        sparsity=0.98,
+):
+    """
+    Fixed rank lora extraction straight from two safetensors checkpoints (a file, a list of shards or
+    a folder of shards) with the same keys, like diffusers transformer weights. Tensors are read
+    lazily a batch at a time, so neither model is ever fully in memory. Every 2d and 4d .weight is
+    extracted, same shaped ones with one batched randomized svd. Keys are saved in peft format,
+    {prefix}.{module}.lora_A.weight / lora_B.weight.
+    """
+    from safetensors import safe_open
+
+    def open_files(path):
+        handles = {}
+        for file in _get_safetensors_files(path):
+            f = safe_open(file, framework='pt', device='cpu')
+            for key in f.keys():
+                handles[key] = f
+        return handles
+
+    base_handles = open_files(base_path)
+    tuned_handles = open_files(tuned_path)
+
+    # group by shape from the headers only
+    groups = OrderedDict()
+    for key, f in tuned_handles.items():
+        if not key.endswith('.weight') or key not in base_handles:
+            continue
+        if key_filter is not None and not key_filter(key):
+            continue
+        shape = tuple(f.get_slice(key).get_shape())
+        if len(shape) not in (2, 4):
+            continue
+        groups.setdefault(shape, []).append(key)
+
+    loras = OrderedDict()
+    rel_errors = []
+    progress = tqdm(total=sum(len(keys) for keys in groups.values()), desc='Extracting')
+    for shape, keys in groups.items():
+        out_ch, in_ch = shape[:2]
+        lora_rank = min(out_ch, in_ch, max(1, rank))
+        for start in range(0, len(keys), svd_batch_size):
+            names = []
+            diffs = []
+            for key in keys[start:start + svd_batch_size]:
+                tuned_weight = tuned_handles[key].get_tensor(key).float()
+                base_weight = base_handles[key].get_tensor(key).float()
+                progress.update(1)
+                if torch.allclose(tuned_weight, base_weight):
+                    continue
+                diff = tuned_weight - base_weight
+                del tuned_weight, base_weight
+                lora_name = f"{prefix}.{key[:-len('.weight')]}"
+                if lora_rank >= out_ch / 2:
+                    loras[f'{lora_name}.diff'] = diff.contiguous().half()
+                    continue
+                names.append(lora_name)
+                diffs.append(diff)
+            if len(diffs) == 0:
+                continue
+            results = extract_low_rank_batched(
+                diffs, lora_rank, extract_device, svd_oversample, svd_power_iters, return_diff=use_bias
+            )
+            del diffs
+            for lora_name, ((extract_a, extract_b, diff), rel_err) in zip(names, results):
+                loras[f'{lora_name}.lora_A.weight'] = extract_a.detach().cpu().contiguous().half()
+                loras[f'{lora_name}.lora_B.weight'] = extract_b.detach().cpu().contiguous().half()
+                if use_bias:
+                    diff = diff.detach().cpu().reshape(extract_b.size(0), -1)
+                    sparse_diff = make_sparse(diff, sparsity).to_sparse().coalesce()
+                    loras[f'{lora_name}.bias_indices'] = sparse_diff.indices().to(torch.int16)
+                    loras[f'{lora_name}.bias_values'] = sparse_diff.values().half()
+                    loras[f'{lora_name}.bias_size'] = torch.tensor(diff.shape).to(torch.int16)
+                rel_errors.append(rel_err)
+            del results
+    progress.close()
+    print_extract_error(rel_errors)
+    return loras, OrderedDict()
+
+
 def get_module(
         lyco_state_dict: Dict,
         lora_name
@@ -0,0 +1,280 @@
+"""
+Disk tier for layer offloading. Frozen weights are written to a safetensors file on local disk
+(ideally NVMe) and the module parameters are swapped for views into a memory map of that file, so
+they live in the page cache instead of pinned host ram. Before a layer runs, its weight is copied
+into a bounded pool of pinned staging buffers, and the next few layers in execution order are
+paged in on a background thread so the copies overlap with compute.
+"""
+
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import torch
+from safetensors.torch import save_file
+
+_SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+def can_offload_to_disk(param: Optional[torch.Tensor]) -> bool:
+    # only plain float weights, quantized tensor subclasses stay in ram
+    if param is None or param.data.__class__ is not torch.Tensor:
+        return False
+    return param.dtype.is_floating_point and not param.is_meta and param.numel() > 0
+
+
+class MemoryTierStats:
+    """
+    Hit / miss and transfer counters per tier. A hit on a tier means the weight was already there
+    when it was needed, bytes and seconds are what was moved into it, for bandwidth.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.tiers: Dict[str, Dict[str, float]] = OrderedDict()
+
+    def _get_tier(self, tier: str) -> Dict[str, float]:
+        if tier not in self.tiers:
+            self.tiers[tier] = {"hits": 0, "misses": 0, "bytes": 0, "seconds": 0.0}
+        return self.tiers[tier]
+
+    def record(self, tier: str, hit: Optional[bool] = None, num_bytes: int = 0, seconds: float = 0.0):
+        with self._lock:
+            stats = self._get_tier(tier)
+            if hit is True:
+                stats["hits"] += 1
+            elif hit is False:
+                stats["misses"] += 1
+            stats["bytes"] += num_bytes
+            stats["seconds"] += seconds
+
+    def merge(self, other: "MemoryTierStats"):
+        with other._lock:
+            tiers = {k: dict(v) for k, v in other.tiers.items()}
+        with self._lock:
+            for tier, other_stats in tiers.items():
+                stats = self._get_tier(tier)
+                for key, value in other_stats.items():
+                    stats[key] += value
+
+    def reset(self):
+        with self._lock:
+            self.tiers = OrderedDict()
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            summary = OrderedDict()
+            for tier, stats in self.tiers.items():
+                total = stats["hits"] + stats["misses"]
+                summary[tier] = {
+                    **stats,
+                    "hit_rate": stats["hits"] / total if total > 0 else 0.0,
+                    "gb_per_second": (stats["bytes"] / 1e9) / stats["seconds"] if stats["seconds"] > 0 else 0.0,
+                }
+            return summary
+
+    def __str__(self):
+        lines = []
+        for tier, stats in self.summary().items():
+            lines.append(
+                f"{tier}: {stats['hits']:.0f} hits, {stats['misses']:.0f} misses ({stats['hit_rate'] * 100:.1f}%), "
+                f"{stats['bytes'] / 1e9:.2f} GB at {stats['gb_per_second']:.2f} GB/s"
+            )
+        return "\n".join(lines)
+
+
+class DiskWeightStore:
+    """
+    Holds the disk offloaded weights of one MemoryManager. Weights are added while the manager attaches
+    to the layers and written out in one go by finalize(). After that, get(key) returns the weight in a
+    pinned staging buffer, paging it in from the memory map if it is not already staged.
+    """
+
+    def __init__(
+        self,
+        disk_dir: str,
+        max_staging_bytes: int = 4 * 1024 ** 3,
+        prefetch: int = 4,
+        stats: Optional[MemoryTierStats] = None,
+    ):
+        self.disk_dir = disk_dir
+        self.max_staging_bytes = max_staging_bytes
+        self.prefetch = prefetch
+        self.stats = stats if stats is not None else MemoryTierStats()
+        self.pin_memory = torch.cuda.is_available()
+
+        self._pending: Dict[str, torch.nn.Parameter] = OrderedDict()
+        self._params: Dict[str, torch.nn.Parameter] = {}
+        self._views: Dict[str, torch.Tensor] = {}
+        self._mmap: Optional[mmap.mmap] = None
+
+        self._lock = threading.Lock()
+        self._staged: Dict[str, torch.Tensor] = OrderedDict()
+        self._staged_bytes = 0
+        self._in_flight: Dict[str, Future] = {}
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+        # execution order, learned from the first pass
+        self._order: List[str] = []
+        self._order_index: Dict[str, int] = {}
+        self._last_index: Optional[int] = None
+
+    def add(self, param: torch.nn.Parameter) -> str:
+        key = str(len(self._pending) + len(self._params))
+        self._pending[key] = param
+        return key
+
+    def finalize(self):
+        if len(self._pending) == 0:
+            return
+        if self._mmap is not None:
+            raise RuntimeError("DiskWeightStore can only be finalized once")
+        os.makedirs(self.disk_dir, exist_ok=True)
+        path = os.path.join(self.disk_dir, f"layer_offload_{uuid.uuid4().hex}.safetensors")
+        save_file(
+            {key: param.data.detach().to("cpu").contiguous() for key, param in self._pending.items()},
+            path,
+        )
+
+        with open(path, "rb") as f:
+            # copy on write, so torch gets a writable buffer without touching the file
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        try:
+            # the mapping keeps the data around, nothing is left behind if we crash
+            os.remove(path)
+        except OSError:
+            pass
+
+        header_size = struct.unpack("<Q", self._mmap[:8])[0]
+        header = json.loads(self._mmap[8:8 + header_size])
+        data_start = 8 + header_size
+        largest = 0
+        for key, param in self._pending.items():
+            info = header[key]
+            start, end = info["data_offsets"]
+            dtype = _SAFETENSORS_DTYPES[info["dtype"]]
+            view = torch.frombuffer(
+                self._mmap, dtype=dtype, count=(end - start) // dtype.itemsize, offset=data_start + start
+            ).view(info["shape"])
+            # the parameter now points at the page cache instead of ram. it is read only from here on
+            param.data = view
+            param.requires_grad_(False)
+            self._views[key] = view
+            self._params[key] = param
+            largest = max(largest, end - start)
+        self._pending = OrderedDict()
+
+        # always room for the layer being used plus everything we prefetch
+        self.max_staging_bytes = max(self.max_staging_bytes, (self.prefetch + 2) * largest)
+        if self.prefetch > 0:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="disk_tier_prefetch")
+
+    def is_offloaded(self, key: str) -> bool:
+        # if something replaced the parameter data (a dtype change), it is a normal ram tensor again
+        param = self._params.get(key, None)
+        if param is None:
+            return False
+        view = self._views[key]
+        return param.data_ptr() == view.data_ptr() and param.dtype == view.dtype
+
+    def _page_in(self, key: str) -> torch.Tensor:
+        view = self._views[key]
+        start = time.perf_counter()
+        staged = torch.empty(view.shape, dtype=view.dtype, pin_memory=self.pin_memory)
+        staged.copy_(view)
+        num_bytes = staged.numel() * staged.element_size()
+        self.stats.record("disk", num_bytes=num_bytes, seconds=time.perf_counter() - start)
+        return staged
+
+    def _stage(self, key: str, staged: torch.Tensor):
+        # caller holds the lock
+        if key in self._staged:
+            return
+        num_bytes = staged.numel() * staged.element_size()
+        while len(self._staged) > 0 and self._staged_bytes + num_bytes > self.max_staging_bytes:
+            _, evicted = self._staged.popitem(last=False)
+            self._staged_bytes -= evicted.numel() * evicted.element_size()
+        self._staged[key] = staged
+        self._staged_bytes += num_bytes
+
+    def _prefetch_job(self, key: str):
+        staged = self._page_in(key)
+        with self._lock:
+            self._stage(key, staged)
+            self._in_flight.pop(key, None)
+
+    def _schedule_prefetch(self, key: str):
+        if self._executor is None:
+            return
+        index = self._order_index.get(key, None)
+        if index is None:
+            # first pass, order is still being learned
+            self._order_index[key] = len(self._order)
+            self._order.append(key)
+            return
+        # backward runs the layers in reverse
+        direction = -1 if self._last_index is not None and index == self._last_index - 1 else 1
+        self._last_index = index
+        num_layers = len(self._order)
+        for i in range(1, min(self.prefetch, num_layers - 1) + 1):
+            next_key = self._order[(index + direction * i) % num_layers]
+            with self._lock:
+                if next_key in self._staged or next_key in self._in_flight:
+                    continue
+                self._in_flight[next_key] = self._executor.submit(self._prefetch_job, next_key)
+
+    def get(self, key: str) -> torch.Tensor:
+        num_bytes = 0
+        with self._lock:
+            staged = self._staged.get(key, None)
+            future = self._in_flight.get(key, None)
+            if staged is not None:
+                self._staged.move_to_end(key)
+                num_bytes = staged.numel() * staged.element_size()
+        if staged is not None:
+            self.stats.record("staging", hit=True, num_bytes=num_bytes)
+        elif future is not None:
+            # prefetch was too late, wait for it instead of reading twice
+            start = time.perf_counter()
+            future.result()
+            with self._lock:
+                staged = self._staged.get(key, None)
+            if staged is None:
+                staged = self._page_in(key)
+            num_bytes = staged.numel() * staged.element_size()
+            self.stats.record("staging", hit=False, num_bytes=num_bytes, seconds=time.perf_counter() - start)
+        else:
+            start = time.perf_counter()
+            staged = self._page_in(key)
+            with self._lock:
+                self._stage(key, staged)
+            num_bytes = staged.numel() * staged.element_size()
+            self.stats.record("staging", hit=False, num_bytes=num_bytes, seconds=time.perf_counter() - start)
+        self._schedule_prefetch(key)
+        return staged
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        with self._lock:
+            self._staged = OrderedDict()
+            self._staged_bytes = 0
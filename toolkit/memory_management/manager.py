@@ -1,6 +1,8 @@
 import torch
-from .manager_modules import LinearLayerMemoryManager, ConvLayerMemoryManager
-import random
+from typing import Optional
+from .manager_modules import LinearLayerMemoryManager, ConvLayerMemoryManager, LayerPrefetcher
+from .disk_tier import DiskWeightStore, MemoryTierStats
+from .offload_planner import OffloadPlan, plan_layer_offloading
 from toolkit.print import print_verbose
 
 LINEAR_MODULES = [
@@ -44,8 +46,18 @@ class MemoryManager:
         self.module: torch.nn.Module = module
         self.process_device: torch.device = process_device
         self.unmanaged_modules: list[torch.nn.Module] = []
+        self.stats = MemoryTierStats()
+        # optional third tier for frozen weights, see disk_tier.py
+        self.disk_store: Optional[DiskWeightStore] = None
+        # copies upcoming layers to the gpu ahead of time, see LayerPrefetcher
+        self.prefetcher: Optional[LayerPrefetcher] = None
+        # which layers are offloaded and why, see offload_planner.py
+        self.plan: Optional[OffloadPlan] = None
 
     def memory_managed_to(self, *args, **kwargs):
+        if self.prefetcher is not None:
+            # weights may change dtype or device, drop anything copied ahead of time
+            self.prefetcher.clear()
         # first move all the unmanaged modules
         for module in self.unmanaged_modules:
             if isinstance(module, torch.nn.Parameter):
@@ -73,7 +85,14 @@ class MemoryManager:
         device: torch.device, 
         offload_percent: float = 1.0,
         ignore_modules: list[torch.nn.Module] = [],
-        verbose: bool = False
+        verbose: bool = False,
+        disk_dir: Optional[str] = None,
+        disk_staging_bytes: int = 4 * 1024 ** 3,
+        disk_prefetch: int = 4,
+        prefetch_layers: int = 0,
+        prefetch_budget_bytes: int = 1024 ** 3,
+        vram_budget_bytes: Optional[int] = None,
+        tokens_per_module: Optional[dict] = None,
     ):
         print_verbose(verbose, f"MemoryManager.attach() called for module {module.__class__.__name__}, device={device}, offload_percent={offload_percent}")
         if hasattr(module, "_memory_manager"):
@@ -83,6 +102,20 @@ class MemoryManager:
 
         module._memory_manager = cls(module, device)
         print_verbose(verbose, f"MemoryManager instance created for {module.__class__.__name__}")
+        if disk_dir is not None:
+            module._memory_manager.disk_store = DiskWeightStore(
+                disk_dir,
+                max_staging_bytes=disk_staging_bytes,
+                prefetch=disk_prefetch,
+                stats=module._memory_manager.stats,
+            )
+
+        if prefetch_layers > 0 and torch.device(device).type == "cuda":
+            module._memory_manager.prefetcher = LayerPrefetcher(
+                torch.device(device),
+                lookahead=prefetch_layers,
+                budget_bytes=prefetch_budget_bytes,
+            )
 
         # override the to method to handle memory management
         module._mm_to = module.to
@@ -96,6 +129,24 @@ class MemoryManager:
             
         # count ignore modules as processed
         modules_processed = [x for x in ignore_modules]
+
+        # decide up front which layers to offload, the rest stay resident
+        candidates = [
+            (name, sub_module)
+            for name, sub_module in module.named_modules()
+            if sub_module.__class__.__name__ in LINEAR_MODULES + CONV_MODULES
+            and sub_module not in modules_processed
+        ]
+        plan = plan_layer_offloading(
+            candidates,
+            offload_percent=offload_percent,
+            vram_budget_bytes=vram_budget_bytes,
+            tokens_per_module=tokens_per_module,
+        )
+        module._memory_manager.plan = plan
+        offload_names = set(plan.offloaded_names)
+        offload_ids = set(id(m) for name, m in candidates if name in offload_names)
+        print_verbose(verbose, f"Offload plan for {module.__class__.__name__}: {plan.summary()}")
         linear_count = 0
         conv_count = 0
         unmanaged_count = 0
@@ -106,11 +157,7 @@ class MemoryManager:
                     child_module.__class__.__name__ in LINEAR_MODULES
                     and child_module not in modules_processed
                 ):
-                    skip = False
-                    if offload_percent < 1.0:
-                        # randomly skip some modules
-                        if random.random() > offload_percent:
-                            skip = True
+                    skip = id(child_module) not in offload_ids
                     if skip:
                         module._memory_manager.unmanaged_modules.append(child_module)
                         unmanaged_count += 1
@@ -134,11 +181,7 @@ class MemoryManager:
                     child_module.__class__.__name__ in CONV_MODULES
                     and child_module not in modules_processed
                 ):
-                    skip = False
-                    if offload_percent < 1.0:
-                        # randomly skip some modules
-                        if random.random() > offload_percent:
-                            skip = True
+                    skip = id(child_module) not in offload_ids
                     if skip:
                         module._memory_manager.unmanaged_modules.append(child_module)
                         unmanaged_count += 1
@@ -168,4 +211,8 @@ class MemoryManager:
                     unmanaged_count += 1
                 else:
                     continue
+        if module._memory_manager.disk_store is not None:
+            # write the frozen weights out and point the layers at the memory map
+            print_verbose(verbose, f"Writing frozen weights of {module.__class__.__name__} to {disk_dir}")
+            module._memory_manager.disk_store.finalize()
         print_verbose(verbose, f"MemoryManager.attach() completed for {module.__class__.__name__}: {linear_count} linear layers, {conv_count} conv layers, {unmanaged_count} unmanaged modules")
@@ -9,8 +9,11 @@ I simply modified it to work with a memory management model and with AI Toolkit'
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from typing import TYPE_CHECKING, Optional, Tuple
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
 from torch.overrides import has_torch_function_unary  # (ADD) torchao detection
+from toolkit.profiler import get_active_profiler
+from .disk_tier import can_offload_to_disk
 
 if TYPE_CHECKING:
     from .manager import MemoryManager
@@ -114,16 +117,155 @@ def _ensure_cpu_pinned(t: Optional[torch.Tensor]) -> Optional[torch.Tensor]:
     return t
 
 
-def _move_params_to_cpu_and_pin(module: nn.Module):
+def _record_transfer(direction: str, *tensors: Optional[torch.Tensor]):
+    profiler = get_active_profiler()
+    if profiler is None:
+        return
+    num_bytes = 0
+    for t in tensors:
+        if t is not None:
+            num_bytes += t.numel() * t.element_size()
+    profiler.record_transfer(num_bytes, direction, name="layer_offload")
+
+
+def _move_params_to_cpu_and_pin(module: nn.Module, pin_weight: bool = True):
     """Force parameters to CPU (+pinned) so we can 'bounce' them per forward/backward."""
     with torch.no_grad():
         if hasattr(module, "weight") and isinstance(module.weight, nn.Parameter):
-            module.weight.data = _ensure_cpu_pinned(module.weight.data).detach()
+            if pin_weight:
+                module.weight.data = _ensure_cpu_pinned(module.weight.data).detach()
+            else:
+                # going to the disk tier, no point pinning it first
+                module.weight.data = module.weight.data.to("cpu").detach()
         if hasattr(module, "bias") and isinstance(module.bias, nn.Parameter):
             if module.bias is not None:
                 module.bias.data = _ensure_cpu_pinned(module.bias.data).detach()
 
 
+def _materialize_weight(
+    cpu_w: torch.Tensor, device: torch.device, target_dtype: torch.dtype
+) -> torch.Tensor:
+    # same as the materialize helpers in the autograd fns, for the prefetcher
+    if _is_quantized_tensor(cpu_w):
+        w_q_gpu = cpu_w.to(device, non_blocking=True)
+        try:
+            w_fp_gpu = w_q_gpu.dequantize()
+        except Exception:
+            w_fp_gpu = w_q_gpu.to(dtype=torch.float32, non_blocking=True)
+        if w_fp_gpu.dtype != target_dtype:
+            w_fp_gpu = w_fp_gpu.to(target_dtype, non_blocking=True)
+        return w_fp_gpu
+    return cpu_w.to(device, non_blocking=True)
+
+
+class LayerPrefetcher:
+    """
+    Learns the order the offloaded layers run in during the first forward pass, then copies the
+    weights of the next few layers to the gpu on the transfer stream while the current layer computes.
+    Backward walks the same order in reverse. How far ahead it goes is capped by the lookahead and by
+    a byte budget for the prefetched weights.
+    """
+
+    def __init__(
+        self,
+        device: torch.device,
+        lookahead: int = 2,
+        budget_bytes: int = 1024 ** 3,
+    ):
+        self.device = device
+        self.lookahead = lookahead
+        self.budget_bytes = budget_bytes
+        self.order: List["BaseLayerMemoryManager"] = []
+        self._index: Dict[int, int] = {}
+        # (id(layer), direction) -> (weight, bias, event, num_bytes, dtype, weight version)
+        self._ready: Dict[int, tuple] = OrderedDict()
+        self._ready_bytes = 0
+
+    def _drop(self, key: tuple):
+        entry = self._ready.pop(key)
+        self._ready_bytes -= entry[3]
+
+    def take(
+        self, layer: "BaseLayerMemoryManager", target_dtype: torch.dtype, direction: int
+    ) -> Optional[Tuple[torch.Tensor, Optional[torch.Tensor]]]:
+        key = (id(layer), direction)
+        if key not in self._ready:
+            return None
+        w, b, event, _, dtype, version = self._ready[key]
+        self._drop(key)
+        # the weight was updated after we copied it (optimizer step, lora merge), copy it again
+        if dtype != target_dtype or version != layer.module.weight._version:
+            return None
+        stream = torch.cuda.current_stream(self.device)
+        stream.wait_event(event)
+        # they were allocated on the transfer stream, keep them alive until compute is done with them
+        w.record_stream(stream)
+        if b is not None:
+            b.record_stream(stream)
+        return w, b
+
+    def prefetch_after(
+        self, layer: "BaseLayerMemoryManager", direction: int, target_dtype: torch.dtype
+    ):
+        if id(layer) not in self._index:
+            if direction < 0:
+                return
+            self._index[id(layer)] = len(self.order)
+            self.order.append(layer)
+        index = self._index[id(layer)]
+        upcoming = []
+        for i in range(1, self.lookahead + 1):
+            next_index = index + direction * i
+            if next_index < 0 or next_index >= len(self.order):
+                break
+            upcoming.append(self.order[next_index])
+
+        # anything in this direction that is not coming up was for a skipped layer. Entries for the other
+        # direction are kept, with gradient checkpointing the recomputed forwards run between backward layers
+        upcoming_keys = set((id(l), direction) for l in upcoming)
+        for key in [k for k in self._ready.keys() if k[1] == direction and k not in upcoming_keys]:
+            self._drop(key)
+
+        state = _get_device_state(self.device)
+        ts = state["transfer_stream"]
+        for next_layer in upcoming:
+            if (id(next_layer), direction) in self._ready:
+                continue
+            weight_cpu = next_layer.module.weight
+            bias_cpu = getattr(next_layer.module, "bias", None)
+            # what it will take on the gpu, quantized weights are dequantized to the compute dtype there
+            element_size = target_dtype.itemsize if _is_quantized_tensor(weight_cpu) else weight_cpu.element_size()
+            num_bytes = weight_cpu.numel() * element_size
+            if bias_cpu is not None:
+                num_bytes += bias_cpu.numel() * bias_cpu.element_size()
+            if self._ready_bytes + num_bytes > self.budget_bytes:
+                break
+            with torch.cuda.stream(ts):
+                w = _materialize_weight(next_layer._weight_source(), self.device, target_dtype)
+                b = bias_cpu.to(self.device, non_blocking=True) if bias_cpu is not None else None
+                event = torch.cuda.Event()
+                event.record()
+            _record_transfer("h2d", weight_cpu, bias_cpu)
+            # charge what was actually allocated
+            num_bytes = w.numel() * w.element_size()
+            if b is not None:
+                num_bytes += b.numel() * b.element_size()
+            self._ready[(id(next_layer), direction)] = (
+                w, b, event, num_bytes, target_dtype, weight_cpu._version
+            )
+            self._ready_bytes += num_bytes
+
+    def clear(self):
+        self._ready = OrderedDict()
+        self._ready_bytes = 0
+
+
+def _get_prefetcher(layer: Optional["BaseLayerMemoryManager"]) -> Optional[LayerPrefetcher]:
+    if layer is None:
+        return None
+    return layer.manager.prefetcher
+
+
 # ==========================
 # Autograd functions (CUDA)
 # ==========================
@@ -131,7 +273,17 @@ def _move_params_to_cpu_and_pin(module: nn.Module):
 
 class _BouncingLinearFn(torch.autograd.Function):
     @staticmethod
-    def forward(ctx, x, weight_cpu, bias_cpu, device: torch.device):
+    def forward(
+        ctx,
+        x,
+        weight_cpu,
+        bias_cpu,
+        device: torch.device,
+        weight_stager=None,
+        layer: Optional["BaseLayerMemoryManager"] = None,
+    ):
+        # weight_stager returns the weight in a staging buffer for disk offloaded weights
+        weight_src = weight_stager if weight_stager is not None else (lambda: weight_cpu)
         # choose compute dtype to match activations
         target_dtype = (
             x.dtype
@@ -158,11 +310,12 @@ class _BouncingLinearFn(torch.autograd.Function):
         if device.type != "cuda":
             out = F.linear(
                 x.to("cpu"),
-                _materialize_linear_weight(weight_cpu, torch.device("cpu")),
+                _materialize_linear_weight(weight_src(), torch.device("cpu")),
                 bias_cpu,
             )
             ctx.save_for_backward(x.to("cpu"), weight_cpu, bias_cpu)
             ctx.device = torch.device("cpu")
+            ctx.weight_stager = weight_stager
             return out.to(x.device)
 
         state = _get_device_state(device)
@@ -172,22 +325,34 @@ class _BouncingLinearFn(torch.autograd.Function):
         ev_cu_s = state["compute_forward_start_event"]
         idx = state["forward_clk"]
 
-        with torch.cuda.stream(ts):
-            ts.wait_event(ev_cu_s)
-            w_bufs[idx] = _materialize_linear_weight(weight_cpu, device)
-            b_bufs[idx] = (
-                bias_cpu.to(device, non_blocking=True) if bias_cpu is not None else None
-            )
-            state["forward_clk"] ^= 1
-            ev_tx_f.record()
+        prefetcher = _get_prefetcher(layer)
+        prefetched = prefetcher.take(layer, target_dtype, 1) if prefetcher is not None else None
+        if prefetched is not None:
+            w_gpu, b_gpu = prefetched
+        else:
+            with torch.cuda.stream(ts):
+                ts.wait_event(ev_cu_s)
+                w_bufs[idx] = _materialize_linear_weight(weight_src(), device)
+                b_bufs[idx] = (
+                    bias_cpu.to(device, non_blocking=True) if bias_cpu is not None else None
+                )
+                state["forward_clk"] ^= 1
+                ev_tx_f.record()
+            _record_transfer("h2d", weight_cpu, bias_cpu)
+            torch.cuda.current_stream().wait_event(ev_tx_f)
+            w_gpu, b_gpu = w_bufs[idx], b_bufs[idx]
+        if prefetcher is not None:
+            # start copying the next layers while this one computes
+            prefetcher.prefetch_after(layer, 1, target_dtype)
 
-        torch.cuda.current_stream().wait_event(ev_tx_f)
         ev_cu_s.record()
-        out = F.linear(x, w_bufs[idx], b_bufs[idx])
+        out = F.linear(x, w_gpu, b_gpu)
 
         ctx.save_for_backward(x, weight_cpu, bias_cpu)
         ctx.device = device
         ctx.target_dtype = target_dtype
+        ctx.weight_stager = weight_stager
+        ctx.layer = layer
         return out
 
     @staticmethod
@@ -195,14 +360,17 @@ class _BouncingLinearFn(torch.autograd.Function):
         x, weight_cpu, bias_cpu = ctx.saved_tensors
         device = ctx.device
         target_dtype = getattr(ctx, "target_dtype", grad_out.dtype)
+        # stage it again instead of keeping the staging buffer alive until backward
+        weight_src = ctx.weight_stager if ctx.weight_stager is not None else (lambda: weight_cpu)
 
         if device.type != "cuda":
+            weight_src = weight_src()
             go_cpu = grad_out.to("cpu")
             x_cpu = x.to("cpu")
             w_mat = (
-                weight_cpu.dequantize()
-                if _is_quantized_tensor(weight_cpu)
-                else weight_cpu
+                weight_src.dequantize()
+                if _is_quantized_tensor(weight_src)
+                else weight_src
             )
             if w_mat.dtype != target_dtype and target_dtype in (
                 torch.bfloat16,
@@ -222,7 +390,7 @@ class _BouncingLinearFn(torch.autograd.Function):
                 if (bias_cpu is not None and getattr(bias_cpu, "requires_grad", False))
                 else None
             )
-            return grad_input.to(grad_out.device), grad_weight, grad_bias, None
+            return grad_input.to(grad_out.device), grad_weight, grad_bias, None, None, None
 
         state = _get_device_state(device)
         transfer_stream = state["transfer_stream"]
@@ -254,17 +422,27 @@ class _BouncingLinearFn(torch.autograd.Function):
             w = cpu_w.to(device, non_blocking=True)
             return w
 
-        with torch.cuda.stream(transfer_stream):
-            transfer_stream.wait_event(ev_cu_b_start)
-            w_bwd_buffers[idx] = _materialize_for_bwd(weight_cpu)
-            state["backward_clk"] ^= 1
-            ev_tx_b.record()
+        prefetcher = _get_prefetcher(ctx.layer)
+        prefetched = prefetcher.take(ctx.layer, target_dtype, -1) if prefetcher is not None else None
+        if prefetched is not None:
+            w_bwd = prefetched[0]
+        else:
+            with torch.cuda.stream(transfer_stream):
+                transfer_stream.wait_event(ev_cu_b_start)
+                w_bwd_buffers[idx] = _materialize_for_bwd(weight_src())
+                state["backward_clk"] ^= 1
+                ev_tx_b.record()
+            _record_transfer("h2d", weight_cpu)
+            torch.cuda.current_stream().wait_event(ev_tx_b)
+            w_bwd = w_bwd_buffers[idx]
+        if prefetcher is not None:
+            # backward runs the layers in reverse
+            prefetcher.prefetch_after(ctx.layer, -1, target_dtype)
 
-        torch.cuda.current_stream().wait_event(ev_tx_b)
         ev_cu_b_start.record()
 
         # grad wrt input (GPU)
-        grad_input = grad_out.to(dtype=target_dtype) @ w_bwd_buffers[idx]
+        grad_input = grad_out.to(dtype=target_dtype) @ w_bwd
 
         # ensure previous grad-to-CPU transfer that used this slot finished
         torch.cuda.current_stream().wait_event(ev_tx_w_bwd_done)
@@ -293,8 +471,9 @@ class _BouncingLinearFn(torch.autograd.Function):
             if bias_cpu is not None and getattr(bias_cpu, "requires_grad", False):
                 grad_bias = b_grad_buffers[idx].to("cpu", non_blocking=True)
             state["transfer_weight_backward_finished_event"].record()
+        _record_transfer("d2h", grad_weight, grad_bias)
 
-        return grad_input.to(dtype=grad_out.dtype), grad_weight, grad_bias, None
+        return grad_input.to(dtype=grad_out.dtype), grad_weight, grad_bias, None, None, None
 
 
 class _BouncingConv2dFn(torch.autograd.Function):
@@ -309,7 +488,11 @@ class _BouncingConv2dFn(torch.autograd.Function):
         padding: Tuple[int, int],
         dilation: Tuple[int, int],
         groups: int,
+        weight_stager=None,
+        layer: Optional["BaseLayerMemoryManager"] = None,
     ):
+        # weight_stager returns the weight in a staging buffer for disk offloaded weights
+        weight_src = weight_stager if weight_stager is not None else (lambda: weight_cpu)
         target_dtype = (
             x.dtype
             if x.dtype in (torch.bfloat16, torch.float16, torch.float32)
@@ -334,7 +517,7 @@ class _BouncingConv2dFn(torch.autograd.Function):
         if device.type != "cuda":
             out = F.conv2d(
                 x.to("cpu"),
-                _materialize_conv_weight(weight_cpu, torch.device("cpu")),
+                _materialize_conv_weight(weight_src(), torch.device("cpu")),
                 bias_cpu,
                 stride,
                 padding,
@@ -343,6 +526,7 @@ class _BouncingConv2dFn(torch.autograd.Function):
             )
             ctx.save_for_backward(x.to("cpu"), weight_cpu, bias_cpu)
             ctx.meta = ("cpu", stride, padding, dilation, groups, target_dtype)
+            ctx.weight_stager = weight_stager
             return out.to(x.device)
 
         state = _get_device_state(device)
@@ -352,37 +536,52 @@ class _BouncingConv2dFn(torch.autograd.Function):
         ev_cu_s = state["compute_forward_start_event"]
         idx = state["forward_clk"]
 
-        with torch.cuda.stream(ts):
-            ts.wait_event(ev_cu_s)
-            w_bufs[idx] = _materialize_conv_weight(weight_cpu, device)
-            b_bufs[idx] = (
-                bias_cpu.to(device, non_blocking=True) if bias_cpu is not None else None
-            )
-            state["forward_clk"] ^= 1
-            ev_tx_f.record()
+        prefetcher = _get_prefetcher(layer)
+        prefetched = prefetcher.take(layer, target_dtype, 1) if prefetcher is not None else None
+        if prefetched is not None:
+            w_gpu, b_gpu = prefetched
+        else:
+            with torch.cuda.stream(ts):
+                ts.wait_event(ev_cu_s)
+                w_bufs[idx] = _materialize_conv_weight(weight_src(), device)
+                b_bufs[idx] = (
+                    bias_cpu.to(device, non_blocking=True) if bias_cpu is not None else None
+                )
+                state["forward_clk"] ^= 1
+                ev_tx_f.record()
+            _record_transfer("h2d", weight_cpu, bias_cpu)
+            torch.cuda.current_stream().wait_event(ev_tx_f)
+            w_gpu, b_gpu = w_bufs[idx], b_bufs[idx]
+        if prefetcher is not None:
+            # start copying the next layers while this one computes
+            prefetcher.prefetch_after(layer, 1, target_dtype)
 
-        torch.cuda.current_stream().wait_event(ev_tx_f)
         ev_cu_s.record()
-        out = F.conv2d(x, w_bufs[idx], b_bufs[idx], stride, padding, dilation, groups)
+        out = F.conv2d(x, w_gpu, b_gpu, stride, padding, dilation, groups)
 
         ctx.save_for_backward(x, weight_cpu, bias_cpu)
         ctx.meta = (device, stride, padding, dilation, groups, target_dtype)
+        ctx.weight_stager = weight_stager
+        ctx.layer = layer
         return out
 
     @staticmethod
     def backward(ctx, grad_out):
         x, weight_cpu, bias_cpu = ctx.saved_tensors
         device, stride, padding, dilation, groups, target_dtype = ctx.meta
+        # stage it again instead of keeping the staging buffer alive until backward
+        weight_src = ctx.weight_stager if ctx.weight_stager is not None else (lambda: weight_cpu)
 
         if (
             isinstance(device, torch.device) and device.type != "cuda"
         ) or device == "cpu":
+            weight_src = weight_src()
             go = grad_out.to("cpu")
             x_cpu = x.to("cpu")
             w_cpu = (
-                weight_cpu.dequantize()
-                if _is_quantized_tensor(weight_cpu)
-                else weight_cpu
+                weight_src.dequantize()
+                if _is_quantized_tensor(weight_src)
+                else weight_src
             )
             if w_cpu.dtype != target_dtype and target_dtype in (
                 torch.bfloat16,
@@ -429,6 +628,8 @@ class _BouncingConv2dFn(torch.autograd.Function):
                 None,
                 None,
                 None,
+                None,
+                None,
             )
 
         state = _get_device_state(device)
@@ -462,20 +663,30 @@ class _BouncingConv2dFn(torch.autograd.Function):
             return w
 
         # Stage weights for input-grad compute
-        with torch.cuda.stream(transfer_stream):
-            transfer_stream.wait_event(ev_cu_b_start)
-            w_bwd_buffers[idx] = _materialize_for_bwd(weight_cpu)
-            state["backward_clk"] ^= 1
-            ev_tx_b.record()
+        prefetcher = _get_prefetcher(ctx.layer)
+        prefetched = prefetcher.take(ctx.layer, target_dtype, -1) if prefetcher is not None else None
+        if prefetched is not None:
+            w_bwd = prefetched[0]
+        else:
+            with torch.cuda.stream(transfer_stream):
+                transfer_stream.wait_event(ev_cu_b_start)
+                w_bwd_buffers[idx] = _materialize_for_bwd(weight_src())
+                state["backward_clk"] ^= 1
+                ev_tx_b.record()
+            _record_transfer("h2d", weight_cpu)
+            torch.cuda.current_stream().wait_event(ev_tx_b)
+            w_bwd = w_bwd_buffers[idx]
+        if prefetcher is not None:
+            # backward runs the layers in reverse
+            prefetcher.prefetch_after(ctx.layer, -1, target_dtype)
 
-        torch.cuda.current_stream().wait_event(ev_tx_b)
         ev_cu_b_start.record()
 
         from torch.nn.grad import conv2d_input, conv2d_weight  # type: ignore
 
         grad_input = conv2d_input(
             x.shape,
-            w_bwd_buffers[idx],
+            w_bwd,
             grad_out.to(dtype=target_dtype),
             stride=stride,
             padding=padding,
@@ -518,6 +729,7 @@ class _BouncingConv2dFn(torch.autograd.Function):
             if bias_cpu is not None and getattr(bias_cpu, "requires_grad", False):
                 grad_bias = b_grad_buffers[idx].to("cpu", non_blocking=True)
             state["transfer_weight_backward_finished_event"].record()
+        _record_transfer("d2h", grad_weight, grad_bias)
 
         return (
             grad_input.to(dtype=grad_out.dtype),
@@ -528,6 +740,7 @@ class _BouncingConv2dFn(torch.autograd.Function):
             None,
             None,
             None,
+            None,
         )
 
 
@@ -550,6 +763,33 @@ class BaseLayerMemoryManager:
         for param in module.parameters(recurse=False):
             param._is_memory_managed = True
 
+    def _offload_params(self):
+        # frozen weights go to the disk tier if the manager has one, everything else to pinned ram
+        self.disk_key = None
+        disk_store = self.manager.disk_store
+        if disk_store is not None and can_offload_to_disk(getattr(self.module, "weight", None)):
+            _move_params_to_cpu_and_pin(self.module, pin_weight=False)
+            self.disk_key = disk_store.add(self.module.weight)
+        else:
+            _move_params_to_cpu_and_pin(self.module)
+
+    def _stage_weight(self):
+        return self.manager.disk_store.get(self.disk_key)
+
+    def _weight_source(self) -> torch.Tensor:
+        # where the weight is copied to the gpu from, a staging buffer or the pinned weight
+        if self.disk_key is not None and self.manager.disk_store.is_offloaded(self.disk_key):
+            return self._stage_weight()
+        return self.module.weight
+
+    def _get_weight_stager(self, weight_cpu: torch.Tensor):
+        if self.disk_key is not None and self.manager.disk_store.is_offloaded(self.disk_key):
+            return self._stage_weight
+        self.manager.stats.record(
+            "ram", hit=True, num_bytes=weight_cpu.numel() * weight_cpu.element_size()
+        )
+        return None
+
 
 class LinearLayerMemoryManager(BaseLayerMemoryManager):
     def __init__(
@@ -559,8 +799,8 @@ class LinearLayerMemoryManager(BaseLayerMemoryManager):
     ):
         super().__init__(module, manager)
 
-        # 1) Move params to CPU + pin memory for fast H2D
-        _move_params_to_cpu_and_pin(self.module)
+        # 1) Move params to CPU + pin memory for fast H2D, or to the disk tier
+        self._offload_params()
 
         # 2) Hijack forward
         if hasattr(self.module, "ara_lora_ref"):
@@ -580,7 +820,9 @@ class LinearLayerMemoryManager(BaseLayerMemoryManager):
             device = self.manager.process_device
 
             # NOTE: do NOT move params to device here; autograd fn streams & bounces them
-            return _BouncingLinearFn.apply(x, weight_cpu, bias_cpu, device)
+            return _BouncingLinearFn.apply(
+                x, weight_cpu, bias_cpu, device, self._get_weight_stager(weight_cpu), self
+            )
 
         if hasattr(self.module, "ara_lora_ref"):
             self.module.ara_lora_ref().org_forward = _mm_forward
@@ -598,8 +840,8 @@ class ConvLayerMemoryManager(BaseLayerMemoryManager):
     ):
         super().__init__(module, manager)
 
-        # 1) Move params to CPU + pin memory for fast H2D
-        _move_params_to_cpu_and_pin(self.module)
+        # 1) Move params to CPU + pin memory for fast H2D, or to the disk tier
+        self._offload_params()
 
         # Cache static conv attributes from the module
         stride = (
@@ -636,7 +878,16 @@ class ConvLayerMemoryManager(BaseLayerMemoryManager):
             device = self.manager.process_device
 
             return _BouncingConv2dFn.apply(
-                x, weight_cpu, bias_cpu, device, stride, padding, dilation, groups
+                x,
+                weight_cpu,
+                bias_cpu,
+                device,
+                stride,
+                padding,
+                dilation,
+                groups,
+                self._get_weight_stager(weight_cpu),
+                self,
             )
 
         if hasattr(self.module, "ara_lora_ref"):
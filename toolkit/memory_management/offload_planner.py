@@ -0,0 +1,220 @@
+"""
+Decides which linear / conv layers layer offloading streams from cpu and which stay on the gpu.
+Streaming a layer costs a copy of its weights every forward and backward. That copy is hidden when
+the layer does a lot of compute per byte moved, so those are offloaded first and layers that do
+little work for their size (modulation and embedding layers that only see one vector per sample)
+stay resident. Compute is the flops per token of the layer shape times its token count, measured
+with measure_tokens_per_module or estimated from the layer name. Offload amounts are in weight bytes.
+"""
+
+import json
+import os
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+import torch
+import torch.nn as nn
+
+
+def get_module_bytes(module: nn.Module) -> int:
+    num_bytes = 0
+    for param in module.parameters(recurse=False):
+        num_bytes += param.numel() * param.element_size()
+    return num_bytes
+
+
+# token count assumed for layers that run on every image / text token when nothing was measured.
+# only the ratio to the one token layers matters for the ranking
+DEFAULT_CALIBRATION_TOKENS = 4096
+
+# name parts of layers that see one vector per sample (timestep, guidance, pooled text, modulation)
+PER_SAMPLE_NAME_PARTS = [
+    "modulation", "adaln", "time", "t_embedder", "guidance", "vector_in", "pooled",
+]
+
+
+def estimate_flops_per_token(module: nn.Module) -> int:
+    # a linear does a multiply and an add per weight per token, a conv the same per output pixel
+    weight = getattr(module, "weight", None)
+    if weight is None:
+        return 0
+    return 2 * weight.numel()
+
+
+def estimate_tokens(name: str, calibration_tokens: int = DEFAULT_CALIBRATION_TOKENS) -> int:
+    # structural guess for when there is no calibration pass
+    for part in name.lower().split("."):
+        if any(p in part for p in PER_SAMPLE_NAME_PARTS):
+            return 1
+        # img_mod / txt_mod, and the linears inside ada layer norms (norm1.linear, norm_out.linear)
+        if part.endswith("_mod") or part.startswith("norm"):
+            return 1
+    return calibration_tokens
+
+
+def measure_tokens_per_module(model: nn.Module, fn: Callable[[], object]) -> Dict[str, int]:
+    """
+    Calibration pass. Runs fn once with hooks on every linear and conv in model and returns how many
+    tokens (or output pixels for convs) each one processed, keyed by module name. Pass it to
+    plan_layer_offloading to plan with measured flops instead of the estimate from the layer names.
+    """
+    tokens: Dict[str, int] = OrderedDict()
+    handles = []
+
+    def _get_hook(name: str, is_conv: bool):
+        def _hook(module, inputs, output):
+            if is_conv:
+                count = output.numel() // output.shape[1]
+            else:
+                count = inputs[0].numel() // inputs[0].shape[-1]
+            tokens[name] = tokens.get(name, 0) + count
+        return _hook
+
+    for name, module in model.named_modules():
+        if isinstance(module, nn.Linear):
+            handles.append(module.register_forward_hook(_get_hook(name, False)))
+        elif isinstance(module, nn.Conv2d):
+            handles.append(module.register_forward_hook(_get_hook(name, True)))
+    try:
+        with torch.no_grad():
+            fn()
+    finally:
+        for handle in handles:
+            handle.remove()
+    return tokens
+
+
+class OffloadPlan:
+    def __init__(
+        self,
+        entries: List[dict],
+        modules: Dict[str, nn.Module],
+        offload_percent: float = 1.0,
+        vram_budget_bytes: Optional[int] = None,
+    ):
+        # one entry per candidate layer, in module order
+        self.entries = entries
+        # not saved, only to see what is trainable. that is decided after the layers are attached
+        self._modules = modules
+        self.offload_percent = offload_percent
+        self.vram_budget_bytes = vram_budget_bytes
+
+    @property
+    def offloaded_names(self) -> List[str]:
+        return [e["name"] for e in self.entries if e["offload"]]
+
+    @property
+    def offloaded_bytes(self) -> int:
+        return sum(e["bytes"] for e in self.entries if e["offload"])
+
+    @property
+    def resident_bytes(self) -> int:
+        return sum(e["bytes"] for e in self.entries if not e["offload"])
+
+    def _is_trainable(self, name: str) -> bool:
+        weight = getattr(self._modules[name], "weight", None)
+        return weight is not None and weight.requires_grad
+
+    def transfer_bytes_per_step(self, train: bool = True) -> int:
+        # forward copies every offloaded layer to the gpu, backward copies it again and sends
+        # the grads of trainable layers back
+        num_bytes = self.offloaded_bytes
+        if train:
+            num_bytes += self.offloaded_bytes
+            num_bytes += sum(
+                e["bytes"] for e in self.entries if e["offload"] and self._is_trainable(e["name"])
+            )
+        return num_bytes
+
+    def summary(self) -> str:
+        num_offloaded = len(self.offloaded_names)
+        return (
+            f"offloading {num_offloaded}/{len(self.entries)} layers, "
+            f"{self.offloaded_bytes / 1024 ** 3:.2f} GB offloaded, "
+            f"{self.resident_bytes / 1024 ** 3:.2f} GB resident, "
+            f"~{self.transfer_bytes_per_step() / 1024 ** 3:.2f} GB transferred per training step"
+        )
+
+    def to_dict(self) -> dict:
+        return OrderedDict([
+            ("offload_percent", self.offload_percent),
+            ("vram_budget_bytes", self.vram_budget_bytes),
+            ("offloaded_bytes", self.offloaded_bytes),
+            ("resident_bytes", self.resident_bytes),
+            ("transfer_bytes_per_step", self.transfer_bytes_per_step()),
+            ("layers", [
+                OrderedDict([*e.items(), ("trainable", self._is_trainable(e["name"]))])
+                for e in self.entries
+            ]),
+        ])
+
+
+def plan_layer_offloading(
+    named_modules: List[Tuple[str, nn.Module]],
+    offload_percent: float = 1.0,
+    vram_budget_bytes: Optional[int] = None,
+    tokens_per_module: Optional[Dict[str, int]] = None,
+    calibration_tokens: int = DEFAULT_CALIBRATION_TOKENS,
+) -> OffloadPlan:
+    """
+    Builds the plan for the given candidate layers. With vram_budget_bytes, layers are offloaded
+    until the ones left resident fit in it, otherwise offload_percent of the weight bytes are
+    offloaded, most flops per byte first. tokens_per_module comes from measure_tokens_per_module,
+    layers missing from it get the estimate from estimate_tokens.
+    """
+    entries = []
+    for name, module in named_modules:
+        num_bytes = get_module_bytes(module)
+        if tokens_per_module is not None and name in tokens_per_module:
+            tokens = tokens_per_module[name]
+        else:
+            tokens = estimate_tokens(name, calibration_tokens)
+        flops = estimate_flops_per_token(module) * tokens
+        entries.append(OrderedDict([
+            ("name", name),
+            ("bytes", num_bytes),
+            ("tokens", tokens),
+            ("flops_per_byte", flops / num_bytes if num_bytes > 0 else 0.0),
+            ("offload", False),
+        ]))
+
+    total_bytes = sum(e["bytes"] for e in entries)
+    if vram_budget_bytes is not None:
+        bytes_to_offload = max(0, total_bytes - vram_budget_bytes)
+    elif offload_percent >= 1.0:
+        bytes_to_offload = float("inf")
+    else:
+        bytes_to_offload = total_bytes * offload_percent
+
+    # most compute per byte moved first, size breaks ties (then name, so they never depend on luck)
+    order = sorted(
+        entries, key=lambda e: (-e["flops_per_byte"], -e["bytes"], e["name"])
+    )
+    offloaded_bytes = 0
+    for entry in order:
+        if offloaded_bytes >= bytes_to_offload:
+            break
+        entry["offload"] = True
+        offloaded_bytes += entry["bytes"]
+
+    return OffloadPlan(
+        entries,
+        OrderedDict(named_modules),
+        offload_percent=offload_percent,
+        vram_budget_bytes=vram_budget_bytes,
+    )
+
+
+def save_offload_plans(modules: Dict[str, Optional[nn.Module]], path: str) -> Dict[str, OffloadPlan]:
+    # writes the plans of every layer offloaded module to one json file, returns the ones found
+    plans = OrderedDict()
+    for name, module in modules.items():
+        manager = getattr(module, "_memory_manager", None)
+        if manager is not None and manager.plan is not None:
+            plans[name] = manager.plan
+    if len(plans) == 0:
+        return plans
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump({name: plan.to_dict() for name, plan in plans.items()}, f, indent=2)
+    return plans
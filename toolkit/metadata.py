@@ -1,13 +1,62 @@
+import hashlib
 import json
 from collections import OrderedDict
-from io import BytesIO
 
-import safetensors
+import torch
 from safetensors import safe_open
 
 from info import software_meta
-from toolkit.train_tools import addnet_hash_legacy
-from toolkit.train_tools import addnet_hash_safetensors
+
+# safetensors writes tensors sorted by dtype (descending, in the order of its
+# Dtype enum) and then by name. We mirror that here so the model hashes can be
+# computed straight from the state dict without serializing the whole file.
+_SAFETENSORS_DTYPE_ORDER = [
+    "BOOL", "U8", "I8", "F8_E5M2", "F8_E4M3", "I16", "U16", "F16", "BF16", "I32", "U32", "F32", "F64", "I64", "U64"
+]
+
+_SAFETENSORS_DTYPES = {
+    torch.bool: "BOOL",
+    torch.uint8: "U8",
+    torch.int8: "I8",
+    torch.int16: "I16",
+    torch.float16: "F16",
+    torch.bfloat16: "BF16",
+    torch.int32: "I32",
+    torch.float32: "F32",
+    torch.float64: "F64",
+    torch.int64: "I64",
+}
+if hasattr(torch, "float8_e5m2"):
+    _SAFETENSORS_DTYPES[torch.float8_e5m2] = "F8_E5M2"
+if hasattr(torch, "float8_e4m3fn"):
+    _SAFETENSORS_DTYPES[torch.float8_e4m3fn] = "F8_E4M3"
+
+# legacy addnet hash is a sha256 of 64KB of the file starting at 1MB
+_LEGACY_HASH_START = 0x100000
+_LEGACY_HASH_END = 0x100000 + 0x10000
+
+
+class _AddnetHasher:
+    """Feeds the bytes of a (virtual) safetensors file through both addnet hashes
+    sequentially, so no copy of the full file ever has to exist in memory."""
+
+    def __init__(self, header_size: int):
+        self.header_size = header_size
+        self.position = 0
+        self.model_hash = hashlib.sha256()
+        self.legacy_hash = hashlib.sha256()
+
+    def update(self, chunk: memoryview):
+        start = self.position
+        end = start + len(chunk)
+        # new hash only covers the tensor data after the header
+        if end > self.header_size:
+            self.model_hash.update(chunk[max(self.header_size - start, 0):])
+        legacy_start = max(_LEGACY_HASH_START, start)
+        legacy_end = min(_LEGACY_HASH_END, end)
+        if legacy_start < legacy_end:
+            self.legacy_hash.update(chunk[legacy_start - start:legacy_end - start])
+        self.position = end
 
 
 def get_meta_for_safetensors(meta: OrderedDict, name=None, add_software_info=True) -> OrderedDict:
@@ -37,13 +86,41 @@ def add_model_hash_to_meta(state_dict, meta: OrderedDict) -> OrderedDict:
     # calculating the hash, as they are meant to be immutable
     metadata = {k: v for k, v in meta.items() if k.startswith("ss_")}
 
-    bytes = safetensors.torch.save(state_dict, metadata)
-    b = BytesIO(bytes)
-
-    model_hash = addnet_hash_safetensors(b)
-    legacy_hash = addnet_hash_legacy(b)
-    meta["sshs_model_hash"] = model_hash
-    meta["sshs_legacy_hash"] = legacy_hash
+    # hash the file safetensors would write, one tensor at a time, instead of
+    # serializing the whole state dict into memory first
+    ordered_keys = sorted(
+        state_dict.keys(),
+        key=lambda k: (-_SAFETENSORS_DTYPE_ORDER.index(_SAFETENSORS_DTYPES[state_dict[k].dtype]), k)
+    )
+
+    header = OrderedDict()
+    header["__metadata__"] = metadata
+    offset = 0
+    for key in ordered_keys:
+        tensor = state_dict[key]
+        num_bytes = tensor.numel() * tensor.element_size()
+        header[key] = {
+            "dtype": _SAFETENSORS_DTYPES[tensor.dtype],
+            "shape": list(tensor.shape),
+            "data_offsets": [offset, offset + num_bytes],
+        }
+        offset += num_bytes
+    header_bytes = json.dumps(header, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+    # safetensors pads the header with spaces to an 8 byte boundary
+    header_bytes += b" " * ((8 - len(header_bytes) % 8) % 8)
+
+    hasher = _AddnetHasher(header_size=8 + len(header_bytes))
+    hasher.update(memoryview(len(header_bytes).to_bytes(8, "little")))
+    hasher.update(memoryview(header_bytes))
+    for key in ordered_keys:
+        tensor = state_dict[key].detach().contiguous().to("cpu")
+        if tensor.numel() == 0:
+            continue
+        hasher.update(memoryview(tensor.reshape(-1).view(torch.uint8).numpy()))
+        del tensor
+
+    meta["sshs_model_hash"] = hasher.model_hash.hexdigest()
+    meta["sshs_legacy_hash"] = hasher.legacy_hash.hexdigest()[0:8]
     return meta
 
 
@@ -89,12 +89,16 @@ class DoRAModule(ToolkitModuleMixin, ExtractableModuleMixin, torch.nn.Module):
         # self.lora_down.weight.data = torch.zeros_like(self.lora_down.weight.data)
         self.lora_down.weight.data = torch.randn_like(self.lora_down.weight.data) * std_dev
 
+        # the frozen weight's row norms, so the norm of the adapted weight can be computed from low rank
+        # terms. (key, tensor), rebuilt when the key changes
+        self._row_norm_sq_cache = None
+
         # m = Magnitude column-wise across output dimension
-        weight = self.get_orig_weight()
-        weight = weight.to(self.lora_up.weight.device, dtype=self.lora_up.weight.dtype)
-        lora_weight  = self.lora_up.weight @ self.lora_down.weight
-        weight_norm = self._get_weight_norm(weight, lora_weight)
-        self.magnitude = nn.Parameter(weight_norm.detach().clone(), requires_grad=True)
+        # lora_up starts at zero, so this is the norm of the original weight
+        weight_norm = self._get_orig_row_norm_sq(self.lora_up.weight.device).sqrt()
+        self.magnitude = nn.Parameter(
+            weight_norm.to(dtype=self.lora_up.weight.dtype).detach().clone(), requires_grad=True
+        )
 
     def apply_to(self):
         self.org_forward = self.org_module[0].forward
@@ -121,26 +125,71 @@ class DoRAModule(ToolkitModuleMixin, ExtractableModuleMixin, torch.nn.Module):
     #     calc_weights = self.magnitude * norm_adapted
     #     return F.linear(x, calc_weights, self.get_orig_bias())
 
-    def _get_weight_norm(self, weight, scaled_lora_weight) -> torch.Tensor:
-        # calculate L2 norm of weight matrix, column-wise
-        weight = weight + scaled_lora_weight.to(weight.device)
-        weight_norm = torch.linalg.norm(weight, dim=1)
-        return weight_norm
+    def clear_norm_cache(self):
+        # forces the cached norms to be rebuilt on the next forward
+        self._row_norm_sq_cache = None
 
-    def apply_dora(self, x, scaled_lora_weight):
+    def _get_orig_weight_key(self):
+        # changes when the base weight is replaced or updated in place (merges, requantizing)
+        weight = self.org_module[0].weight
+        return id(weight), getattr(weight, '_version', 0)
+
+    def _get_orig_row_norm_sq(self, device) -> torch.Tensor:
+        key = self._get_orig_weight_key()
+        if self._row_norm_sq_cache is None or self._row_norm_sq_cache[0] != key:
+            with torch.no_grad():
+                weight = self.get_orig_weight()
+                row_norm_sq = torch.cat([w.float().pow(2).sum(dim=1) for w in weight.split(4096)])
+            self._row_norm_sq_cache = (key, row_norm_sq)
+        row_norm_sq = self._row_norm_sq_cache[1]
+        if row_norm_sq.device != device:
+            row_norm_sq = row_norm_sq.to(device)
+            self._row_norm_sq_cache = (key, row_norm_sq)
+        return row_norm_sq
+
+    def _get_orig_projection(self, dtype) -> torch.Tensor:
+        # V A^T [out, rank]. goes through the base layer so quantized or offloaded weights are never
+        # rebuilt. recomputed every forward, it is only rank rows through the layer. optimizers that write
+        # lora_down through .data or a kernel (8bit, bitsandbytes) do not bump _version, so it can not be cached
+        down = self.lora_down.weight
+        with torch.no_grad():
+            projection = self.org_forward(down.detach().to(dtype))
+            bias = self.get_orig_bias()
+            if bias is not None:
+                projection = projection - bias.to(projection.device, dtype=projection.dtype)
+        return projection.t().float()
+
+    @torch.no_grad()
+    def _get_weight_norm(self, scale, dtype) -> torch.Tensor:
+        # row wise L2 norm of V + s * B A without building it
+        # ||v_i||^2 + 2s (B_i . (V A^T)_i) + s^2 ||B_i A||^2
+        up = self.lora_up.weight.float()
+        down = self.lora_down.weight.float()
+        row_norm_sq = self._get_orig_row_norm_sq(up.device)
+        projection = self._get_orig_projection(dtype).to(up.device)
+        lora_norm_sq = ((up @ (down @ down.t())) * up).sum(dim=1)
+        cross = (up * projection).sum(dim=1)
+        norm_sq = row_norm_sq + 2 * scale * cross + scale ** 2 * lora_norm_sq
+        return norm_sq.clamp_min(0).sqrt()
+
+    def apply_dora(self, x, scale, base_output=None):
         # ref https://github.com/huggingface/peft/blob/1e6d1d73a0850223b0916052fd8d2382a90eae5a/src/peft/tuners/lora/layer.py#L192
-        # lora weight is already scaled
+        # scale is the multiplier, the lora weight is lora_up @ lora_down * scale
 
-        # magnitude = self.lora_magnitude_vector[active_adapter]
-        weight = self.get_orig_weight()
-        weight = weight.to(scaled_lora_weight.device, dtype=scaled_lora_weight.dtype)
-        weight_norm = self._get_weight_norm(weight, scaled_lora_weight)
         # see section 4.3 of DoRA (https://arxiv.org/abs/2402.09353)
         # "[...] we suggest treating ||V +∆V ||_c in
         # Eq. (5) as a constant, thereby detaching it from the gradient
         # graph. This means that while ||V + ∆V ||_c dynamically
         # reflects the updates of ∆V , it won’t receive any gradient
         # during backpropagation"
-        weight_norm = weight_norm.detach()
-        dora_weight = transpose(weight + scaled_lora_weight, False)
-        return (self.magnitude / weight_norm - 1).view(1, -1) * F.linear(x.to(dora_weight.dtype), dora_weight)
+        weight_norm = self._get_weight_norm(scale, x.dtype)
+
+        # x (V + ∆V)^T, the base layer output without its bias plus the low rank part
+        if base_output is None:
+            base_output = self.org_forward(x)
+        bias = self.get_orig_bias()
+        if bias is not None:
+            base_output = base_output - bias.to(base_output.device, dtype=base_output.dtype)
+        lora_output = F.linear(F.linear(x.to(self.lora_down.weight.dtype), self.lora_down.weight), self.lora_up.weight)
+        dora_output = base_output + lora_output * scale
+        return (self.magnitude / weight_norm - 1).view(1, -1) * dora_output
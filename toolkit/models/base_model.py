@@ -18,12 +18,14 @@ from torchvision.transforms import Resize, transforms
 
 from toolkit.clip_vision_adapter import ClipVisionAdapter
 from toolkit.custom_adapter import CustomAdapter
+from toolkit.fused_lora import fuse_lora_networks, unfuse_lora_networks
 from toolkit.ip_adapter import IPAdapter
 from toolkit.config_modules import ModelConfig, GenerateImageConfig, ModelArch
 from toolkit.models.decorator import Decorator
 from toolkit.paths import KEYMAPS_ROOT
 from toolkit.prompt_utils import inject_trigger_into_prompt, PromptEmbeds, concat_prompt_embeds
 from toolkit.reference_adapter import ReferenceAdapter
+from toolkit.sample_batcher import SampleBatcher
 from toolkit.sd_device_states_presets import empty_preset
 from toolkit.train_tools import get_torch_dtype, apply_noise_offset
 import torch
@@ -187,6 +189,8 @@ class BaseModel:
         self.use_raw_control_images = False
         # defines if the model supports model paths. Only some will
         self.supports_model_paths = False
+        # set true for models that implement generate_batch_images
+        self.supports_batched_sampling = False
         
         # use new lokr format (default false for old models for backwards compatibility)
         self.use_old_lokr_format = True
@@ -295,6 +299,20 @@ class BaseModel:
         raise NotImplementedError(
             "generate_single_image must be implemented in child classes")
 
+    def generate_batch_images(
+        self,
+        pipeline,
+        gen_configs: List[GenerateImageConfig],
+        conditional_embeds: PromptEmbeds,
+        unconditional_embeds: PromptEmbeds,
+        generators: List[torch.Generator],
+        extra: dict,
+    ) -> list:
+        # override this in child classes that set supports_batched_sampling. The embeds are
+        # batched and all gen_configs share resolution, steps and guidance. Return one image per config
+        raise NotImplementedError(
+            "generate_batch_images must be implemented in child classes")
+
     def get_noise_prediction(
         latent_model_input: torch.Tensor,
         timestep: torch.Tensor,  # 0 to 1000 scale
@@ -368,6 +386,7 @@ class BaseModel:
             sampler=None,
             pipeline: Union[None, StableDiffusionPipeline,
                             StableDiffusionXLPipeline] = None,
+            batch_size: int = 1,
     ):
         network = self.network
         merge_multiplier = 1.0
@@ -399,10 +418,20 @@ class BaseModel:
             if len(unique_network_weights) == 1 and network.can_merge_in:
                 can_merge_in = True
                 merge_multiplier = unique_network_weights.pop()
-                network.merge_in(merge_weight=merge_multiplier)
+                network.fast_merge_in(merge_weight=merge_multiplier)
         else:
             network = BlankNetwork()
 
+        fused_loras = []
+        if self.model_config.fuse_sampling_loras:
+            stacked_networks = []
+            if self.assistant_lora is not None and self.assistant_lora.is_active:
+                stacked_networks.append(self.assistant_lora)
+            if self.network is not None and not network.is_merged_in:
+                stacked_networks.append(network)
+            if len(stacked_networks) > 1:
+                fused_loras = fuse_lora_networks(stacked_networks)
+
         self.save_device_state()
         self.set_device_state_preset('generate')
 
@@ -423,6 +452,31 @@ class BaseModel:
 
         # pipeline.to(self.device_torch)
 
+        # batch samples that share settings into a single pipeline call when the model supports it
+        batcher = None
+        if batch_size > 1 and self.supports_batched_sampling and self.adapter is None \
+                and self.refiner_unet is None:
+            def generate_batch(indexes, gen_configs, conditional_embeds, unconditional_embeds, generators):
+                # the loop may have moved on to the next sample already
+                current_multiplier = network.multiplier
+                network.multiplier = gen_configs[0].network_multiplier
+                imgs = self.generate_batch_images(
+                    pipeline,
+                    gen_configs,
+                    conditional_embeds,
+                    unconditional_embeds,
+                    generators,
+                    {},
+                )
+                for idx, batch_gen_config, img in zip(indexes, gen_configs, imgs):
+                    batch_gen_config.save_image(img, idx)
+                    batch_gen_config.log_image(img, idx)
+                    self._after_sample_image(idx, len(image_configs))
+                network.multiplier = current_multiplier
+                flush()
+
+            batcher = SampleBatcher(batch_size, generate_batch)
+
         with network:
             with torch.no_grad():
                 if network is not None:
@@ -651,6 +705,9 @@ class BaseModel:
                     unconditional_embeds = unconditional_embeds.to(
                         self.device_torch, dtype=self.unet.dtype)
 
+                    if batcher is not None and batcher.add(i, gen_config, conditional_embeds, unconditional_embeds):
+                        continue
+
                     img = self.generate_single_image(
                         pipeline,
                         gen_config,
@@ -665,6 +722,9 @@ class BaseModel:
                     self._after_sample_image(i, len(image_configs))
                     flush()
 
+                if batcher is not None:
+                    batcher.flush()
+
                 if self.adapter is not None and isinstance(self.adapter, ReferenceAdapter):
                     self.adapter.clear_memory()
 
@@ -683,8 +743,9 @@ class BaseModel:
             network.multiplier = start_multiplier
 
         self.unet.to(self.device_torch, dtype=self.torch_dtype)
+        unfuse_lora_networks(fused_loras)
         if network.is_merged_in:
-            network.merge_out(merge_multiplier)
+            network.fast_merge_out()
         # self.tokenizer.to(original_device_dict['tokenizer'])
 
         # refuse loras
@@ -1588,6 +1649,22 @@ class BaseModel:
     def get_transformer_block_names(self) -> Optional[List[str]]:
         # override in child classes to get transformer block names for lora targeting
         return None
+
+    def get_layer_offloading_kwargs(self) -> dict:
+        # extra MemoryManager.attach kwargs for the transformer, planning, prefetching and the disk tier
+        kwargs = {
+            "prefetch_layers": self.model_config.layer_offloading_prefetch_layers,
+            "prefetch_budget_bytes": int(self.model_config.layer_offloading_prefetch_budget_gb * 1024 ** 3),
+        }
+        if self.model_config.layer_offloading_transformer_vram_budget_gb is not None:
+            kwargs["vram_budget_bytes"] = int(
+                self.model_config.layer_offloading_transformer_vram_budget_gb * 1024 ** 3
+            )
+        if self.model_config.layer_offloading_disk_dir is not None:
+            kwargs["disk_dir"] = self.model_config.layer_offloading_disk_dir
+            kwargs["disk_staging_bytes"] = int(self.model_config.layer_offloading_disk_staging_gb * 1024 ** 3)
+            kwargs["disk_prefetch"] = self.model_config.layer_offloading_disk_prefetch
+        return kwargs
     
     def get_base_model_version(self) -> str:
         # override in child classes to get the base model version
@@ -10,8 +10,6 @@ from toolkit.network_mixins import ToolkitModuleMixin
 
 from typing import TYPE_CHECKING, Union, List
 
-from optimum.quanto import QBytesTensor, QTensor
-from torchao.dtypes import AffineQuantizedTensor
 
 if TYPE_CHECKING:
 
@@ -250,92 +248,63 @@ class LokrModule(ToolkitModuleMixin, nn.Module):
         return weight
 
     @torch.no_grad()
-    def merge_in(self, merge_weight=1.0):
-        if not self.can_merge_in:
-            return
-
-        # extract weight from org_module
-        org_sd = self.org_module[0].state_dict()
-        # todo find a way to merge in weights when doing quantized model
-        if 'weight._data' in org_sd:
-            # quantized weight
-            return
-
-        weight_key = "weight"
-        if 'weight._data' in org_sd:
-            # quantized weight
-            weight_key = "weight._data"
-
-        orig_dtype = org_sd[weight_key].dtype
-        weight = org_sd[weight_key].float()
-
-        scale = self.scale
-        # handle trainable scaler method locon does
-        if hasattr(self, 'scalar'):
-            scale = scale * self.scalar
-
-        lokr_weight = self.get_weight(weight)
-
-        merged_weight = (
-            weight
-            + (lokr_weight * merge_weight).to(weight.device, dtype=weight.dtype)
-        )
+    def get_merge_delta(self, weight):
+        # the kron weight already has the scale in it
+        return self.get_weight(weight).float()
+
+    def _get_w1(self):
+        return self.lokr_w1 if self.use_w1 else self.lokr_w1_a @ self.lokr_w1_b
 
-        # set weight to org_module
-        org_sd[weight_key] = merged_weight.to(orig_dtype)
-        self.org_module[0].load_state_dict(org_sd)
-
-    def get_orig_weight(self, device):
-        weight = self.org_module[0].weight
-        if weight.device != device:
-            weight = weight.to(device)
-        if isinstance(weight, QTensor) or isinstance(weight, QBytesTensor):
-            return weight.dequantize().data.detach()
-        elif isinstance(weight, AffineQuantizedTensor):
-            return weight.dequantize().data.detach()
+    def _get_w2(self):
+        if self.use_w2:
+            return self.lokr_w2
+        if self.cp:
+            return make_weight_cp(self.lokr_t2, self.lokr_w2_a, self.lokr_w2_b)
+        return self.lokr_w2_a @ self.lokr_w2_b
+
+    def _linear_forward(self, x):
+        # (w1 ⊗ w2) x == w1 X w2^T with x reshaped to X [in_m, in_n], so the full weight is never built
+        w1 = self._get_w1()
+        in_m = w1.shape[1]
+        h = x.reshape(*x.shape[:-1], in_m, x.shape[-1] // in_m)
+        if self.use_w2:
+            h = h @ self.lokr_w2.t()
         else:
-            return weight.data.detach()
-
-    def get_orig_bias(self, device):
-        if hasattr(self.org_module[0], 'bias') and self.org_module[0].bias is not None:
-            bias = self.org_module[0].bias
-            if bias.device != device:
-                bias = bias.to(device)
-            if isinstance(bias, QTensor) or isinstance(bias, QBytesTensor):
-                return bias.dequantize().data.detach()
-            elif isinstance(bias, AffineQuantizedTensor):
-                return bias.dequantize().data.detach()
-            else:
-                return self.org_module[0].bias.data.detach()
-        return None
+            # low rank w2, go through the rank instead of building it
+            h = (h @ self.lokr_w2_b.t()) @ self.lokr_w2_a.t()
+        h = w1 @ h
+        return h.reshape(*x.shape[:-1], h.shape[-2] * h.shape[-1])
+
+    def _conv_forward(self, x):
+        w1 = self._get_w1()
+        out_l, in_m = w1.shape
+        w2 = self._get_w2()
+        batch_size, in_dim = x.shape[:2]
+        in_n = in_dim // in_m
+        w2 = w2.reshape(w2.shape[0], in_n, *self.shape[2:])
+        # run w2 over each of the in_m channel groups as its own batch item, then mix the groups with w1
+        h = self.op(x.reshape(batch_size * in_m, in_n, *x.shape[2:]), w2, None, **self.extra_args)
+        h = h.reshape(batch_size, in_m, *h.shape[1:])
+        h = torch.einsum('ij,nj...->ni...', w1, h)
+        return h.reshape(batch_size, out_l * h.shape[2], *h.shape[3:])
 
     def _call_forward(self, x):
-        if isinstance(x, QTensor) or isinstance(x, QBytesTensor):
-            x = x.dequantize()
-
-        orig_dtype = x.dtype
-
-        orig_weight = self.get_orig_weight(x.device)
-        lokr_weight = self.get_weight(orig_weight).to(dtype=orig_weight.dtype)
-        multiplier = self.network_ref().torch_multiplier
-
-        if x.dtype != orig_weight.dtype:
-            x = x.to(dtype=orig_weight.dtype)
-
-        # we do not currently support split batch multipliers for lokr. Just do a mean
-        multiplier = torch.mean(multiplier)
+        # only the lokr part, the original module runs unmodified and the mixin applies the
+        # (per sample) multiplier like it does for lora
+        if self.op == F.linear:
+            output = self._linear_forward(x)
+        elif self.extra_args["groups"] == 1:
+            output = self._conv_forward(x)
+        else:
+            # grouped conv does not factor per group, build the weight
+            output = self.op(x, self.get_weight().view(self.shape), None, **self.extra_args)
+            return output
 
-        weight = (
-            orig_weight
-            + lokr_weight * multiplier
-        )
-        bias = self.get_orig_bias(x.device)
-        if bias is not None:
-            bias = bias.to(weight.device, dtype=weight.dtype)
-        output = self.op(
-            x,
-            weight.view(self.shape),
-            bias,
-            **self.extra_args
-        )
-        return output.to(orig_dtype)
+        if self.training and self.rank_dropout:
+            # same as the output channel mask get_weight applies to the weight
+            drop = torch.rand(output.size(-1 if self.op == F.linear else 1)) < self.rank_dropout
+            drop = drop.to(output.device, dtype=output.dtype)
+            if self.op != F.linear:
+                drop = drop.view(-1, *[1] * (output.dim() - 2))
+            output = output * drop
+        return output * self.scale
@@ -381,7 +381,8 @@ class Wan21(BaseModel):
             MemoryManager.attach(
                 transformer,
                 self.device_torch,
-                offload_percent=self.model_config.layer_offloading_transformer_percent
+                offload_percent=self.model_config.layer_offloading_transformer_percent,
+                **self.get_layer_offloading_kwargs(),
             )
         
         if self.model_config.low_vram:
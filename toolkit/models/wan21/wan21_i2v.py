@@ -347,6 +347,7 @@ class Wan21I2V(Wan21):
             image_configs,
             sampler=None,
             pipeline=None,
+            batch_size=1,
     ):
         # will oom on 24gb vram if we dont unload vision encoder first
         if self.model_config.low_vram:
@@ -359,6 +360,7 @@ class Wan21I2V(Wan21):
             image_configs,
             sampler=sampler,
             pipeline=pipeline,
+            batch_size=batch_size,
         )
     
     def set_device_state_preset(self, *args, **kwargs):
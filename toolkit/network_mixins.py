@@ -1,20 +1,22 @@
-import json
 import os
 from collections import OrderedDict
 from typing import Optional, Union, List, Type, TYPE_CHECKING, Dict, Any, Literal
 
 import torch
 from optimum.quanto import QTensor
+from optimum.quanto.nn import QModuleMixin
 from torch import nn
 import weakref
 
 from tqdm import tqdm
 
 from toolkit.config_modules import NetworkConfig
+from toolkit.delta_checkpoint import is_delta_checkpoint, load_delta_checkpoint, make_delta_state_dict, \
+    DELTA_PARENT_META_KEY, DELTA_FORMAT_META_KEY
 from toolkit.lorm import extract_conv, extract_linear, count_parameters
 from toolkit.metadata import add_model_hash_to_meta
 from toolkit.paths import KEYMAPS_ROOT
-from toolkit.saving import get_lora_keymap_from_model_keymap
+from toolkit.saving import get_compiled_keymap
 from optimum.quanto import QBytesTensor
 
 if TYPE_CHECKING:
@@ -177,6 +179,15 @@ class ToolkitModuleMixin:
         self.network_ref: weakref.ref = weakref.ref(network)
         self.is_checkpointing = False
         self._multiplier: Union[float, list, torch.Tensor] = None
+        # set when this module's weights are merged into org_module
+        self.is_weight_merged = False
+        # original org_module weight while fast merged, in a list so torch does not register it
+        self._merge_backup: Optional[list] = None
+        # multiplier used by fast_merge_in, to subtract the same delta on fast_merge_out
+        self._merge_weight: Optional[float] = None
+        # reused pinned cpu buffer for exact restores, and the event of the last async restore copy
+        self._merge_buffer: Optional[list] = None
+        self._merge_event = None
 
     def _call_forward(self: Module, x):
         # module dropout
@@ -262,12 +273,17 @@ class ToolkitModuleMixin:
             # we are doing lorm
             return self.lorm_forward(x, *args, **kwargs)
 
+        # the weight was restored with an async copy, order whatever stream we run on after it
+        if self._merge_event is not None and x.is_cuda:
+            torch.cuda.current_stream(x.device).wait_event(self._merge_event)
+            self._merge_event = None
+
         # skip if not active
         if not network.is_active:
             skip = True
 
-        # skip if is merged in
-        if network.is_merged_in:
+        # skip if is merged in. modules that could not be merged keep running
+        if network.is_merged_in and self.is_weight_merged:
             skip = True
 
         # skip if multiplier is 0
@@ -282,15 +298,17 @@ class ToolkitModuleMixin:
         #     # return dora forward
         #     return self.dora_forward(x, *args, **kwargs)
         
-        if self.__class__.__name__ == "LokrModule":
-            return self._call_forward(x)
-
         org_forwarded = self.org_forward(x, *args, **kwargs)
 
         if isinstance(x, QTensor):
             x = x.dequantize()
+        if self.__class__.__name__ == "LokrModule":
+            # lokr applies its kronecker factors to the input, there is no lora_down
+            lora_dtype = (self.lokr_w1 if self.use_w1 else self.lokr_w1_a).dtype
+        else:
+            lora_dtype = self.lora_down.weight.dtype
         # always cast to float32
-        lora_input = x.to(self.lora_down.weight.dtype)
+        lora_input = x.to(lora_dtype)
         lora_output = self._call_forward(lora_input)
         multiplier = self.network_ref().torch_multiplier
 
@@ -315,12 +333,11 @@ class ToolkitModuleMixin:
                 lx = torch.nn.functional.dropout(x, p=self.dropout)
             else:
                 lx = x
-            lora_weight = self.lora_up.weight @ self.lora_down.weight
-            # scale it here
             # todo handle our batch split scalers for slider training. For now take the mean of them
             scale = multiplier.mean()
-            scaled_lora_weight = lora_weight * scale
-            scaled_lora_output = scaled_lora_output + self.apply_dora(lx, scaled_lora_weight).to(org_forwarded.dtype)
+            # reuse the base output when there is no dropout, it is x V^T already
+            base_output = org_forwarded if lx is x else None
+            scaled_lora_output = scaled_lora_output + self.apply_dora(lx, scale, base_output).to(org_forwarded.dtype)
 
         try:
             x = org_forwarded + scaled_lora_output
@@ -343,67 +360,137 @@ class ToolkitModuleMixin:
         merge_out_weight = abs(merge_out_weight)
         # merging out is just merging in the negative of the weight
         self.merge_in(merge_weight=-merge_out_weight)
+        self.is_weight_merged = False
 
     @torch.no_grad()
-    def merge_in(self: Module, merge_weight=1.0):
-        if not self.can_merge_in:
-            return
-        # get up/down weight
+    def get_merge_delta(self: Module, weight: torch.Tensor) -> torch.Tensor:
+        # float32 delta this module adds to weight at a multiplier of 1.0, on the lora device
         if self.full_rank:
             up_weight = None
         else:
-            up_weight = self.lora_up.weight.clone().float()
-        down_weight = self.lora_down.weight.clone().float()
-
-        # extract weight from org_module
-        org_sd = self.org_module[0].state_dict()
-        # todo find a way to merge in weights when doing quantized model
-        if 'weight._data' in org_sd:
-            # quantized weight
-            return
-
-        weight_key = "weight"
-        if 'weight._data' in org_sd:
-            # quantized weight
-            weight_key = "weight._data"
+            up_weight = self.lora_up.weight.float()
+        down_weight = self.lora_down.weight.float()
 
-        orig_dtype = org_sd[weight_key].dtype
-        weight = org_sd[weight_key].float()
-
-        multiplier = merge_weight
         scale = self.scale
         # handle trainable scaler method locon does
         if hasattr(self, 'scalar'):
             scale = scale * self.scalar
-
-        weight_device = weight.device
-        if weight.device != down_weight.device:
-            weight = weight.to(down_weight.device)
-        if scale.device != down_weight.device:
+        if isinstance(scale, torch.Tensor) and scale.device != down_weight.device:
             scale = scale.to(down_weight.device)
-        # merge weight
+
         if self.full_rank:
-            weight = weight + multiplier * down_weight * scale
+            delta = down_weight
         elif len(weight.size()) == 2:
             # linear
-            weight = weight + multiplier * (up_weight @ down_weight) * scale
+            delta = up_weight @ down_weight
         elif down_weight.size()[2:4] == (1, 1):
             # conv2d 1x1
-            weight = (
-                    weight
-                    + multiplier
-                    * (up_weight.squeeze(3).squeeze(2) @ down_weight.squeeze(3).squeeze(2)).unsqueeze(2).unsqueeze(3)
-                    * scale
-            )
+            delta = (up_weight.squeeze(3).squeeze(2) @ down_weight.squeeze(3).squeeze(2)).unsqueeze(2).unsqueeze(3)
         else:
             # conv2d 3x3
-            conved = torch.nn.functional.conv2d(down_weight.permute(1, 0, 2, 3), up_weight).permute(1, 0, 2, 3)
-            # print(conved.size(), weight.size(), module.stride, module.padding)
-            weight = weight + multiplier * conved * scale
+            delta = torch.nn.functional.conv2d(down_weight.permute(1, 0, 2, 3), up_weight).permute(1, 0, 2, 3)
+        return delta * scale
+
+    @torch.no_grad()
+    def merge_in(self: Module, merge_weight=1.0):
+        if not self.can_merge_in:
+            return
+
+        # extract weight from org_module
+        org_sd = self.org_module[0].state_dict()
+        # quantized weights are only handled by fast_merge_in
+        if 'weight._data' in org_sd:
+            return
+
+        weight_key = "weight"
+        orig_dtype = org_sd[weight_key].dtype
+        weight = org_sd[weight_key].float()
+        delta = self.get_merge_delta(weight)
+
+        weight_device = weight.device
+        if weight.device != delta.device:
+            weight = weight.to(delta.device)
+        weight = weight + merge_weight * delta
 
         # set weight to org_module
         org_sd[weight_key] = weight.to(weight_device, orig_dtype)
         self.org_module[0].load_state_dict(org_sd)
+        self.is_weight_merged = True
+
+    @torch.no_grad()
+    def fast_merge_in(self: Module, merge_weight=1.0):
+        # merges in place for sampling, has to be undone with fast_merge_out. Dense weights get the
+        # delta subtracted again unless network.exact_merge_restore keeps a copy to restore from
+        if not self.can_merge_in or self.is_weight_merged:
+            return
+        org_module = self.org_module[0]
+        weight = org_module.weight
+
+        if isinstance(weight, QTensor):
+            # quanto. merge into the dequantized weight and quantize it again. The original quantized
+            # weight is just set aside, swapping it back in is exact and does not copy anything
+            if not isinstance(org_module, QModuleMixin):
+                return
+            dense_weight = weight.dequantize()
+            delta = self.get_merge_delta(dense_weight).to(dense_weight.device)
+            merged_weight = (dense_weight.float() + merge_weight * delta).to(dense_weight.dtype)
+            self._merge_backup = [weight]
+            org_module.weight = torch.nn.Parameter(merged_weight, requires_grad=False)
+            org_module.freeze()
+            self.is_weight_merged = True
+            return
+
+        if weight.data.__class__ is not torch.Tensor:
+            # other quantized tensor types (torchao). the lora keeps running unmerged for this module
+            return
+
+        network: Network = self.network_ref()
+        network_config = getattr(network, 'network_config', None) if network is not None else None
+        if network_config is None or network_config.exact_merge_restore:
+            # snapshot into a cpu buffer that is reused every time we sample. It is pinned so the copies
+            # both ways are async and ordered on the stream, the host never waits on them
+            backup = self._merge_buffer[0] if self._merge_buffer is not None else None
+            if backup is None or backup.shape != weight.shape or backup.dtype != weight.dtype:
+                backup = torch.empty(weight.shape, dtype=weight.dtype, device='cpu', pin_memory=weight.is_cuda)
+                self._merge_buffer = [backup]
+            if self._merge_event is not None:
+                # the last restore may still be reading the buffer
+                torch.cuda.current_stream(weight.device).wait_event(self._merge_event)
+                self._merge_event = None
+            backup.copy_(weight.data, non_blocking=weight.is_cuda)
+            self._merge_backup = [backup]
+
+        delta = self.get_merge_delta(weight)
+        if delta.device != weight.device:
+            delta = delta.to(weight.device)
+        weight.data.copy_(weight.data.float() + merge_weight * delta)
+        self._merge_weight = merge_weight
+        self.is_weight_merged = True
+
+    @torch.no_grad()
+    def fast_merge_out(self: Module):
+        if not self.is_weight_merged:
+            return
+        org_module = self.org_module[0]
+        backup = self._merge_backup[0] if self._merge_backup is not None else None
+        if isinstance(backup, QTensor):
+            org_module.weight = backup
+        elif backup is not None:
+            weight = org_module.weight
+            weight.data.copy_(backup, non_blocking=weight.is_cuda)
+            if weight.is_cuda:
+                # waited on before the weight is used or the buffer is written again
+                self._merge_event = torch.cuda.Event()
+                self._merge_event.record()
+        else:
+            weight = org_module.weight
+            delta = self.get_merge_delta(weight)
+            if delta.device != weight.device:
+                delta = delta.to(weight.device)
+            weight.data.copy_(weight.data.float() - self._merge_weight * delta)
+        self._merge_backup = None
+        self._merge_weight = None
+        self.is_weight_merged = False
 
     def setup_lorm(self: Module, state_dict: Optional[Dict[str, Any]] = None):
         # LoRM (Low Rank Middle) is a method reduce the number of parameters in a module while keeping the inputs and
@@ -456,7 +543,7 @@ class ToolkitNetworkMixin:
         # will prevent optimizer from loading as it will have double states
         self.did_change_weights = False
 
-    def get_keymap(self: Network, force_weight_mapping=False):
+    def _get_compiled_keymap(self: Network, force_weight_mapping=False):
         use_weight_mapping = False
 
         if self.is_ssd:
@@ -484,43 +571,20 @@ class ToolkitNetworkMixin:
 
         keymap_path = os.path.join(KEYMAPS_ROOT, keymap_name)
 
-        keymap = None
-        # check if file exists
-        if os.path.exists(keymap_path):
-            with open(keymap_path, 'r') as f:
-                keymap = json.load(f)['ldm_diffusers_keymap']
-
-        if use_weight_mapping and keymap is not None:
-            # get keymap from weights
-            keymap = get_lora_keymap_from_model_keymap(keymap)
-
-        # upgrade keymaps for DoRA
-        if self.network_type.lower() == 'dora':
-            if keymap is not None:
-                new_keymap = {}
-                for ldm_key, diffusers_key in keymap.items():
-                    ldm_key = ldm_key.replace('.alpha', '.magnitude')
-                    # ldm_key = ldm_key.replace('.lora_down.weight', '.lora_down')
-                    # ldm_key = ldm_key.replace('.lora_up.weight', '.lora_up')
-
-                    diffusers_key = diffusers_key.replace('.alpha', '.magnitude')
-                    # diffusers_key = diffusers_key.replace('.lora_down.weight', '.lora_down')
-                    # diffusers_key = diffusers_key.replace('.lora_up.weight', '.lora_up')
-
-                    new_keymap[ldm_key] = diffusers_key
-
-                keymap = new_keymap
+        # parsed, converted for lora / dora and inverted once per keymap file, see get_compiled_keymap
+        return get_compiled_keymap(
+            keymap_path,
+            use_weight_mapping=use_weight_mapping,
+            is_dora=self.network_type.lower() == 'dora',
+        )
 
-        return keymap
+    def get_keymap(self: Network, force_weight_mapping=False):
+        compiled = self._get_compiled_keymap(force_weight_mapping)
+        return None if compiled is None else compiled[0]
     
     def get_state_dict(self: Network, extra_state_dict=None, dtype=torch.float16):
-        keymap = self.get_keymap()
-
-        save_keymap = {}
-        if keymap is not None:
-            for ldm_key, diffusers_key in keymap.items():
-                #  invert them
-                save_keymap[diffusers_key] = ldm_key
+        compiled = self._get_compiled_keymap()
+        save_keymap = {} if compiled is None else compiled[1]
 
         state_dict = self.state_dict()
         save_dict = OrderedDict()
@@ -528,7 +592,7 @@ class ToolkitNetworkMixin:
         for key in list(state_dict.keys()):
             v = state_dict[key]
             v = v.detach().clone().to("cpu").to(dtype)
-            save_key = save_keymap[key] if key in save_keymap else key
+            save_key = save_keymap.get(key, key)
             save_dict[save_key] = v
             del state_dict[key]
 
@@ -599,6 +663,36 @@ class ToolkitNetworkMixin:
             save_file(save_dict, file, metadata)
         else:
             torch.save(save_dict, file)
+        return save_dict
+
+    def can_save_delta_weights(self: Network):
+        # models with their own save_lora may split or rewrite the file, so we cannot chain deltas on them
+        return self.base_model_ref is None or not hasattr(self.base_model_ref(), 'save_lora')
+
+    def save_delta_weights(
+            self: Network,
+            file,
+            parent_file: str,
+            parent_state_dict: OrderedDict,
+            dtype=torch.float16,
+            metadata=None,
+            extra_state_dict: Optional[OrderedDict] = None,
+            delta_format: str = 'int8',
+    ) -> OrderedDict:
+        # saves only the compressed change since parent_file. Returns the state dict a load will
+        # reconstruct, which the next delta should be taken against
+        save_dict = self.get_state_dict(extra_state_dict=extra_state_dict, dtype=dtype)
+        delta_dict, reconstructed = make_delta_state_dict(save_dict, parent_state_dict, delta_format=delta_format)
+        del save_dict
+
+        metadata = OrderedDict() if metadata is None else OrderedDict(metadata)
+        metadata[DELTA_PARENT_META_KEY] = os.path.basename(parent_file)
+        metadata[DELTA_FORMAT_META_KEY] = delta_format
+        metadata = add_model_hash_to_meta(delta_dict, metadata)
+
+        from safetensors.torch import save_file
+        save_file(delta_dict, file, metadata)
+        return reconstructed
 
     def load_weights(self: Network, file, force_weight_mapping=False):
         # allows us to save and load to and from ldm weights
@@ -606,7 +700,10 @@ class ToolkitNetworkMixin:
         keymap = {} if keymap is None else keymap
 
         if isinstance(file, str):
-            if self.base_model_ref is not None and hasattr(self.base_model_ref(), 'load_lora'):
+            if is_delta_checkpoint(file):
+                # rebuild the full weights from the base save and the deltas after it
+                weights_sd = load_delta_checkpoint(file)
+            elif self.base_model_ref is not None and hasattr(self.base_model_ref(), 'load_lora'):
                 # call the base model load lora method
                 weights_sd = self.base_model_ref().load_lora(file)
             else:
@@ -624,7 +721,7 @@ class ToolkitNetworkMixin:
 
         load_sd = OrderedDict()
         for key, value in weights_sd.items():
-            load_key = keymap[key] if key in keymap else key
+            load_key = keymap.get(key, key)
             # replace old double __ with single _
             if self.is_pixart:
                 load_key = load_key.replace('__', '_')
@@ -826,6 +923,21 @@ class ToolkitNetworkMixin:
         for module in self.get_all_modules():
             module.merge_out(merge_weight)
 
+    def fast_merge_in(self: Network, merge_weight=1.0):
+        # temporary merge for sampling, has to be undone with fast_merge_out
+        if self.network_type.lower() == 'dora':
+            return
+        self.is_merged_in = True
+        for module in self.get_all_modules():
+            module.fast_merge_in(merge_weight)
+
+    def fast_merge_out(self: Network):
+        if not self.is_merged_in:
+            return
+        self.is_merged_in = False
+        for module in self.get_all_modules():
+            module.fast_merge_out()
+
     def extract_weight(
             self: Network,
             extract_mode: ExtractMode = "existing",
@@ -0,0 +1,191 @@
+import json
+import os
+import re
+from collections import OrderedDict
+from typing import List, Optional, Pattern, Tuple
+
+import torch
+
+from toolkit.print import print_acc
+from toolkit.util.cache_files import get_cache_key, write_cache_json
+
+# bump this if the way modules are selected changes so old plans are not used
+NETWORK_MODULE_PLAN_VERSION = 1
+
+
+def compile_contains(words: Optional[List[str]]) -> Optional[Pattern]:
+    # one regex that matches if any of the words is in the string, same as any(w in s for w in words)
+    if words is None or len(words) == 0:
+        return None
+    return re.compile("|".join(re.escape(w) for w in words))
+
+
+class ModuleSelectionRules:
+    """
+    The ignore / only / transformer only rules of a network compiled into a few regexes, so picking
+    the modules to put a lora on is one search per rule instead of a substring scan per word.
+    """
+
+    def __init__(
+        self,
+        ignore_if_contains: Optional[List[str]] = None,
+        only_if_contains: Optional[List[str]] = None,
+        required_groups: Optional[List[List[str]]] = None,
+        parameter_threshold: float = 0.0,
+    ):
+        self.ignore_if_contains = list(ignore_if_contains or [])
+        self.only_if_contains = list(only_if_contains) if only_if_contains is not None else None
+        # lora name has to contain one word of every group, used for transformer_only
+        self.required_groups = [list(g) for g in (required_groups or [])]
+        self.parameter_threshold = parameter_threshold
+
+        self._ignore = compile_contains(self.ignore_if_contains)
+        self._only = compile_contains(self.only_if_contains)
+        # an empty group can never match
+        self._required = [compile_contains(g) for g in self.required_groups]
+
+    def is_selected(self, clean_name: str, lora_name: str, module: torch.nn.Module) -> bool:
+        if self._ignore is not None and self._ignore.search(clean_name):
+            return False
+        for required in self._required:
+            if required is None or not required.search(lora_name):
+                return False
+        if self.parameter_threshold > 0:
+            if sum(p.numel() for p in module.parameters()) < self.parameter_threshold:
+                return False
+        if self.only_if_contains is not None:
+            if self._only is None:
+                return False
+            if not self._only.search(clean_name) and not self._only.search(lora_name):
+                return False
+        return True
+
+    def to_dict(self) -> dict:
+        return OrderedDict([
+            ("ignore_if_contains", self.ignore_if_contains),
+            ("only_if_contains", self.only_if_contains),
+            ("required_groups", self.required_groups),
+            ("parameter_threshold", self.parameter_threshold),
+        ])
+
+
+def get_lora_names(prefix: str, name: str, child_name: str, peft_format: bool) -> Tuple[str, str]:
+    # returns the lora name and the clean (dotted) name
+    clean_name = ".".join([x for x in [prefix, name, child_name] if x])
+    if peft_format:
+        # we replace this on saving
+        return clean_name.replace(".", "$$"), clean_name
+    return clean_name.replace(".", "_"), clean_name
+
+
+def _get_module_config(root_module: torch.nn.Module):
+    config = getattr(root_module, "config", None)
+    if config is None:
+        return None
+    if hasattr(config, "to_dict"):
+        return config.to_dict()
+    try:
+        return dict(config)
+    except (TypeError, ValueError):
+        return None
+
+
+def get_module_plan_path(
+    cache_dir: str,
+    root_module: torch.nn.Module,
+    target_replace_modules: List[str],
+    module_classes: List[str],
+    prefix: str,
+    peft_format: bool,
+    rules: ModuleSelectionRules,
+) -> Optional[str]:
+    # the architecture is identified by the model class and its config, without walking it
+    module_config = _get_module_config(root_module)
+    if module_config is None:
+        return None
+    info = OrderedDict([
+        ("class", root_module.__class__.__name__),
+        ("config", module_config),
+        ("target_replace_modules", list(target_replace_modules)),
+        ("module_classes", list(module_classes)),
+        ("prefix", prefix),
+        ("peft_format", peft_format),
+        ("rules", rules.to_dict()),
+        ("version", NETWORK_MODULE_PLAN_VERSION),
+    ])
+    return os.path.join(cache_dir, f"{prefix}_{get_cache_key(info)}.json")
+
+
+def _scan_module_plan(
+    root_module: torch.nn.Module,
+    target_replace_modules: List[str],
+    module_classes: List[str],
+    prefix: str,
+    peft_format: bool,
+    rules: ModuleSelectionRules,
+) -> List[Tuple[str, str]]:
+    plan = []
+    for name, module in root_module.named_modules():
+        if module.__class__.__name__ not in target_replace_modules:
+            continue
+        for child_name, child_module in module.named_modules():
+            if child_module.__class__.__name__ not in module_classes:
+                continue
+            lora_name, clean_name = get_lora_names(prefix, name, child_name, peft_format)
+            if rules.is_selected(clean_name, lora_name, child_module):
+                plan.append((name, child_name))
+    return plan
+
+
+def _resolve_module_plan(
+    root_module: torch.nn.Module,
+    plan: List[Tuple[str, str]],
+    module_classes: List[str],
+) -> Optional[List[Tuple[str, torch.nn.Module, str, torch.nn.Module]]]:
+    resolved = []
+    for name, child_name in plan:
+        try:
+            module = root_module.get_submodule(name)
+            child_module = module.get_submodule(child_name)
+        except AttributeError:
+            return None
+        if child_module.__class__.__name__ not in module_classes:
+            return None
+        resolved.append((name, module, child_name, child_module))
+    return resolved
+
+
+def get_module_plan(
+    root_module: torch.nn.Module,
+    target_replace_modules: List[str],
+    module_classes: List[str],
+    prefix: str,
+    peft_format: bool,
+    rules: ModuleSelectionRules,
+    cache_dir: Optional[str] = None,
+) -> List[Tuple[str, torch.nn.Module, str, torch.nn.Module]]:
+    """
+    Returns (name, module, child_name, child_module) for every module a lora should go on, in the
+    order the model lists them. With a cache_dir, the plan is saved keyed by the model architecture
+    and the rules, and later runs look the modules up by name instead of scanning the model.
+    """
+    path = None
+    if cache_dir is not None:
+        path = get_module_plan_path(
+            cache_dir, root_module, target_replace_modules, module_classes, prefix, peft_format, rules
+        )
+    if path is not None and os.path.exists(path):
+        try:
+            with open(path, "r") as f:
+                cached = [tuple(entry) for entry in json.load(f)["modules"]]
+            resolved = _resolve_module_plan(root_module, cached, module_classes)
+            if resolved is not None:
+                return resolved
+            print_acc(f"Cached network module plan {path} does not match the model, rescanning")
+        except Exception as e:
+            print_acc(f"Failed to load cached network module plan {path}: {e}")
+
+    plan = _scan_module_plan(root_module, target_replace_modules, module_classes, prefix, peft_format, rules)
+    if path is not None:
+        write_cache_json(path, {"modules": plan})
+    return _resolve_module_plan(root_module, plan, module_classes)
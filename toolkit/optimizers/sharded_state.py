@@ -0,0 +1,203 @@
+import json
+import os
+import shutil
+from collections import OrderedDict
+from typing import Optional
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+# sharded optimizer state lives in a folder next to the checkpoints:
+#   optimizer/index.json                 <- structure, non tensor values and tensor -> shard map
+#   optimizer/group_000_00000.safetensors <- tensors for param group 0, split by max_shard_size
+SHARDED_OPTIMIZER_DIRNAME = 'optimizer'
+SHARDED_OPTIMIZER_INDEX = 'index.json'
+SHARDED_OPTIMIZER_FORMAT_VERSION = 1
+
+DEFAULT_MAX_SHARD_SIZE = 2 * 1024 ** 3
+
+
+def _encode_value(value, key: str, tensors: OrderedDict):
+    # replaces tensors with references so the rest can be stored as json
+    if isinstance(value, torch.Tensor):
+        tensors[key] = value
+        return {'__tensor__': key}
+    if isinstance(value, torch.dtype):
+        # 8bit optimizer states keep the original dtype around
+        return {'__dtype__': str(value).replace('torch.', '')}
+    if isinstance(value, dict):
+        # keep keys typed, param ids are ints
+        return {'__dict__': [[k, _encode_value(v, f"{key}.{k}", tensors)] for k, v in value.items()]}
+    if isinstance(value, tuple):
+        return {'__tuple__': [_encode_value(v, f"{key}.{i}", tensors) for i, v in enumerate(value)]}
+    if isinstance(value, list):
+        return [_encode_value(v, f"{key}.{i}", tensors) for i, v in enumerate(value)]
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    raise TypeError(f"Cannot store optimizer state value of type {type(value)} at {key}")
+
+
+def _decode_value(value, tensors: dict):
+    if isinstance(value, dict):
+        if '__tensor__' in value:
+            return tensors[value['__tensor__']]
+        if '__dtype__' in value:
+            return getattr(torch, value['__dtype__'])
+        if '__dict__' in value:
+            return {k: _decode_value(v, tensors) for k, v in value['__dict__']}
+        if '__tuple__' in value:
+            return tuple(_decode_value(v, tensors) for v in value['__tuple__'])
+    if isinstance(value, list):
+        return [_decode_value(v, tensors) for v in value]
+    return value
+
+
+def _fsync_file(path: str):
+    # make sure the data is on disk before the folder is renamed into place
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def save_sharded_optimizer_state(
+        state_dict: dict,
+        save_dir: str,
+        max_shard_size: int = DEFAULT_MAX_SHARD_SIZE
+):
+    """
+    Saves an optimizer state dict as per param group safetensors shards plus a small json index.
+    Everything is written to a temp folder first and swapped in with a rename, so a crash
+    mid save never corrupts the previous state.
+    """
+    tmp_dir = save_dir + '.tmp'
+    old_dir = save_dir + '.old'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    param_to_group = {}
+    for group_idx, group in enumerate(state_dict['param_groups']):
+        for param_id in group['params']:
+            param_to_group[param_id] = group_idx
+
+    # bucket the tensors by param group
+    buckets = OrderedDict()
+    tensor_params = {}
+    encoded_state = []
+    for param_id, param_state in state_dict['state'].items():
+        bucket_name = f"group_{param_to_group.get(param_id, 0):03d}"
+        bucket = buckets.setdefault(bucket_name, OrderedDict())
+        num_tensors = len(bucket)
+        encoded_state.append([param_id, _encode_value(param_state, f"state.{param_id}", bucket)])
+        for key in list(bucket.keys())[num_tensors:]:
+            tensor_params[key] = param_id
+    param_group_tensors = OrderedDict()
+    encoded_param_groups = _encode_value(state_dict['param_groups'], 'param_groups', param_group_tensors)
+    if len(param_group_tensors) > 0:
+        buckets['param_groups'] = param_group_tensors
+
+    # write the shards, splitting large groups so no shard has to be held in memory whole
+    tensor_index = OrderedDict()
+    for bucket_name, bucket in buckets.items():
+        shard_idx = 0
+        shard = OrderedDict()
+        shard_size = 0
+
+        def write_shard():
+            shard_filename = f"{bucket_name}_{str(shard_idx).zfill(5)}.safetensors"
+            shard_path = os.path.join(tmp_dir, shard_filename)
+            save_file(shard, shard_path)
+            _fsync_file(shard_path)
+            for shard_key in shard.keys():
+                tensor_index[shard_key] = {
+                    'shard': shard_filename,
+                    'param': tensor_params.get(shard_key, None),
+                }
+
+        for key, tensor in bucket.items():
+            tensor_size = tensor.numel() * tensor.element_size()
+            if len(shard) > 0 and shard_size + tensor_size > max_shard_size:
+                write_shard()
+                shard_idx += 1
+                shard = OrderedDict()
+                shard_size = 0
+            shard[key] = tensor.detach().contiguous()
+            shard_size += tensor_size
+        if len(shard) > 0:
+            write_shard()
+
+    index = {
+        'format_version': SHARDED_OPTIMIZER_FORMAT_VERSION,
+        'state': encoded_state,
+        'param_groups': encoded_param_groups,
+        'tensors': tensor_index,
+    }
+    index_path = os.path.join(tmp_dir, SHARDED_OPTIMIZER_INDEX)
+    with open(index_path, 'w') as f:
+        json.dump(index, f)
+        f.flush()
+        os.fsync(f.fileno())
+
+    # swap it in. If we die between the renames, the loader will fall back to the .old folder
+    if os.path.exists(old_dir):
+        shutil.rmtree(old_dir)
+    if os.path.exists(save_dir):
+        os.rename(save_dir, old_dir)
+    os.rename(tmp_dir, save_dir)
+    if os.path.exists(old_dir):
+        shutil.rmtree(old_dir)
+
+
+def get_sharded_optimizer_state_dir(save_dir: str) -> Optional[str]:
+    # returns the folder holding a complete sharded optimizer state, if there is one
+    for path in [save_dir, save_dir + '.old']:
+        if os.path.exists(os.path.join(path, SHARDED_OPTIMIZER_INDEX)):
+            return path
+    return None
+
+
+def load_sharded_optimizer_state(
+        save_dir: str,
+        optimizer: Optional[torch.optim.Optimizer] = None
+) -> dict:
+    """
+    Loads a sharded optimizer state dict one shard at a time. If an optimizer is passed, the state
+    tensors are moved straight to the device of the param they belong to as they are read, so state
+    for gpu params never piles up in host memory. State for cpu params (and everything when no
+    optimizer is passed) is still returned whole, so it ends up in host memory like torch.load would.
+    """
+    with open(os.path.join(save_dir, SHARDED_OPTIMIZER_INDEX), 'r') as f:
+        index = json.load(f)
+
+    if index.get('format_version', None) != SHARDED_OPTIMIZER_FORMAT_VERSION:
+        raise ValueError(f"Unknown sharded optimizer format version {index.get('format_version', None)}")
+
+    # param ids are assigned in order across the param groups
+    param_devices = []
+    if optimizer is not None:
+        for group in optimizer.param_groups:
+            for param in group['params']:
+                param_devices.append(param.device)
+
+    shards = OrderedDict()
+    for key, tensor_info in index['tensors'].items():
+        shards.setdefault(tensor_info['shard'], []).append(key)
+
+    tensors = {}
+    for shard_filename, keys in shards.items():
+        with safe_open(os.path.join(save_dir, shard_filename), framework="pt", device="cpu") as f:
+            for key in keys:
+                tensor = f.get_tensor(key)
+                param_id = index['tensors'][key]['param']
+                # leave scalars like step on the cpu, the optimizer decides where those go
+                if param_id is not None and param_id < len(param_devices) and tensor.dim() > 0:
+                    tensor = tensor.to(param_devices[param_id])
+                tensors[key] = tensor
+
+    return {
+        'state': {param_id: _decode_value(param_state, tensors) for param_id, param_state in index['state']},
+        'param_groups': _decode_value(index['param_groups'], tensors),
+    }
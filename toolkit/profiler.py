@@ -0,0 +1,303 @@
+import json
+import os
+import time
+import warnings
+from collections import OrderedDict, deque
+from typing import Dict, List, Optional
+
+import numpy as np
+import torch
+
+# record kinds
+KIND_SECTION = 0
+KIND_TRANSFER_H2D = 1
+KIND_TRANSFER_D2H = 2
+KIND_SYNC = 3
+KIND_DATALOADER_WAIT = 4
+KIND_STEP = 5
+
+_KIND_NAMES = {
+    KIND_SECTION: 'section',
+    KIND_TRANSFER_H2D: 'h2d',
+    KIND_TRANSFER_D2H: 'd2h',
+    KIND_SYNC: 'sync',
+    KIND_DATALOADER_WAIT: 'dataloader_wait',
+    KIND_STEP: 'step',
+}
+
+# one record is 39 bytes. Times are in ns, device_ns is -1 until the cuda events resolve
+RECORD_DTYPE = np.dtype([
+    ('step', '<i4'),
+    ('kind', 'u1'),
+    ('name', '<u2'),
+    ('start_ns', '<i8'),
+    ('cpu_ns', '<i8'),
+    ('device_ns', '<i8'),
+    ('value', '<i8'),
+], align=False)
+
+# sections that are the training loop waiting on the dataloader
+DATALOADER_SECTIONS = ['get_batch', 'get_batch:reg']
+
+# the active profiler, so low level code (offloading, etc) can report transfers without plumbing
+_active_profiler: Optional['StepProfiler'] = None
+
+
+def get_active_profiler() -> Optional['StepProfiler']:
+    return _active_profiler
+
+
+class StepProfiler:
+    """
+    Low overhead step profiler. Records per section cpu time and device time (via cuda events that are
+    resolved lazily, so it never syncs), host <-> device bytes, dataloader waits and host syncs into a
+    fixed size binary ring buffer. Can be exported to a chrome trace or summarized into the logger.
+    """
+
+    def __init__(
+            self,
+            capacity: int = 65536,
+            device_timing: bool = True,
+            count_syncs: bool = False,
+    ):
+        self.capacity = capacity
+        self.records = np.zeros(capacity, dtype=RECORD_DTYPE)
+        # total records ever written, the ring index is num_written % capacity
+        self.num_written = 0
+        self.names: List[str] = []
+        self._name_ids: Dict[str, int] = {}
+        self.step_num = 0
+        self._step_start_ns = time.perf_counter_ns()
+        self._origin_ns = self._step_start_ns
+
+        self.device_timing = device_timing and torch.cuda.is_available()
+        self._active: Dict[str, tuple] = {}
+        # (record index, start event, end event) waiting for the device to get there
+        self._pending_events = deque()
+        self._event_pool: List[torch.cuda.Event] = []
+
+        # summary accumulators since the last get_summary
+        self._summary_start = 0
+
+        self.count_syncs = count_syncs and torch.cuda.is_available()
+        self._orig_showwarning = None
+        self._orig_filters = None
+        if self.count_syncs:
+            self._install_sync_counter()
+
+    def activate(self):
+        global _active_profiler
+        _active_profiler = self
+
+    def deactivate(self):
+        global _active_profiler
+        if _active_profiler is self:
+            _active_profiler = None
+        if self._orig_showwarning is not None:
+            torch.cuda.set_sync_debug_mode(0)
+            warnings.showwarning = self._orig_showwarning
+            self._orig_showwarning = None
+        if self._orig_filters is not None:
+            # drop our 'always' filter so it does not outlive the profiler
+            warnings.filters[:] = self._orig_filters
+            # let the module know the filters changed so cached 'once' lookups get redone
+            if hasattr(warnings, '_filters_mutated'):
+                warnings._filters_mutated()
+            self._orig_filters = None
+
+    # -------------------------
+    # recording
+    # -------------------------
+
+    def _get_name_id(self, name: str) -> int:
+        name_id = self._name_ids.get(name, None)
+        if name_id is None:
+            name_id = len(self.names)
+            self.names.append(name)
+            self._name_ids[name] = name_id
+        return name_id
+
+    def _write(self, kind: int, name: str, start_ns: int, cpu_ns: int, value: int = 0) -> int:
+        record_idx = self.num_written
+        self.records[record_idx % self.capacity] = (
+            self.step_num, kind, self._get_name_id(name), start_ns - self._origin_ns, cpu_ns, -1, value
+        )
+        self.num_written += 1
+        return record_idx
+
+    def _get_event(self):
+        if len(self._event_pool) > 0:
+            return self._event_pool.pop()
+        return torch.cuda.Event(enable_timing=True)
+
+    def start_section(self, name: str):
+        start_event = None
+        if self.device_timing:
+            start_event = self._get_event()
+            start_event.record()
+        self._active[name] = (time.perf_counter_ns(), start_event)
+
+    def cancel_section(self, name: str):
+        if name in self._active:
+            _, start_event = self._active.pop(name)
+            if start_event is not None:
+                self._event_pool.append(start_event)
+
+    def stop_section(self, name: str):
+        if name not in self._active:
+            return
+        start_ns, start_event = self._active.pop(name)
+        end_ns = time.perf_counter_ns()
+        kind = KIND_DATALOADER_WAIT if name in DATALOADER_SECTIONS else KIND_SECTION
+        record_idx = self._write(kind, name, start_ns, end_ns - start_ns)
+        if start_event is not None:
+            end_event = self._get_event()
+            end_event.record()
+            self._pending_events.append((record_idx, start_event, end_event))
+
+    def section(self, name: str):
+        return _ProfilerSection(self, name)
+
+    def record_transfer(self, num_bytes: int, direction: str = 'h2d', name: str = 'transfer'):
+        kind = KIND_TRANSFER_H2D if direction == 'h2d' else KIND_TRANSFER_D2H
+        self._write(kind, name, time.perf_counter_ns(), 0, int(num_bytes))
+
+    def record_sync(self, name: str = 'sync'):
+        self._write(KIND_SYNC, name, time.perf_counter_ns(), 0, 1)
+
+    def step(self, step_num: int):
+        # marks the end of a step and resolves any device timings that are done
+        now = time.perf_counter_ns()
+        self._write(KIND_STEP, 'step', self._step_start_ns, now - self._step_start_ns)
+        self._step_start_ns = now
+        self.step_num = step_num
+        self._resolve_events()
+
+    def _resolve_events(self, block: bool = False):
+        while len(self._pending_events) > 0:
+            record_idx, start_event, end_event = self._pending_events[0]
+            if block:
+                end_event.synchronize()
+            elif not end_event.query():
+                # events complete in order, nothing after this one is done either
+                break
+            self._pending_events.popleft()
+            # skip if it was overwritten in the ring already
+            if self.num_written - record_idx <= self.capacity:
+                elapsed_ms = start_event.elapsed_time(end_event)
+                self.records['device_ns'][record_idx % self.capacity] = int(elapsed_ms * 1e6)
+            self._event_pool.append(start_event)
+            self._event_pool.append(end_event)
+
+    def _install_sync_counter(self):
+        # torch warns on every synchronizing call in this mode. We count them instead of printing
+        self._orig_showwarning = warnings.showwarning
+        orig_showwarning = self._orig_showwarning
+
+        def showwarning(message, category, filename, lineno, file=None, line=None):
+            if 'called a synchronizing CUDA operation' in str(message):
+                self.record_sync()
+                return
+            orig_showwarning(message, category, filename, lineno, file, line)
+
+        warnings.showwarning = showwarning
+        self._orig_filters = list(warnings.filters)
+        warnings.filterwarnings('always', message='.*called a synchronizing CUDA operation.*')
+        torch.cuda.set_sync_debug_mode(1)
+
+    # -------------------------
+    # output
+    # -------------------------
+
+    def get_records(self, since: int = 0) -> np.ndarray:
+        # records in write order, oldest first
+        first = max(since, self.num_written - self.capacity)
+        if first >= self.num_written:
+            return self.records[:0].copy()
+        idx = np.arange(first, self.num_written) % self.capacity
+        return self.records[idx]
+
+    def get_summary(self) -> OrderedDict:
+        # averages since the last call, keyed for the logger
+        records = self.get_records(self._summary_start)
+        self._summary_start = self.num_written
+        summary = OrderedDict()
+        if len(records) == 0:
+            return summary
+        num_steps = max(int(np.sum(records['kind'] == KIND_STEP)), 1)
+        for kind in [KIND_SECTION, KIND_DATALOADER_WAIT]:
+            kind_records = records[records['kind'] == kind]
+            for name_id in np.unique(kind_records['name']):
+                section = kind_records[kind_records['name'] == name_id]
+                name = self.names[name_id]
+                summary[f"profile/{name}/cpu_ms"] = float(section['cpu_ns'].mean() / 1e6)
+                device_ns = section['device_ns'][section['device_ns'] >= 0]
+                if len(device_ns) > 0:
+                    summary[f"profile/{name}/device_ms"] = float(device_ns.mean() / 1e6)
+        steps = records[records['kind'] == KIND_STEP]
+        if len(steps) > 0:
+            summary["profile/step/cpu_ms"] = float(steps['cpu_ns'].mean() / 1e6)
+        waits = records[records['kind'] == KIND_DATALOADER_WAIT]
+        summary["profile/dataloader_wait_ms_per_step"] = float(waits['cpu_ns'].sum() / 1e6 / num_steps)
+        h2d = records[records['kind'] == KIND_TRANSFER_H2D]
+        summary["profile/h2d_mb_per_step"] = float(h2d['value'].sum() / (1024 ** 2) / num_steps)
+        d2h = records[records['kind'] == KIND_TRANSFER_D2H]
+        summary["profile/d2h_mb_per_step"] = float(d2h['value'].sum() / (1024 ** 2) / num_steps)
+        if self.count_syncs:
+            syncs = records[records['kind'] == KIND_SYNC]
+            summary["profile/syncs_per_step"] = float(len(syncs) / num_steps)
+        return summary
+
+    def save(self, path: str):
+        # raw binary dump of the ring buffer plus the name table
+        self._resolve_events()
+        np.save(path, self.get_records())
+        with open(os.path.splitext(path)[0] + '_names.json', 'w') as f:
+            json.dump(self.names, f)
+
+    def export_chrome_trace(self, path: str):
+        self._resolve_events(block=True)
+        events = []
+        for record in self.get_records():
+            kind = int(record['kind'])
+            name = self.names[record['name']]
+            ts = record['start_ns'] / 1000.0
+            args = {'step': int(record['step'])}
+            if kind in (KIND_SECTION, KIND_DATALOADER_WAIT, KIND_STEP):
+                events.append({
+                    'name': name, 'cat': _KIND_NAMES[kind], 'ph': 'X', 'ts': ts,
+                    'dur': record['cpu_ns'] / 1000.0, 'pid': 0, 'tid': 'cpu', 'args': args,
+                })
+                if record['device_ns'] >= 0:
+                    # device time has no start of its own, line it up with the cpu start
+                    events.append({
+                        'name': name, 'cat': 'device', 'ph': 'X', 'ts': ts,
+                        'dur': record['device_ns'] / 1000.0, 'pid': 0, 'tid': 'device', 'args': args,
+                    })
+            elif kind in (KIND_TRANSFER_H2D, KIND_TRANSFER_D2H):
+                events.append({
+                    'name': _KIND_NAMES[kind], 'ph': 'C', 'ts': ts, 'pid': 0,
+                    'args': {'bytes': int(record['value'])},
+                })
+            elif kind == KIND_SYNC:
+                events.append({
+                    'name': name, 'cat': 'sync', 'ph': 'i', 's': 't', 'ts': ts, 'pid': 0, 'tid': 'cpu',
+                })
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+class _ProfilerSection:
+    def __init__(self, profiler: StepProfiler, name: str):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler.start_section(self.name)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.profiler.stop_section(self.name)
+        else:
+            self.profiler.cancel_section(self.name)
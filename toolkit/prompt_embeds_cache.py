@@ -0,0 +1,96 @@
+import hashlib
+import os
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Dict, List, Optional, Union
+
+from toolkit.print import print_acc
+from toolkit.prompt_utils import PromptEmbeds
+from toolkit.util.cache_files import get_cache_key, write_cache_file
+
+if TYPE_CHECKING:
+    from toolkit.config_modules import ModelConfig
+
+# bump this if the way prompts are encoded changes so old cache entries are not used
+PROMPT_EMBEDS_CACHE_VERSION = 1
+
+
+def get_text_encoder_identity(model_config: 'ModelConfig') -> OrderedDict:
+    # everything on the model config that changes what the text encoder outputs
+    return OrderedDict([
+        ("arch", model_config.arch),
+        ("name_or_path", model_config.name_or_path_original),
+        ("extras_name_or_path", model_config.extras_name_or_path),
+        ("te_name_or_path", model_config.te_name_or_path),
+        ("model_paths", model_config.model_paths),
+        ("te_dtype", model_config.te_dtype),
+        ("text_encoder_bits", model_config.text_encoder_bits),
+        ("quantize_te", model_config.quantize_te),
+        ("qtype_te", model_config.qtype_te),
+        ("use_text_encoder_1", model_config.use_text_encoder_1),
+        ("use_text_encoder_2", model_config.use_text_encoder_2),
+        ("assistant_lora_path", model_config.assistant_lora_path),
+        ("inference_lora_path", model_config.inference_lora_path),
+    ])
+
+
+class PromptEmbedsCache:
+    """
+    Content addressed disk cache for encoded prompts. Entries are keyed by the prompt, a hash of the
+    contents of any control images that go into the text encoder, and the text encoder identity, so
+    it is safe to share between runs and jobs.
+    """
+
+    def __init__(self, cache_dir: str, text_encoder_identity: Dict):
+        self.cache_dir = cache_dir
+        self.text_encoder_identity = text_encoder_identity
+        self._file_hashes: Dict[str, str] = {}
+
+    def _hash_file(self, path: str) -> str:
+        if path not in self._file_hashes:
+            file_hash = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    file_hash.update(chunk)
+            self._file_hashes[path] = file_hash.hexdigest()
+        return self._file_hashes[path]
+
+    def get_path(
+            self,
+            prompt: str,
+            control_paths: Optional[List[str]] = None,
+            extra: Optional[Dict] = None,
+    ) -> str:
+        info = OrderedDict([
+            ("prompt", prompt),
+            ("control_hashes", [self._hash_file(p) for p in control_paths or []]),
+            ("text_encoder", self.text_encoder_identity),
+            ("extra", extra or {}),
+            ("version", PROMPT_EMBEDS_CACHE_VERSION),
+        ])
+        return os.path.join(self.cache_dir, f'{get_cache_key(info)}.safetensors')
+
+    def load(
+            self,
+            prompt: str,
+            control_paths: Optional[List[str]] = None,
+            extra: Optional[Dict] = None,
+    ) -> Union[PromptEmbeds, None]:
+        path = self.get_path(prompt, control_paths, extra)
+        if not os.path.exists(path):
+            return None
+        try:
+            return PromptEmbeds.load(path)
+        except Exception as e:
+            # a broken entry just gets encoded again
+            print_acc(f"Failed to load cached prompt embeds {path}: {e}")
+            return None
+
+    def save(
+            self,
+            prompt: str,
+            prompt_embeds: PromptEmbeds,
+            control_paths: Optional[List[str]] = None,
+            extra: Optional[Dict] = None,
+    ):
+        path = self.get_path(prompt, control_paths, extra)
+        write_cache_file(path, prompt_embeds.save)
@@ -0,0 +1,115 @@
+from typing import TYPE_CHECKING, Callable, List, Optional
+
+import torch
+
+from toolkit.prompt_utils import PromptEmbeds, concat_prompt_embeds
+
+if TYPE_CHECKING:
+    from toolkit.config_modules import GenerateImageConfig
+
+
+def _embeds_signature(embeds: PromptEmbeds) -> Optional[tuple]:
+    # shapes have to match exactly, padding them would change the output
+    if not isinstance(embeds.text_embeds, torch.Tensor):
+        return None
+    if isinstance(embeds.attention_mask, (list, tuple)):
+        return None
+    pooled_shape = None if embeds.pooled_embeds is None else tuple(embeds.pooled_embeds.shape)
+    mask_shape = None if embeds.attention_mask is None else tuple(embeds.attention_mask.shape)
+    return tuple(embeds.text_embeds.shape), pooled_shape, mask_shape
+
+
+def get_sample_batch_key(
+        gen_config: 'GenerateImageConfig',
+        conditional_embeds: PromptEmbeds,
+        unconditional_embeds: PromptEmbeds,
+) -> Optional[tuple]:
+    """
+    Returns a key that is the same for samples that can go through the pipeline in a single call,
+    or None if the sample has to be generated on its own.
+    """
+    if gen_config.latents is not None:
+        return None
+    if any(x is not None for x in [
+        gen_config.ctrl_img, gen_config.ctrl_img_1, gen_config.ctrl_img_2, gen_config.ctrl_img_3,
+        gen_config.adapter_image_path
+    ]):
+        return None
+    if len(gen_config.extra_values) > 0:
+        return None
+    cond_signature = _embeds_signature(conditional_embeds)
+    uncond_signature = _embeds_signature(unconditional_embeds)
+    if cond_signature is None or uncond_signature is None:
+        return None
+    return (
+        gen_config.width,
+        gen_config.height,
+        gen_config.num_inference_steps,
+        gen_config.guidance_scale,
+        gen_config.guidance_rescale,
+        gen_config.network_multiplier,
+        gen_config.num_frames,
+        gen_config.fps,
+        gen_config.do_cfg_norm,
+        cond_signature,
+        uncond_signature,
+    )
+
+
+class SampleBatcher:
+    """
+    Collects samples with the same batch key and hands them to generate_fn together. generate_fn gets
+    (indexes, gen_configs, conditional_embeds, unconditional_embeds, generators) with the embeds
+    concatenated on the batch dim and one generator per sample, seeded like the single sample path,
+    so every sample starts from the same noise it would get on its own.
+    """
+
+    def __init__(self, batch_size: int, generate_fn: Callable):
+        self.batch_size = batch_size
+        self.generate_fn = generate_fn
+        self._key = None
+        self._indexes: List[int] = []
+        self._gen_configs: List['GenerateImageConfig'] = []
+        self._conditional: List[PromptEmbeds] = []
+        self._unconditional: List[PromptEmbeds] = []
+
+    def add(
+            self,
+            idx: int,
+            gen_config: 'GenerateImageConfig',
+            conditional_embeds: PromptEmbeds,
+            unconditional_embeds: PromptEmbeds,
+    ) -> bool:
+        # returns False if the sample cannot be batched and has to be generated by the caller
+        key = get_sample_batch_key(gen_config, conditional_embeds, unconditional_embeds)
+        if key is None:
+            # keep the output order stable
+            self.flush()
+            return False
+        if key != self._key:
+            self.flush()
+            self._key = key
+        self._indexes.append(idx)
+        self._gen_configs.append(gen_config)
+        self._conditional.append(conditional_embeds)
+        self._unconditional.append(unconditional_embeds)
+        if len(self._indexes) >= self.batch_size:
+            self.flush()
+        return True
+
+    def flush(self):
+        if len(self._indexes) == 0:
+            return
+        indexes = self._indexes
+        gen_configs = self._gen_configs
+        conditional_embeds = concat_prompt_embeds(self._conditional)
+        unconditional_embeds = concat_prompt_embeds(self._unconditional)
+        self._key = None
+        self._indexes = []
+        self._gen_configs = []
+        self._conditional = []
+        self._unconditional = []
+
+        # same as torch.manual_seed(seed) in the single sample path, but one per sample
+        generators = [torch.Generator().manual_seed(gen_config.seed) for gen_config in gen_configs]
+        self.generate_fn(indexes, gen_configs, conditional_embeds, unconditional_embeds, generators)
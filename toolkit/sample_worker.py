@@ -0,0 +1,257 @@
+import os
+import queue
+import traceback
+from collections import OrderedDict
+from typing import TYPE_CHECKING, List, Optional
+
+import torch
+import torch.multiprocessing as mp
+
+from toolkit.print import print_acc
+
+if TYPE_CHECKING:
+    from toolkit.logging_aitk import EmptyLogger
+    from toolkit.network_mixins import Network
+
+
+def _create_sampling_network(sd, network_config, model_config, train_config):
+    # same network the trainer builds, without any of the training setup
+    from toolkit.lora_special import LoRASpecialNetwork
+    from toolkit.lycoris_special import LycorisSpecialNetwork
+
+    network_kwargs = network_config.network_kwargs
+    NetworkClass = LoRASpecialNetwork
+    if network_config.type.lower() == 'locon' or network_config.type.lower() == 'lycoris':
+        NetworkClass = LycorisSpecialNetwork
+    if hasattr(sd, 'target_lora_modules'):
+        network_kwargs['target_lin_modules'] = sd.target_lora_modules
+
+    network = NetworkClass(
+        text_encoder=sd.text_encoder,
+        unet=sd.get_model_to_train(),
+        lora_dim=network_config.linear,
+        multiplier=1.0,
+        alpha=network_config.linear_alpha,
+        train_unet=train_config.train_unet,
+        train_text_encoder=train_config.train_text_encoder,
+        conv_lora_dim=network_config.conv,
+        conv_alpha=network_config.conv_alpha,
+        is_sdxl=model_config.is_xl or model_config.is_ssd,
+        is_v2=model_config.is_v2,
+        is_v3=model_config.is_v3,
+        is_pixart=model_config.is_pixart,
+        is_auraflow=model_config.is_auraflow,
+        is_flux=model_config.is_flux,
+        is_lumina2=model_config.is_lumina2,
+        is_ssd=model_config.is_ssd,
+        is_vega=model_config.is_vega,
+        dropout=network_config.dropout,
+        use_text_encoder_1=model_config.use_text_encoder_1,
+        use_text_encoder_2=model_config.use_text_encoder_2,
+        network_config=network_config,
+        network_type=network_config.type,
+        transformer_only=network_config.transformer_only,
+        is_transformer=sd.is_transformer,
+        base_model=sd,
+        **network_kwargs
+    )
+    network.force_to(sd.device_torch, dtype=torch.float32)
+    sd.network = network
+    network._update_torch_multiplier()
+    network.apply_to(sd.text_encoder, sd.unet, train_config.train_text_encoder, train_config.train_unet)
+    # we cannot merge in with layer offloading, and only merge into quantized weights if asked to
+    if model_config.layer_offloading or (model_config.quantize and not network_config.merge_quantized):
+        network.can_merge_in = False
+    network.eval()
+    return network
+
+
+def _sample_worker_main(
+        raw_model_config: dict,
+        raw_network_config: dict,
+        raw_train_config: dict,
+        device: str,
+        request_queue,
+        result_queue,
+):
+    from toolkit.config_modules import GenerateImageConfig, ModelConfig, NetworkConfig, TrainConfig
+    from toolkit.sampler import get_sampler
+    from toolkit.util.get_model import get_model_class
+
+    try:
+        train_config = TrainConfig(**raw_train_config)
+        model_config = ModelConfig(**raw_model_config)
+        network_config = NetworkConfig(**raw_network_config)
+
+        ModelClass = get_model_class(model_config)
+        if hasattr(ModelClass, 'get_train_scheduler'):
+            noise_scheduler = ModelClass.get_train_scheduler()
+        else:
+            arch = 'sd'
+            if model_config.is_pixart:
+                arch = 'pixart'
+            if model_config.is_flux:
+                arch = 'flux'
+            if model_config.is_lumina2:
+                arch = 'lumina2'
+            noise_scheduler = get_sampler(
+                train_config.noise_scheduler,
+                {
+                    "prediction_type": "v_prediction" if model_config.is_v_pred else "epsilon",
+                },
+                arch=arch,
+            )
+        sd = ModelClass(
+            device=device,
+            model_config=model_config,
+            dtype=train_config.dtype,
+            noise_scheduler=noise_scheduler,
+        )
+        sd.load_model()
+        network = _create_sampling_network(sd, network_config, model_config, train_config)
+    except Exception:
+        result_queue.put({'type': 'error', 'step': None, 'error': traceback.format_exc()})
+        return
+
+    result_queue.put({'type': 'ready'})
+
+    while True:
+        request = request_queue.get()
+        if request is None:
+            break
+        try:
+            snapshot_path = request['snapshot_path']
+            network.load_weights(snapshot_path)
+            os.remove(snapshot_path)
+            gen_img_configs = [GenerateImageConfig(**kwargs) for kwargs in request['gen_img_configs']]
+            sd.generate_images(
+                gen_img_configs,
+                sampler=request['sampler'],
+                batch_size=request['batch_size'],
+            )
+            images = [
+                (i, gen_img_config.get_image_path(i), gen_img_config.prompt)
+                for i, gen_img_config in enumerate(gen_img_configs)
+            ]
+            result_queue.put({'type': 'done', 'step': request['step'], 'images': images})
+        except Exception:
+            result_queue.put({'type': 'error', 'step': request['step'], 'error': traceback.format_exc()})
+
+
+class SampleWorker:
+    """
+    Long lived process that owns its own copy of the base model and generates the samples, so training
+    does not stop for them. Each round, the trainer saves a snapshot of the network weights and hands
+    it over with the sample configs. Finished images are written to the samples folder by the worker
+    and handed back to the trainer's logger when poll() picks up the result.
+    """
+
+    def __init__(
+            self,
+            raw_model_config: dict,
+            raw_network_config: dict,
+            raw_train_config: dict,
+            device: str,
+            snapshot_dir: str,
+            logger: Optional['EmptyLogger'] = None,
+            max_pending: int = 2,
+    ):
+        self.device = device
+        self.snapshot_dir = snapshot_dir
+        self.logger = logger
+        self.max_pending = max_pending
+        self.num_pending = 0
+        self.is_ready = False
+
+        ctx = mp.get_context('spawn')
+        self._request_queue = ctx.Queue()
+        self._result_queue = ctx.Queue()
+        self._process = ctx.Process(
+            target=_sample_worker_main,
+            args=(
+                raw_model_config,
+                raw_network_config,
+                raw_train_config,
+                device,
+                self._request_queue,
+                self._result_queue,
+            ),
+            daemon=True,
+        )
+
+    def start(self):
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        print_acc(f"Starting sample worker on {self.device}")
+        self._process.start()
+
+    def _handle_result(self, result: dict):
+        if result['type'] == 'ready':
+            self.is_ready = True
+            return
+        self.num_pending -= 1
+        if result['type'] == 'error':
+            if result['step'] is None:
+                # it never got going, nothing else will work
+                raise RuntimeError(f"Sample worker failed to start:\n{result['error']}")
+            print_acc(f"Sample worker failed to generate samples for step {result['step']}:\n{result['error']}")
+            return
+        if self.logger is not None:
+            from PIL import Image
+            for i, image_path, prompt in result['images']:
+                if os.path.exists(image_path) and os.path.splitext(image_path)[1].lower() in ['.jpg', '.jpeg', '.png']:
+                    self.logger.log_image(Image.open(image_path), i, prompt)
+
+    def _get_result(self, block: bool) -> bool:
+        try:
+            result = self._result_queue.get(block=block, timeout=5.0 if block else None)
+        except queue.Empty:
+            if block and not self._process.is_alive():
+                raise RuntimeError("Sample worker exited unexpectedly")
+            return False
+        self._handle_result(result)
+        return True
+
+    def poll(self):
+        # picks up any finished rounds without blocking
+        while self._get_result(block=False):
+            pass
+
+    def submit(
+            self,
+            step: Optional[int],
+            network: 'Network',
+            gen_img_config_kwargs_list: List[dict],
+            sampler: Optional[str] = None,
+            batch_size: int = 1,
+            dtype=torch.float32,
+    ):
+        self.poll()
+        # do not let rounds pile up if the worker is slower than sample_every
+        while self.num_pending >= self.max_pending:
+            self._get_result(block=True)
+
+        snapshot_name = f"snapshot_{step if step is not None else 'none'}_{self.num_pending}.safetensors"
+        snapshot_path = os.path.join(self.snapshot_dir, snapshot_name)
+        network.save_weights(snapshot_path, dtype=dtype, metadata=OrderedDict())
+        self._request_queue.put({
+            'step': step,
+            'snapshot_path': snapshot_path,
+            'gen_img_configs': gen_img_config_kwargs_list,
+            'sampler': sampler,
+            'batch_size': batch_size,
+        })
+        self.num_pending += 1
+
+    def wait(self):
+        while self.num_pending > 0:
+            self._get_result(block=True)
+
+    def shutdown(self):
+        try:
+            if self._process.is_alive():
+                self.wait()
+        finally:
+            self._request_queue.put(None)
+            self._process.join(timeout=60)
+            if self._process.is_alive():
+                self._process.terminate()
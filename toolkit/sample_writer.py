@@ -0,0 +1,49 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List
+
+
+class SampleWriter:
+    """
+    Writes sample images, videos and audio on background threads so the model does not sit idle
+    while they are encoded. The queue is bounded, so if encoding falls behind, submit blocks
+    instead of holding on to every generated sample in memory.
+    """
+
+    def __init__(self, num_workers: int = 2, max_queue_size: int = 8):
+        self._executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='sample_writer')
+        self._slots = threading.BoundedSemaphore(max_queue_size)
+        self._lock = threading.Lock()
+        self._futures: List[Future] = []
+
+    def _release_slot(self, future: Future):
+        self._slots.release()
+
+    def submit(self, fn, *args, **kwargs):
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(fn, *args, **kwargs)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(self._release_slot)
+        with self._lock:
+            self._futures.append(future)
+
+    def wait(self):
+        # blocks until everything submitted so far is on disk, raises the first error if any
+        with self._lock:
+            futures = self._futures
+            self._futures = []
+        error = None
+        for future in futures:
+            if future.exception() is not None and error is None:
+                error = future.exception()
+        if error is not None:
+            raise error
+
+    def shutdown(self):
+        try:
+            self.wait()
+        finally:
+            self._executor.shutdown(wait=True)
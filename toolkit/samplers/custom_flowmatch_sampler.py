@@ -4,7 +4,6 @@ from torch.distributions import LogNormal
 from diffusers import FlowMatchEulerDiscreteScheduler
 import torch
 import numpy as np
-from toolkit.timestep_weighing.default_weighing_scheme import default_weighing_scheme
 
 
 def calculate_shift(
@@ -25,6 +24,9 @@ class CustomFlowMatchEulerDiscreteScheduler(FlowMatchEulerDiscreteScheduler):
         super().__init__(*args, **kwargs)
         self.init_noise_sigma = 1.0
         self.timestep_type = "linear"
+        # sorted schedule timesteps and weight tables per device, see _get_timestep_lookup
+        self._timestep_lookup_cache = {}
+        self._weight_table_cache = {}
 
         with torch.no_grad():
             # create weights for timesteps
@@ -56,38 +58,69 @@ class CustomFlowMatchEulerDiscreteScheduler(FlowMatchEulerDiscreteScheduler):
             self.linear_timesteps_weights2 = hbsmntw_weighing
             pass
 
-    def get_weights_for_timesteps(self, timesteps: torch.Tensor, v2=False, timestep_type="linear") -> torch.Tensor:
-        # Get the indices of the timesteps
-        step_indices = [(self.timesteps == t).nonzero().item()
-                        for t in timesteps]
-
-        # Get the weights for the timesteps
-        if timestep_type == "weighted":
-            weights = torch.tensor(
-                [default_weighing_scheme[i] for i in step_indices],
-                device=timesteps.device,
-                dtype=timesteps.dtype
-            )
-        if v2:
-            weights = self.linear_timesteps_weights2[step_indices].flatten()
-        else:
-            weights = self.linear_timesteps_weights[step_indices].flatten()
+    def _get_timestep_lookup(self, device):
+        # ascending copy of the schedule timesteps for searchsorted and the index of each in the schedule.
+        # rebuilt when the schedule is replaced (set_train_timesteps) or edited in place
+        cache = self._timestep_lookup_cache
+        device = torch.device(device)
+        cached = cache.get(device)
+        if cached is not None and cached[0] is self.timesteps and cached[1] == self.timesteps._version:
+            return cached[2], cached[3]
+        with torch.no_grad():
+            sorted_timesteps, order = torch.sort(self.timesteps.to(device, dtype=torch.float32))
+        cache[device] = (self.timesteps, self.timesteps._version, sorted_timesteps, order)
+        return sorted_timesteps, order
+
+    def _get_step_indices(self, timesteps: torch.Tensor, device):
+        # schedule indices on both sides of each timestep and how far it is between them. a timestep
+        # on the grid gets frac 1 on itself, one between grid points is interpolated, no host syncs
+        sorted_timesteps, order = self._get_timestep_lookup(device)
+        t = timesteps.to(device=device, dtype=torch.float32).flatten()
+        if sorted_timesteps.numel() == 1:
+            idx = order.expand_as(t)
+            return idx, idx, torch.ones_like(t)
+        hi = torch.searchsorted(sorted_timesteps, t).clamp_(1, sorted_timesteps.numel() - 1)
+        lo = hi - 1
+        t_lo = sorted_timesteps[lo]
+        t_hi = sorted_timesteps[hi]
+        frac = ((t - t_lo) / (t_hi - t_lo).clamp_min(1e-8)).clamp_(0.0, 1.0)
+        return order[lo], order[hi], frac
+
+    def _lerp_table(self, table: torch.Tensor, lo, hi, frac) -> torch.Tensor:
+        # written so frac of exactly 0 or 1 returns the table value untouched
+        frac = frac.to(table.dtype)
+        return table[lo] * (1.0 - frac) + table[hi] * frac
+
+    def _get_weight_table(self, v2, device) -> torch.Tensor:
+        cache = self._weight_table_cache
+        key = (v2, torch.device(device))
+        if key not in cache:
+            weights = self.linear_timesteps_weights2 if v2 else self.linear_timesteps_weights
+            cache[key] = weights.to(device)
+        return cache[key]
 
-        return weights
+    def get_weights_for_timesteps(self, timesteps: torch.Tensor, v2=False, timestep_type="linear") -> torch.Tensor:
+        # the weighted timestep_type uses the same curve as linear
+        lo, hi, frac = self._get_step_indices(timesteps, timesteps.device)
+        return self._lerp_table(self._get_weight_table(v2, timesteps.device), lo, hi, frac)
 
     def get_sigmas(self, timesteps: torch.Tensor, n_dim, dtype, device) -> torch.Tensor:
-        sigmas = self.sigmas.to(device=device, dtype=dtype)
-        schedule_timesteps = self.timesteps.to(device)
-        timesteps = timesteps.to(device)
-        step_indices = [(schedule_timesteps == t).nonzero().item()
-                        for t in timesteps]
-
-        sigma = sigmas[step_indices].flatten()
+        lo, hi, frac = self._get_step_indices(timesteps, device)
+        sigma = self._lerp_table(self.sigmas.to(device=device, dtype=dtype), lo, hi, frac)
         while len(sigma.shape) < n_dim:
             sigma = sigma.unsqueeze(-1)
 
         return sigma
 
+    def get_sigmas_and_weights(self, timesteps: torch.Tensor, n_dim, dtype, device, v2=False):
+        # one lookup for both, same results as get_sigmas and get_weights_for_timesteps
+        lo, hi, frac = self._get_step_indices(timesteps, device)
+        sigma = self._lerp_table(self.sigmas.to(device=device, dtype=dtype), lo, hi, frac)
+        while len(sigma.shape) < n_dim:
+            sigma = sigma.unsqueeze(-1)
+        weights = self._lerp_table(self._get_weight_table(v2, device), lo, hi, frac)
+        return sigma, weights
+
     def add_noise(
             self,
             original_samples: torch.Tensor,
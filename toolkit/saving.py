@@ -1,13 +1,14 @@
 import json
 import os
 from collections import OrderedDict
-from typing import TYPE_CHECKING, Literal, Optional, Union
+from typing import TYPE_CHECKING, Dict, Literal, Optional, Tuple, Union
 
 import torch
 from safetensors.torch import load_file, save_file
 
 from toolkit.train_tools import get_torch_dtype
-from toolkit.paths import KEYMAPS_ROOT
+from toolkit.paths import KEYMAPS_ROOT, TOOLKIT_ROOT
+from toolkit.util.cache_files import get_cache_key, write_cache_json
 
 if TYPE_CHECKING:
     from toolkit.stable_diffusion_model import StableDiffusion
@@ -328,3 +329,64 @@ def get_lora_keymap_from_model_keymap(model_keymap: 'OrderedDict') -> 'OrderedDi
         lora_keymap[f"{key}.alpha"] = f"{value}.alpha"
 
     return lora_keymap
+
+
+# bump this if the way keymaps are compiled changes so old caches are not used
+KEYMAP_CACHE_VERSION = 1
+KEYMAP_CACHE_ROOT = os.path.join(TOOLKIT_ROOT, '.cache', 'keymaps')
+
+# in memory, by source file, its mtime and size and the conversions applied
+_compiled_keymaps: Dict[tuple, Tuple[Dict[str, str], Dict[str, str]]] = {}
+
+
+def get_compiled_keymap(
+        keymap_path: str,
+        use_weight_mapping: bool = False,
+        is_dora: bool = False,
+) -> Optional[Tuple[Dict[str, str], Dict[str, str]]]:
+    """
+    Returns (ldm -> diffusers, diffusers -> ldm) for a keymap json, with the lora and dora key
+    conversions already applied, or None if the file does not exist. The result is compiled once,
+    kept in memory and cached on disk until the json changes, so saves and loads do not parse the
+    json again. The dicts are shared, do not modify them.
+    """
+    try:
+        stat = os.stat(keymap_path)
+    except OSError:
+        return None
+    cache_key = (os.path.abspath(keymap_path), stat.st_mtime_ns, stat.st_size, use_weight_mapping, is_dora)
+    if cache_key in _compiled_keymaps:
+        return _compiled_keymaps[cache_key]
+
+    cache_name = os.path.splitext(os.path.basename(keymap_path))[0]
+    cache_path = os.path.join(KEYMAP_CACHE_ROOT, f"{cache_name}_{get_cache_key([KEYMAP_CACHE_VERSION, *cache_key])}.json")
+
+    keymap = None
+    if os.path.exists(cache_path):
+        try:
+            with open(cache_path, 'r') as f:
+                # stored as pairs to keep the order
+                keymap = OrderedDict(json.load(f)['keymap'])
+        except Exception:
+            keymap = None
+
+    if keymap is None:
+        with open(keymap_path, 'r') as f:
+            keymap = json.load(f, object_pairs_hook=OrderedDict)['ldm_diffusers_keymap']
+        if use_weight_mapping:
+            keymap = get_lora_keymap_from_model_keymap(keymap)
+        if is_dora:
+            keymap = OrderedDict(
+                (ldm_key.replace('.alpha', '.magnitude'), diffusers_key.replace('.alpha', '.magnitude'))
+                for ldm_key, diffusers_key in keymap.items()
+            )
+        try:
+            write_cache_json(cache_path, {'keymap': list(keymap.items())})
+        except OSError:
+            # read only install, it is compiled once per process
+            pass
+
+    # a later ldm key with the same diffusers key wins, like inverting in a loop
+    save_keymap = {diffusers_key: ldm_key for ldm_key, diffusers_key in keymap.items()}
+    _compiled_keymaps[cache_key] = (keymap, save_keymap)
+    return keymap, save_keymap
@@ -24,6 +24,7 @@ from torchvision.transforms import Resize, transforms
 from toolkit.assistant_lora import load_assistant_lora_from_path
 from toolkit.clip_vision_adapter import ClipVisionAdapter
 from toolkit.custom_adapter import CustomAdapter
+from toolkit.fused_lora import fuse_lora_networks, unfuse_lora_networks
 from toolkit.dequantize import patch_dequantization_on_save
 from toolkit.ip_adapter import IPAdapter
 from toolkit.util.vae import load_vae
@@ -34,6 +35,7 @@ from toolkit.models.decorator import Decorator
 from toolkit.paths import KEYMAPS_ROOT
 from toolkit.prompt_utils import inject_trigger_into_prompt, PromptEmbeds, concat_prompt_embeds
 from toolkit.reference_adapter import ReferenceAdapter
+from toolkit.sample_batcher import SampleBatcher
 from toolkit.sampler import get_sampler
 from toolkit.samplers.custom_flowmatch_sampler import CustomFlowMatchEulerDiscreteScheduler
 from toolkit.saving import save_ldm_model_from_diffusers, get_ldm_state_dict_from_diffusers
@@ -1127,11 +1129,80 @@ class StableDiffusion:
         self._status_update_hooks.append(func)
 
     @torch.no_grad()
+    def generate_batch_images(
+            self,
+            pipeline,
+            gen_configs: List[GenerateImageConfig],
+            conditional_embeds: PromptEmbeds,
+            unconditional_embeds: PromptEmbeds,
+            generators: List[torch.Generator],
+            extra: dict,
+    ) -> list:
+        # one pipeline call for samples that share resolution, steps and guidance
+        gen_config = gen_configs[0]
+        if self.is_xl:
+            return pipeline(
+                prompt_embeds=conditional_embeds.text_embeds,
+                pooled_prompt_embeds=conditional_embeds.pooled_embeds,
+                negative_prompt_embeds=unconditional_embeds.text_embeds,
+                negative_pooled_prompt_embeds=unconditional_embeds.pooled_embeds,
+                height=gen_config.height,
+                width=gen_config.width,
+                num_inference_steps=gen_config.num_inference_steps,
+                guidance_scale=gen_config.guidance_scale,
+                guidance_rescale=gen_config.guidance_rescale,
+                generator=generators,
+                **extra
+            ).images
+        elif self.is_v3 or (self.is_flux and self.model_config.use_flux_cfg):
+            return pipeline(
+                prompt_embeds=conditional_embeds.text_embeds,
+                pooled_prompt_embeds=conditional_embeds.pooled_embeds,
+                negative_prompt_embeds=unconditional_embeds.text_embeds,
+                negative_pooled_prompt_embeds=unconditional_embeds.pooled_embeds,
+                height=gen_config.height,
+                width=gen_config.width,
+                num_inference_steps=gen_config.num_inference_steps,
+                guidance_scale=gen_config.guidance_scale,
+                generator=generators,
+                **extra
+            ).images
+        elif self.is_flux:
+            # Fix a bug in diffusers/torch
+            def callback_on_step_end(pipe, i, t, callback_kwargs):
+                latents = callback_kwargs["latents"]
+                if latents.dtype != self.unet.dtype:
+                    latents = latents.to(self.unet.dtype)
+                return {"latents": latents}
+            return pipeline(
+                prompt_embeds=conditional_embeds.text_embeds,
+                pooled_prompt_embeds=conditional_embeds.pooled_embeds,
+                height=gen_config.height,
+                width=gen_config.width,
+                num_inference_steps=gen_config.num_inference_steps,
+                guidance_scale=gen_config.guidance_scale,
+                generator=generators,
+                callback_on_step_end=callback_on_step_end,
+                **extra
+            ).images
+        else:
+            return pipeline(
+                prompt_embeds=conditional_embeds.text_embeds,
+                negative_prompt_embeds=unconditional_embeds.text_embeds,
+                height=gen_config.height,
+                width=gen_config.width,
+                num_inference_steps=gen_config.num_inference_steps,
+                guidance_scale=gen_config.guidance_scale,
+                generator=generators,
+                **extra
+            ).images
+
     def generate_images(
             self,
             image_configs: List[GenerateImageConfig],
             sampler=None,
             pipeline: Union[None, StableDiffusionPipeline, StableDiffusionXLPipeline] = None,
+            batch_size: int = 1,
     ):
         network = unwrap_model(self.network)
         merge_multiplier = 1.0
@@ -1162,10 +1233,20 @@ class StableDiffusion:
                 self.unet.to(self.device_torch)
                 can_merge_in = True
                 merge_multiplier = unique_network_weights.pop()
-                network.merge_in(merge_weight=merge_multiplier)
+                network.fast_merge_in(merge_weight=merge_multiplier)
         else:
             network = BlankNetwork()
 
+        fused_loras = []
+        if self.model_config.fuse_sampling_loras:
+            stacked_networks = []
+            if self.assistant_lora is not None and self.assistant_lora.is_active:
+                stacked_networks.append(self.assistant_lora)
+            if self.network is not None and not network.is_merged_in:
+                stacked_networks.append(network)
+            if len(stacked_networks) > 1:
+                fused_loras = fuse_lora_networks(stacked_networks)
+
         self.save_device_state()
         self.set_device_state_preset('generate')
 
@@ -1367,6 +1448,33 @@ class StableDiffusion:
 
         # pipeline.to(self.device_torch)
 
+        # batch samples that share settings into a single pipeline call. The k-diffusion samplers,
+        # refiner and adapters still go one at a time
+        batcher = None
+        if batch_size > 1 and self.adapter is None and self.refiner_unet is None \
+                and not (sampler is not None and sampler.startswith("sample_")) \
+                and not (self.is_pixart or self.is_lumina2 or self.is_auraflow):
+            def generate_batch(indexes, gen_configs, conditional_embeds, unconditional_embeds, generators):
+                # the loop may have moved on to the next sample already
+                current_multiplier = network.multiplier
+                network.multiplier = gen_configs[0].network_multiplier
+                imgs = self.generate_batch_images(
+                    pipeline,
+                    gen_configs,
+                    conditional_embeds,
+                    unconditional_embeds,
+                    generators,
+                    {},
+                )
+                for idx, batch_gen_config, img in zip(indexes, gen_configs, imgs):
+                    batch_gen_config.save_image(img, idx)
+                    batch_gen_config.log_image(img, idx)
+                    self._after_sample_image(idx, len(image_configs))
+                network.multiplier = current_multiplier
+                flush()
+
+            batcher = SampleBatcher(batch_size, generate_batch)
+
         with network:
             with torch.no_grad():
                 if network is not None:
@@ -1525,6 +1633,9 @@ class StableDiffusion:
                     conditional_embeds = conditional_embeds.to(self.device_torch, dtype=self.unet.dtype)
                     unconditional_embeds = unconditional_embeds.to(self.device_torch, dtype=self.unet.dtype)
 
+                    if batcher is not None and batcher.add(i, gen_config, conditional_embeds, unconditional_embeds):
+                        continue
+
                     if self.is_xl:
                         # fix guidance rescale for sdxl
                         # was trained on 0.7 (I believe)
@@ -1714,6 +1825,9 @@ class StableDiffusion:
                     self._after_sample_image(i, len(image_configs))
                     flush()
 
+                if batcher is not None:
+                    batcher.flush()
+
                 if self.adapter is not None and isinstance(self.adapter, ReferenceAdapter):
                     self.adapter.clear_memory()
 
@@ -1734,8 +1848,9 @@ class StableDiffusion:
             network.multiplier = start_multiplier
 
         self.unet.to(self.device_torch, dtype=self.torch_dtype)
+        unfuse_lora_networks(fused_loras)
         if network.is_merged_in:
-            network.merge_out(merge_multiplier)
+            network.fast_merge_out()
         # self.tokenizer.to(original_device_dict['tokenizer'])
 
         # refuse loras
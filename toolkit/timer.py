@@ -14,16 +14,22 @@ class Timer:
         self.active_timers = {}
         self.current_timer = None  # Used for the context manager functionality
         self._after_print_hooks = []
+        # optional toolkit.profiler.StepProfiler that gets cpu/device times for every timer section
+        self.profiler = None
 
     def start(self, timer_name):
         if timer_name not in self.timers:
             self.timers[timer_name] = deque(maxlen=self.max_buffer)
         self.active_timers[timer_name] = time.time()
+        if self.profiler is not None:
+            self.profiler.start_section(timer_name)
 
     def cancel(self, timer_name):
         """Cancel an active timer."""
         if timer_name in self.active_timers:
             del self.active_timers[timer_name]
+        if self.profiler is not None:
+            self.profiler.cancel_section(timer_name)
 
     def stop(self, timer_name):
         if timer_name not in self.active_timers:
@@ -31,6 +37,8 @@ class Timer:
 
         elapsed_time = time.time() - self.active_timers[timer_name]
         self.timers[timer_name].append(elapsed_time)
+        if self.profiler is not None:
+            self.profiler.stop_section(timer_name)
 
         # Clean up active timers
         del self.active_timers[timer_name]
@@ -0,0 +1,39 @@
+import base64
+import hashlib
+import json
+import os
+from typing import Any, Callable
+
+
+def get_cache_key(info: Any) -> str:
+    # short file name safe hash of anything json can hold, other values go through str()
+    hash_input = json.dumps(info, sort_keys=True, default=str).encode('utf-8')
+    hash_str = base64.urlsafe_b64encode(hashlib.md5(hash_input).digest()).decode('ascii')
+    return hash_str.replace('=', '')
+
+
+def write_cache_file(path: str, write_fn: Callable[[str], None]):
+    """
+    Calls write_fn with a temp path next to path, then moves the result into place, so a crash or a
+    second process never sees a half written file. The temp path keeps the extension of path.
+    """
+    folder = os.path.dirname(path)
+    if folder != '':
+        os.makedirs(folder, exist_ok=True)
+    root, ext = os.path.splitext(path)
+    tmp_path = f"{root}.{os.getpid()}.tmp{ext}"
+    try:
+        write_fn(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def write_cache_json(path: str, data: Any, **kwargs):
+    def _write(tmp_path: str):
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, **kwargs)
+
+    write_cache_file(path, _write)
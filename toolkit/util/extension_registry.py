@@ -0,0 +1,188 @@
+import importlib
+import json
+import os
+import pkgutil
+from collections import OrderedDict
+from typing import List, Optional
+
+from toolkit.paths import TOOLKIT_ROOT
+from toolkit.util.cache_files import get_cache_key, write_cache_json
+
+EXTENSION_FOLDERS = ['extensions', 'extensions_built_in']
+
+# models that live in the toolkit itself, (module, class name)
+BUILT_IN_MODEL_ENTRIES = [
+    ('toolkit.models.wan21', 'Wan21'),
+    ('toolkit.models.wan21', 'Wan21I2V'),
+    ('toolkit.models.cogview4', 'CogView4'),
+]
+
+# bump this if the manifest format changes
+EXTENSION_REGISTRY_VERSION = 2
+EXTENSION_REGISTRY_PATH = os.path.join(TOOLKIT_ROOT, '.cache', 'extension_registry.json')
+
+# any change to a python file in here rebuilds the manifest
+_WATCHED_FOLDERS = EXTENSION_FOLDERS + [os.path.join('toolkit', 'models')]
+
+_registry: Optional[dict] = None
+_refreshed = False
+
+
+def _get_fingerprint() -> str:
+    files = []
+    for folder in _WATCHED_FOLDERS:
+        folder_path = os.path.join(TOOLKIT_ROOT, folder)
+        for root, dirs, filenames in os.walk(folder_path):
+            dirs[:] = [d for d in dirs if d != '__pycache__' and not d.startswith('.')]
+            for filename in filenames:
+                if not filename.endswith('.py'):
+                    continue
+                path = os.path.join(root, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((os.path.relpath(path, TOOLKIT_ROOT), stat.st_mtime_ns, stat.st_size))
+    files.sort()
+    return get_cache_key([EXTENSION_REGISTRY_VERSION, files])
+
+
+def _build_registry(fingerprint: str) -> dict:
+    # imports everything once and records where each model arch and extension uid lives
+    models = OrderedDict()
+    extensions = OrderedDict()
+    failed = []
+
+    for module_name, class_name in BUILT_IN_MODEL_ENTRIES:
+        ModelClass = getattr(importlib.import_module(module_name), class_name)
+        models.setdefault(ModelClass.arch, [ModelClass.__module__, ModelClass.__qualname__])
+
+    for sub_dir in EXTENSION_FOLDERS:
+        extensions_dir = os.path.join(TOOLKIT_ROOT, sub_dir)
+        for (_, name, _) in pkgutil.iter_modules([extensions_dir]):
+            try:
+                module = importlib.import_module(f"{sub_dir}.{name}")
+                # the first model with an arch wins, like the list order used to decide
+                for ModelClass in getattr(module, "AI_TOOLKIT_MODELS", None) or []:
+                    models.setdefault(ModelClass.arch, [ModelClass.__module__, ModelClass.__qualname__])
+                # a later extension with the same uid replaces an earlier one
+                for extension in getattr(module, "AI_TOOLKIT_EXTENSIONS", None) or []:
+                    extensions[extension.uid] = [extension.__module__, extension.__qualname__]
+            except ImportError as e:
+                print(f"Failed to import the {name} module. Error: {str(e)}")
+                failed.append(f"{sub_dir}.{name}")
+
+    return OrderedDict([
+        ("version", EXTENSION_REGISTRY_VERSION),
+        ("fingerprint", fingerprint),
+        ("models", models),
+        ("extensions", extensions),
+        ("failed", failed),
+        # keys looked up and not found with this fingerprint, like the stable diffusion archs
+        ("missing", OrderedDict([("models", []), ("extensions", [])])),
+    ])
+
+
+def get_extension_registry(refresh: bool = False) -> dict:
+    """
+    Manifest of every model arch and extension uid and the module and class they are defined in.
+    It is built by importing all extensions once, then cached on disk until a file in an extension
+    folder or toolkit/models changes, so resolving one model only imports that model's module.
+    """
+    global _registry
+    if _registry is not None and not refresh:
+        return _registry
+
+    fingerprint = _get_fingerprint()
+    if not refresh and os.path.exists(EXTENSION_REGISTRY_PATH):
+        try:
+            with open(EXTENSION_REGISTRY_PATH, 'r') as f:
+                cached = json.load(f)
+            if cached.get("version") == EXTENSION_REGISTRY_VERSION and cached.get("fingerprint") == fingerprint:
+                _registry = cached
+                return _registry
+        except Exception:
+            pass
+
+    _registry = _build_registry(fingerprint)
+    _save_registry()
+    return _registry
+
+
+def _save_registry():
+    try:
+        write_cache_json(EXTENSION_REGISTRY_PATH, _registry, indent=2)
+    except OSError:
+        # read only install, it is rebuilt every run
+        pass
+
+
+def _load_entry(entry: List[str]):
+    module_name, qualname = entry
+    obj = importlib.import_module(module_name)
+    for part in qualname.split('.'):
+        obj = getattr(obj, part)
+    return obj
+
+
+def _resolve(section: str, key: str):
+    global _refreshed
+    registry = get_extension_registry()
+    entry = registry[section].get(key)
+    if entry is None and key in registry["missing"][section]:
+        # already looked up and rebuilt for with these files, get_extension_registry(refresh=True) clears it
+        return None
+    if entry is None and len(registry["failed"]) > 0 and not _refreshed:
+        # a dependency may have been installed since an extension failed to import
+        _refreshed = True
+        registry = get_extension_registry(refresh=True)
+        entry = registry[section].get(key)
+    if entry is None:
+        registry["missing"][section].append(key)
+        _save_registry()
+        return None
+    try:
+        return _load_entry(entry)
+    except (ImportError, AttributeError):
+        if _refreshed:
+            raise
+        # the manifest is out of date, a rebuild shows the real error if there is one
+        _refreshed = True
+        entry = get_extension_registry(refresh=True)[section].get(key)
+        if entry is None:
+            return None
+        return _load_entry(entry)
+
+
+def get_registered_model_class(arch: str):
+    # the model class for an arch, importing only its module. None if no extension has it
+    return _resolve("models", arch)
+
+
+def _raise_failed_imports():
+    # extensions were always imported without catching anything, so a broken one still stops the job
+    registry = get_extension_registry()
+    if len(registry["failed"]) == 0:
+        return
+    for module_name in registry["failed"]:
+        try:
+            importlib.import_module(module_name)
+        except ImportError as e:
+            print(f"Failed to import the {module_name} module. Error: {str(e)}")
+            raise
+    # they all import now, a dependency was installed since the manifest was built
+    get_extension_registry(refresh=True)
+
+
+def get_registered_extension(uid: str):
+    _raise_failed_imports()
+    return _resolve("extensions", uid)
+
+
+def get_all_registered_models() -> list:
+    return [_load_entry(entry) for entry in get_extension_registry()["models"].values()]
+
+
+def get_all_registered_extensions() -> list:
+    _raise_failed_imports()
+    return [_load_entry(entry) for entry in get_extension_registry()["extensions"].values()]
@@ -1,5 +1,7 @@
+import json
+from collections import OrderedDict
 from fnmatch import fnmatch
-from typing import List, Optional, Union, TYPE_CHECKING
+from typing import Callable, List, Optional, Union, TYPE_CHECKING
 import torch
 
 from optimum.quanto.quantize import _quantize_submodule
@@ -9,12 +11,14 @@ from torchao.quantization.quant_api import (
     Float8WeightOnlyConfig,
     UIntXWeightOnlyConfig,
 )
-from optimum.quanto import freeze
+from optimum.quanto import freeze, quantization_map
 from tqdm import tqdm
+from safetensors import safe_open
 from safetensors.torch import load_file
 from huggingface_hub import hf_hub_download
 
 from toolkit.print import print_acc
+from toolkit.util.cache_files import get_cache_key, write_cache_file
 import os
 
 if TYPE_CHECKING:
@@ -126,9 +130,135 @@ def quantize(
             # raise e
 
 
+def load_accuracy_recovery_adapter(
+    base_model: "BaseModel",
+    model_to_quantize: torch.nn.Module,
+):
+    from toolkit.config_modules import NetworkConfig
+    from toolkit.lora_special import LoRASpecialNetwork
+
+    # todo handle hf repos
+    load_lora_path = base_model.model_config.accuracy_recovery_adapter
+
+    if not os.path.exists(load_lora_path):
+        # not local file, grab from the hub
+
+        path_split = load_lora_path.split("/")
+        if len(path_split) > 3:
+            raise ValueError(
+                "The accuracy recovery adapter path must be a local path or for a hf repo, 'username/repo_name/filename.safetensors'."
+            )
+        repo_id = f"{path_split[0]}/{path_split[1]}"
+        print_acc(f"Grabbing lora from the hub: {load_lora_path}")
+        new_lora_path = hf_hub_download(
+            repo_id,
+            filename=path_split[-1],
+        )
+        # replace the path
+        load_lora_path = new_lora_path
+
+    # build the lora config based on the lora weights
+    lora_state_dict = load_file(load_lora_path)
+    
+    if hasattr(base_model, "convert_lora_weights_before_load"):
+        lora_state_dict = base_model.convert_lora_weights_before_load(lora_state_dict)
+    
+    network_config = {
+        "type": "lora",
+        "network_kwargs": {"only_if_contains": []},
+        "transformer_only": False,
+    }
+    first_key = list(lora_state_dict.keys())[0]
+    first_weight = lora_state_dict[first_key]
+    # if it starts with lycoris and includes lokr
+    if first_key.startswith("lycoris") and any(
+        "lokr" in key for key in lora_state_dict.keys()
+    ):
+        network_config["type"] = "lokr"
+    
+    network_kwargs = {}
+
+    # find firse loraA weight
+    if network_config["type"] == "lora":
+        linear_dim = None
+        for key, value in lora_state_dict.items():
+            if "lora_A" in key:
+                linear_dim = int(value.shape[0])
+                break
+        linear_alpha = linear_dim
+        network_config["linear"] = linear_dim
+        network_config["linear_alpha"] = linear_alpha
+
+        # we build the keys to match every key
+        only_if_contains = []
+        for key in lora_state_dict.keys():
+            contains_key = key.split(".lora_")[0]
+            if contains_key not in only_if_contains:
+                only_if_contains.append(contains_key)
+
+        network_kwargs["only_if_contains"] = only_if_contains
+    elif network_config["type"] == "lokr":
+        # find the factor
+        largest_factor = 0
+        for key, value in lora_state_dict.items():
+            if "lokr_w1" in key:
+                factor = int(value.shape[0])
+                if factor > largest_factor:
+                    largest_factor = factor
+        network_config["lokr_full_rank"] = True
+        network_config["lokr_factor"] = largest_factor
+
+        only_if_contains = []
+        for key in lora_state_dict.keys():
+            if "lokr_w1" in key:
+                contains_key = key.split(".lokr_w1")[0]
+                contains_key = contains_key.replace("lycoris_", "")
+                if contains_key not in only_if_contains:
+                    only_if_contains.append(contains_key)
+        network_kwargs["only_if_contains"] = only_if_contains
+    
+    if hasattr(base_model, 'target_lora_modules'):
+        network_kwargs['target_lin_modules'] = base_model.target_lora_modules
+
+    # todo auto grab these
+    # get dim and scale
+    network_config = NetworkConfig(**network_config)
+
+    network = LoRASpecialNetwork(
+        text_encoder=None,
+        unet=model_to_quantize,
+        lora_dim=network_config.linear,
+        multiplier=1.0,
+        alpha=network_config.linear_alpha,
+        # conv_lora_dim=self.network_config.conv,
+        # conv_alpha=self.network_config.conv_alpha,
+        train_unet=True,
+        train_text_encoder=False,
+        network_config=network_config,
+        network_type=network_config.type,
+        transformer_only=network_config.transformer_only,
+        is_transformer=base_model.is_transformer,
+        base_model=base_model,
+        is_ara=True,
+        **network_kwargs
+    )
+    network.apply_to(
+        None, model_to_quantize, apply_text_encoder=False, apply_unet=True
+    )
+    network.force_to(base_model.device_torch, dtype=base_model.torch_dtype)
+    network._update_torch_multiplier()
+    network.load_weights(lora_state_dict)
+    network.eval()
+    network.is_active = True
+    network.can_merge_in = False
+    base_model.accuracy_recovery_adapter = network
+    return network
+
+
 def quantize_model(
     base_model: "BaseModel",
     model_to_quantize: torch.nn.Module,
+    cache_name: Optional[str] = None,
 ):
     from toolkit.dequantize import patch_dequantization_on_save
 
@@ -141,125 +271,8 @@ def quantize_model(
     patch_dequantization_on_save(model_to_quantize)
 
     if base_model.model_config.accuracy_recovery_adapter is not None:
-        from toolkit.config_modules import NetworkConfig
-        from toolkit.lora_special import LoRASpecialNetwork
-
         # we need to load and quantize with an accuracy recovery adapter
-        # todo handle hf repos
-        load_lora_path = base_model.model_config.accuracy_recovery_adapter
-
-        if not os.path.exists(load_lora_path):
-            # not local file, grab from the hub
-
-            path_split = load_lora_path.split("/")
-            if len(path_split) > 3:
-                raise ValueError(
-                    "The accuracy recovery adapter path must be a local path or for a hf repo, 'username/repo_name/filename.safetensors'."
-                )
-            repo_id = f"{path_split[0]}/{path_split[1]}"
-            print_acc(f"Grabbing lora from the hub: {load_lora_path}")
-            new_lora_path = hf_hub_download(
-                repo_id,
-                filename=path_split[-1],
-            )
-            # replace the path
-            load_lora_path = new_lora_path
-
-        # build the lora config based on the lora weights
-        lora_state_dict = load_file(load_lora_path)
-        
-        if hasattr(base_model, "convert_lora_weights_before_load"):
-            lora_state_dict = base_model.convert_lora_weights_before_load(lora_state_dict)
-        
-        network_config = {
-            "type": "lora",
-            "network_kwargs": {"only_if_contains": []},
-            "transformer_only": False,
-        }
-        first_key = list(lora_state_dict.keys())[0]
-        first_weight = lora_state_dict[first_key]
-        # if it starts with lycoris and includes lokr
-        if first_key.startswith("lycoris") and any(
-            "lokr" in key for key in lora_state_dict.keys()
-        ):
-            network_config["type"] = "lokr"
-        
-        network_kwargs = {}
-
-        # find firse loraA weight
-        if network_config["type"] == "lora":
-            linear_dim = None
-            for key, value in lora_state_dict.items():
-                if "lora_A" in key:
-                    linear_dim = int(value.shape[0])
-                    break
-            linear_alpha = linear_dim
-            network_config["linear"] = linear_dim
-            network_config["linear_alpha"] = linear_alpha
-
-            # we build the keys to match every key
-            only_if_contains = []
-            for key in lora_state_dict.keys():
-                contains_key = key.split(".lora_")[0]
-                if contains_key not in only_if_contains:
-                    only_if_contains.append(contains_key)
-
-            network_kwargs["only_if_contains"] = only_if_contains
-        elif network_config["type"] == "lokr":
-            # find the factor
-            largest_factor = 0
-            for key, value in lora_state_dict.items():
-                if "lokr_w1" in key:
-                    factor = int(value.shape[0])
-                    if factor > largest_factor:
-                        largest_factor = factor
-            network_config["lokr_full_rank"] = True
-            network_config["lokr_factor"] = largest_factor
-
-            only_if_contains = []
-            for key in lora_state_dict.keys():
-                if "lokr_w1" in key:
-                    contains_key = key.split(".lokr_w1")[0]
-                    contains_key = contains_key.replace("lycoris_", "")
-                    if contains_key not in only_if_contains:
-                        only_if_contains.append(contains_key)
-            network_kwargs["only_if_contains"] = only_if_contains
-        
-        if hasattr(base_model, 'target_lora_modules'):
-            network_kwargs['target_lin_modules'] = base_model.target_lora_modules
-
-        # todo auto grab these
-        # get dim and scale
-        network_config = NetworkConfig(**network_config)
-
-        network = LoRASpecialNetwork(
-            text_encoder=None,
-            unet=model_to_quantize,
-            lora_dim=network_config.linear,
-            multiplier=1.0,
-            alpha=network_config.linear_alpha,
-            # conv_lora_dim=self.network_config.conv,
-            # conv_alpha=self.network_config.conv_alpha,
-            train_unet=True,
-            train_text_encoder=False,
-            network_config=network_config,
-            network_type=network_config.type,
-            transformer_only=network_config.transformer_only,
-            is_transformer=base_model.is_transformer,
-            base_model=base_model,
-            is_ara=True,
-            **network_kwargs
-        )
-        network.apply_to(
-            None, model_to_quantize, apply_text_encoder=False, apply_unet=True
-        )
-        network.force_to(base_model.device_torch, dtype=base_model.torch_dtype)
-        network._update_torch_multiplier()
-        network.load_weights(lora_state_dict)
-        network.eval()
-        network.is_active = True
-        network.can_merge_in = False
-        base_model.accuracy_recovery_adapter = network
+        network = load_accuracy_recovery_adapter(base_model, model_to_quantize)
 
         # quantize it
         lora_exclude_modules = []
@@ -306,6 +319,9 @@ def quantize_model(
             quantize(block, weights=quantization_type)
             freeze(block)
             block.to("cpu", non_blocking=True)
+        # the blocks were copied back to cpu async, make sure they landed before anything reads them
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
 
         # todo, on extras find a universal way to quantize them on device and move them back to their original
         # device without having to move the transformer blocks to the device first
@@ -313,3 +329,274 @@ def quantize_model(
         # model_to_quantize.to(base_model.device_torch, dtype=base_model.torch_dtype)
         quantize(model_to_quantize, weights=quantization_type)
         freeze(model_to_quantize)
+
+    if cache_name is not None:
+        save_quantized_model_to_cache(base_model, model_to_quantize, cache_name)
+
+
+def get_safetensors_files(model_path: str, subfolder: Optional[str] = None) -> List[str]:
+    # local files for a diffusers style folder or hub repo, handles sharded checkpoints
+    if model_path.endswith(".safetensors"):
+        return [model_path]
+    index_name = "diffusion_pytorch_model.safetensors.index.json"
+    single_name = "diffusion_pytorch_model.safetensors"
+    if os.path.exists(model_path):
+        folder = model_path if subfolder is None else os.path.join(model_path, subfolder)
+        index_path = os.path.join(folder, index_name)
+        if os.path.exists(index_path):
+            with open(index_path, "r") as f:
+                shard_names = sorted(set(json.load(f)["weight_map"].values()))
+            return [os.path.join(folder, name) for name in shard_names]
+        return [os.path.join(folder, single_name)]
+    try:
+        index_path = hf_hub_download(model_path, filename=index_name, subfolder=subfolder)
+    except Exception:
+        return [hf_hub_download(model_path, filename=single_name, subfolder=subfolder)]
+    with open(index_path, "r") as f:
+        shard_names = sorted(set(json.load(f)["weight_map"].values()))
+    return [
+        hf_hub_download(model_path, filename=name, subfolder=subfolder)
+        for name in shard_names
+    ]
+
+
+def can_quantize_streaming(base_model: "BaseModel") -> bool:
+    model_config = base_model.model_config
+    # the accuracy recovery adapter has to be attached to the full precision model first
+    return (
+        model_config.quantize
+        and model_config.quantize_streaming
+        and model_config.accuracy_recovery_adapter is None
+    )
+
+
+def quantize_model_streaming(
+    base_model: "BaseModel",
+    model_to_quantize: torch.nn.Module,
+    safetensors_paths: List[str],
+    cache_name: Optional[str] = None,
+):
+    """
+    Same result as quantize_model, but for a model whose parameters are still on the meta device. Each
+    transformer block is read from the safetensors files, quantized and moved to cpu before the next one
+    is read, so host ram peaks at about one full precision block on top of the quantized model.
+    Checkpoint keys have to match the model's state dict keys.
+    """
+    from toolkit.dequantize import patch_dequantization_on_save
+
+    if base_model.model_config.accuracy_recovery_adapter is not None:
+        raise ValueError("Streaming quantization does not support accuracy recovery adapters")
+
+    patch_dequantization_on_save(model_to_quantize)
+    dtype = base_model.torch_dtype
+    keep_in_fp32 = getattr(model_to_quantize, "_keep_in_fp32_modules", None) or []
+
+    handles = [safe_open(path, framework="pt", device="cpu") for path in safetensors_paths]
+    key_to_handle = {}
+    for handle in handles:
+        for key in handle.keys():
+            key_to_handle[key] = handle
+    remaining_keys = set(key_to_handle.keys())
+
+    def load_tensors(prefix: str):
+        state_dict = {}
+        for key in [k for k in remaining_keys if k.startswith(prefix)]:
+            tensor = key_to_handle[key].get_tensor(key)
+            if tensor.is_floating_point():
+                is_fp32 = any(module_name in key.split(".") for module_name in keep_in_fp32)
+                tensor = tensor.to(torch.float32 if is_fp32 else dtype)
+            state_dict[key[len(prefix):]] = tensor
+            remaining_keys.remove(key)
+        return state_dict
+
+    quantization_type = get_qtype(base_model.model_config.qtype)
+    blocks = []
+    for name in base_model.get_transformer_block_names():
+        block_list = getattr(model_to_quantize, name, None)
+        if block_list is not None:
+            blocks += [(f"{name}.{i}.", block) for i, block in enumerate(block_list)]
+    base_model.print_and_status_update(
+        f" - loading and quantizing {len(blocks)} transformer blocks"
+    )
+    for prefix, block in tqdm(blocks):
+        block.load_state_dict(load_tensors(prefix), strict=False, assign=True)
+        block.to(base_model.device_torch, non_blocking=True)
+        quantize(block, weights=quantization_type)
+        freeze(block)
+        block.to("cpu", non_blocking=True)
+    # the blocks were copied back to cpu async, make sure they landed before anything reads them
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+    base_model.print_and_status_update(" - loading and quantizing extras")
+    model_to_quantize.load_state_dict(load_tensors(""), strict=False, assign=True)
+    del handles, key_to_handle
+
+    still_meta = [
+        key for key, value in list(model_to_quantize.named_parameters()) + list(model_to_quantize.named_buffers())
+        if value.is_meta
+    ]
+    if len(still_meta) > 0:
+        raise ValueError(
+            f"{len(still_meta)} weights were not found in the checkpoint, first is {still_meta[0]}. "
+            "Streaming quantization needs a checkpoint with the same keys as the model."
+        )
+    quantize(model_to_quantize, weights=quantization_type)
+    freeze(model_to_quantize)
+
+    if cache_name is not None:
+        save_quantized_model_to_cache(base_model, model_to_quantize, cache_name)
+
+
+# bump if the way models are quantized changes so old cache entries are not used
+QUANTIZED_CACHE_VERSION = 2
+
+
+def can_use_quantized_cache(model_config) -> bool:
+    # the cache restores modules from quanto's quantization map, torchao tensors have no way back
+    return (
+        model_config.quantize
+        and model_config.quantized_cache
+        and model_config.qtype not in torchao_qtypes
+    )
+
+
+def _get_path_stamp(path: Optional[str]):
+    # local weights can be overwritten in place, so the mtime and size go in the key too
+    if path is None or not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def get_quantized_cache_path(base_model: "BaseModel", name: str) -> str:
+    from toolkit.paths import MODELS_PATH
+
+    model_config = base_model.model_config
+    info = OrderedDict([
+        ("name", name),
+        ("arch", model_config.arch),
+        ("name_or_path", model_config.name_or_path),
+        ("name_or_path_stamp", _get_path_stamp(model_config.name_or_path)),
+        ("assistant_lora_path", model_config.assistant_lora_path),
+        ("qtype", model_config.qtype),
+        ("quantize_kwargs", model_config.quantize_kwargs),
+        ("accuracy_recovery_adapter", model_config.accuracy_recovery_adapter),
+        ("accuracy_recovery_adapter_stamp", _get_path_stamp(model_config.accuracy_recovery_adapter)),
+        ("model_kwargs", model_config.model_kwargs),
+        ("dtype", str(base_model.torch_dtype)),
+        ("torch", torch.__version__),
+        ("version", QUANTIZED_CACHE_VERSION),
+    ])
+    cache_dir = model_config.quantized_cache_dir
+    if cache_dir is None:
+        cache_dir = os.path.join(MODELS_PATH, "_quantized_cache")
+    return os.path.join(cache_dir, f"{name}_{get_cache_key(info)}.pt")
+
+
+def save_quantized_model_to_cache(
+    base_model: "BaseModel",
+    model: torch.nn.Module,
+    name: str,
+):
+    if not can_use_quantized_cache(base_model.model_config):
+        return
+    path = get_quantized_cache_path(base_model, name)
+    if os.path.exists(path):
+        return
+    # the raw quantized state dict, not the dequantized one we patch in for saving. Frozen quanto modules
+    # store their weights as plain tensors (weight._data, weight._scale, ...)
+    state_dict = getattr(model, "orig_state_dict", model.state_dict)()
+    # buffers that are not in the state dict are made in __init__ and would stay on meta when loading
+    extra_buffers = {
+        key: value for key, value in model.named_buffers() if key not in state_dict
+    }
+    # only plain tensors, so the cache can be loaded with weights_only=True
+    not_plain = [
+        (key, value.__class__.__name__) for key, value in list(state_dict.items()) + list(extra_buffers.items())
+        if value.__class__ is not torch.Tensor
+    ]
+    if len(not_plain) > 0:
+        print_acc(f"Not caching quantized {name}, {not_plain[0][0]} is a {not_plain[0][1]}")
+        return
+    base_model.print_and_status_update(f" - saving quantized {name} to cache")
+    config = getattr(model, "config", None)
+    cached = {
+        "state_dict": state_dict,
+        "extra_buffers": extra_buffers,
+        "quantization_map": quantization_map(model),
+        # as json so loading does not have to unpickle arbitrary config objects
+        "config": json.dumps(dict(config), default=str) if config is not None else None,
+    }
+    try:
+        write_cache_file(path, lambda tmp_path: torch.save(cached, tmp_path))
+    except Exception as e:
+        print_acc(f"Failed to save quantized {name} to cache: {e}")
+
+
+def load_quantized_model_from_cache(
+    base_model: "BaseModel",
+    name: str,
+    create_empty_model: Callable[[Optional[dict]], torch.nn.Module],
+) -> Optional[torch.nn.Module]:
+    """
+    Loads a model quantized and cached by quantize_model(..., cache_name=name). create_empty_model gets
+    the cached model config and is called on the meta device, the quantized weights are then assigned
+    straight from the cache file, so the full precision weights are never loaded. Returns None if there
+    is nothing cached and the model has to be loaded and quantized the normal way.
+    """
+    from toolkit.dequantize import patch_dequantization_on_save
+
+    model_config = base_model.model_config
+    if not can_use_quantized_cache(model_config):
+        return None
+    path = get_quantized_cache_path(base_model, name)
+    if not os.path.exists(path):
+        return None
+
+    base_model.print_and_status_update(f" - loading quantized {name} from cache")
+    try:
+        # the cache dir can be shared, so never unpickle anything but tensors and plain containers
+        cached = torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+        # only quanto qtypes we know are allowed in the quantization map
+        for qconfig in cached["quantization_map"].values():
+            for qtype_name in [qconfig["weights"], qconfig["activations"]]:
+                if qtype_name != "none" and qtype_name not in qtypes:
+                    raise ValueError(f"Unknown qtype {qtype_name} in the quantization map")
+        config = json.loads(cached["config"]) if cached["config"] is not None else None
+        with torch.device("meta"):
+            model = create_empty_model(config)
+        # swap in the same quanto modules, on meta so nothing is allocated
+        for module_name, module in list(model.named_modules()):
+            qconfig = cached["quantization_map"].get(module_name, None)
+            if qconfig is not None:
+                _quantize_submodule(
+                    model,
+                    module_name,
+                    module,
+                    weights=None if qconfig["weights"] == "none" else qconfig["weights"],
+                    activations=None if qconfig["activations"] == "none" else qconfig["activations"],
+                )
+        model.load_state_dict(cached["state_dict"], strict=False, assign=True)
+        for key, value in cached["extra_buffers"].items():
+            module_name, _, buffer_name = key.rpartition(".")
+            module = model.get_submodule(module_name)
+            module._buffers[buffer_name] = value
+        still_meta = [
+            key for key, value in list(model.named_parameters()) + list(model.named_buffers())
+            if value.is_meta
+        ]
+        if len(still_meta) > 0:
+            raise ValueError(f"{len(still_meta)} tensors missing from the cache, first is {still_meta[0]}")
+    except Exception as e:
+        # an old or broken entry, it gets replaced once the model is quantized again
+        print_acc(f"Failed to load quantized {name} from cache, quantizing again: {e}")
+        os.remove(path)
+        return None
+
+    for param in model.parameters():
+        param.requires_grad = False
+    patch_dequantization_on_save(model)
+    if model_config.accuracy_recovery_adapter is not None:
+        load_accuracy_recovery_adapter(base_model, model)
+    return model
@@ -31,6 +31,36 @@ function closeDb(db: sqlite3.Database) {
   });
 }
 
+type RollupPoint = { step: number; wall_time: number | null; value: number | null };
+
+// mean of each bucket of the resolution, as one point at the first step of the bucket
+function queryRollups(
+  db: sqlite3.Database,
+  key: string,
+  resolution: number,
+  sinceStep: number | null,
+  beforeStep: number | null,
+  limit: number
+) {
+  return all<RollupPoint>(
+    db,
+    `
+    SELECT
+      bucket * ? AS step,
+      last_wall_time AS wall_time,
+      value_sum / count AS value
+    FROM metric_rollups
+    WHERE key = ?
+      AND resolution = ?
+      AND (? IS NULL OR bucket * ? > ?)
+      AND (? IS NULL OR bucket * ? < ?)
+    ORDER BY bucket ASC
+    LIMIT ?
+    `,
+    [resolution, key, resolution, sinceStep, resolution, sinceStep, beforeStep, resolution, beforeStep, limit]
+  );
+}
+
 export async function GET(request: NextRequest, { params }: { params: { jobID: string } }) {
   // this must be awaited to avoid TS error
   const { jobID } = await params;
@@ -59,14 +89,64 @@ export async function GET(request: NextRequest, { params }: { params: { jobID: s
     const keysRows = await all<{ key: string }>(db, `SELECT key FROM metric_keys ORDER BY key ASC`);
     const keys = keysRows.map((r) => r.key);
 
-    const points = await all<{
-      step: number;
-      wall_time: number;
-      value: number | null;
-      value_text: string | null;
-    }>(
-      db,
-      `
+    // with retain_raw_steps set, the trainer deletes old raw rows and only keeps their rollups.
+    // serve the compacted part of the history from the finest rollup, and the raw rows after it.
+    // strided reads are served from rollups too, scanning every raw row to keep one in stride is slow
+    let rawStart: number | null = null;
+    let rollupsOnly = false;
+    let rollupPoints: RollupPoint[] = [];
+    const hasRollups = await all(db, `SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'metric_rollups'`);
+    if (hasRollups.length > 0) {
+      const [range] = await all<{
+        first_seen_step: number | null;
+        raw_min: number | null;
+        resolution: number | null;
+        stride_resolution: number | null;
+      }>(
+        db,
+        `
+        SELECT
+          (SELECT first_seen_step FROM metric_keys WHERE key = ?) AS first_seen_step,
+          (SELECT MIN(step) FROM metrics WHERE key = ?) AS raw_min,
+          (SELECT MIN(resolution) FROM metric_rollups WHERE key = ?) AS resolution,
+          (SELECT MAX(resolution) FROM metric_rollups WHERE key = ? AND resolution <= ?) AS stride_resolution
+        `,
+        [key, key, key, key, stride]
+      );
+      const compacted =
+        range != null &&
+        range.first_seen_step != null &&
+        range.resolution != null &&
+        (range.raw_min == null || range.raw_min > range.first_seen_step);
+      if (stride > 1 && range != null && range.resolution != null) {
+        // the finest rollup that is not finer than the stride, or the finest there is
+        const resolution = range.stride_resolution ?? range.resolution;
+        rollupPoints = await queryRollups(db, key, resolution, sinceStep, null, limit);
+        rollupsOnly = true;
+      } else if (compacted) {
+        const resolution = range.resolution as number;
+        if (sinceStep == null || range.raw_min == null || sinceStep < range.raw_min) {
+          rollupPoints = await queryRollups(db, key, resolution, sinceStep, range.raw_min, limit);
+        }
+        if (range.raw_min != null) {
+          // the bucket holding the oldest raw row was partly compacted, its rollup covers it
+          rawStart = Math.ceil(range.raw_min / resolution) * resolution;
+        }
+      }
+    }
+
+    const rawLimit = limit - rollupPoints.length;
+    const points =
+      rollupsOnly || rawLimit <= 0
+        ? []
+        : await all<{
+            step: number;
+            wall_time: number;
+            value: number | null;
+            value_text: string | null;
+          }>(
+            db,
+            `
       SELECT
         m.step AS step,
         s.wall_time AS wall_time,
@@ -76,21 +156,25 @@ export async function GET(request: NextRequest, { params }: { params: { jobID: s
       JOIN steps s ON s.step = m.step
       WHERE m.key = ?
         AND (? IS NULL OR m.step > ?)
+        AND (? IS NULL OR m.step >= ?)
         AND (m.step % ?) = 0
       ORDER BY m.step ASC
       LIMIT ?
       `,
-      [key, sinceStep, sinceStep, stride, limit]
-    );
+            [key, sinceStep, sinceStep, rawStart, rawStart, stride, rawLimit]
+          );
 
     return NextResponse.json({
       key,
       keys,
-      points: points.map((p) => ({
-        step: p.step,
-        wall_time: p.wall_time,
-        value: p.value ?? (p.value_text ? Number(p.value_text) : null),
-      })),
+      points: [
+        ...rollupPoints,
+        ...points.map((p) => ({
+          step: p.step,
+          wall_time: p.wall_time,
+          value: p.value ?? (p.value_text ? Number(p.value_text) : null),
+        })),
+      ],
     });
   } finally {
     await closeDb(db);
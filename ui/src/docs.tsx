@@ -240,8 +240,10 @@ const docs: { [key: string]: ConfigDoc } = {
         weights, so a larger card is usually still needed.
         <br />
         <br />
-        You can also select the percentage of the layers to offload. It is generally best to offload as few as possible
-        (close to 0%) for best performance, but you can offload more if you need the memory.
+        You can also select the percentage of the layer weights to offload. The percentage is of the weight size, not
+        the number of layers. Layers that do the most compute for their size are offloaded first, since their transfers
+        are the easiest to hide. It is generally best to offload as few as possible (close to 0%) for best performance,
+        but you can offload more if you need the memory.
       </>
     ),
   },